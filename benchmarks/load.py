@@ -0,0 +1,257 @@
+"""
+Measure the throughput, latency and memory of each server mode under load.
+
+Run from the root of the repository:
+
+    python benchmarks/load.py [--requests N] [--clients N] [--output results.json]
+
+A tree of test files is generated in a temporary directory. For each server mode
+and scenario, a server is started in a subprocess (`python -m rheostatic`) and
+loaded by a number of client threads, each of which reuses its connection when
+the server allows it. The requests per second, latency percentiles, bytes
+received and peak memory (RSS, Linux only) of the server are reported, and
+written as JSON with `--output`. Pass the JSON of an earlier run to `--compare`
+to report the change in throughput and latency against it.
+
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import http.client
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, REPO)
+
+from rheostatic import __version__                      # noqa: E402
+
+# The arguments to `rheostatic` for each server mode
+MODES = {
+    'wsgi': [],
+    'wsgi-threads': ['--threads', '8'],
+    'wsgi-workers': ['--workers', '4', '--threads', '4'],
+    'asyncio': ['--engine', 'asyncio'],
+    'preload': ['--threads', '8', '--preload'],
+}
+
+# Each scenario is a root within the generated tree, a URL, the expected status,
+# the share of `--requests` to make and any extra arguments to `rheostatic`
+SCENARIOS = {
+    'small-file': ('site', '/small.html', 200, 1, []),
+    'large-file': ('site', '/large.bin', 200, 0.002, []),
+    '404-page': ('site', '/missing.html', 404, 1, []),
+    '404-plain': ('bare', '/missing.html', 404, 1, []),
+    'huge-listing': ('site', '/huge/', 200, 0.1, []),
+    'default-extension': ('site', '/page', 200, 1, ['--default-extension', '.html']),
+}
+
+
+def make_tree(path, large_size, listing_size):
+    """ Generate the files served by the scenarios. """
+    site = os.path.join(path, 'site')
+    huge = os.path.join(site, 'huge')
+    os.makedirs(huge)
+    os.makedirs(os.path.join(path, 'bare'))
+    with open(os.path.join(site, 'small.html'), 'wb') as f:
+        f.write(b'<p>small</p>\n' * 80)
+    with open(os.path.join(site, 'page.html'), 'wb') as f:
+        f.write(b'<p>page</p>\n' * 80)
+    with open(os.path.join(site, '404.html'), 'wb') as f:
+        f.write(b'<h1>Not Found</h1>\n')
+    with open(os.path.join(site, 'large.bin'), 'wb') as f:
+        # A sparse file, so it costs no disk space
+        f.truncate(large_size)
+    for i in range(listing_size):
+        open(os.path.join(huge, 'file-{:06d}.txt'.format(i)), 'wb').close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(root, args):
+    """ Start a server and return the process and port once it accepts connections. """
+    port = free_port()
+    command = [sys.executable, '-m', 'rheostatic', root, '--host', '127.0.0.1', '--port', str(port), '--quiet']
+    env = dict(os.environ, PYTHONPATH=REPO)
+    process = subprocess.Popen(command + args, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('The server exited with status {}'.format(process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('The server did not start')
+
+
+def peak_rss(pid):
+    """ Return the total peak RSS in KiB of a process and its children, or None if unknown. """
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open('/proc/{}/status'.format(pid)) as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        total += int(line.split()[1])
+            with open('/proc/{0}/task/{0}/children'.format(pid)) as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            return None
+    return total
+
+
+def load(port, url, status, requests, clients):
+    """ Make requests from client threads and return the latencies, errors and bytes received. """
+    counter = itertools.count()
+    latencies = []
+    totals = {'errors': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        times, errors, received = [], 0, 0
+        while next(counter) < requests:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', url)
+                response = connection.getresponse()
+                while True:
+                    chunk = response.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+                if response.status != status:
+                    errors += 1
+                if response.will_close:
+                    connection.close()
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+                continue
+            times.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(times)
+            totals['errors'] += errors
+            totals['bytes'] += received
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, sorted(latencies), totals['errors'], totals['bytes']
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def run(tree, mode, scenario, requests, clients):
+    root, url, status, share, args = SCENARIOS[scenario]
+    requests = max(int(requests * share), clients)
+    process, port = start_server(os.path.join(tree, root), MODES[mode] + args)
+    try:
+        seconds, latencies, errors, received = load(port, url, status, requests, clients)
+        rss = peak_rss(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+    return {
+        'mode': mode,
+        'scenario': scenario,
+        'requests': requests,
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'requests_per_second': round(requests / seconds, 1),
+        'p50_ms': p50 and round(p50 * 1000, 3),
+        'p99_ms': p99 and round(p99 * 1000, 3),
+        'bytes_received': received,
+        'server_peak_rss_kib': rss
+    }
+
+
+def compare(results, baseline):
+    """ Print the change of each result against a baseline run. """
+    previous = {(r['mode'], r['scenario']): r for r in baseline['results']}
+    print('\nChange against {} (rheostatic {}):'.format(baseline.get('started'), baseline.get('version')))
+    for result in results:
+        old = previous.get((result['mode'], result['scenario']))
+        if old is None:
+            continue
+        changes = []
+        for key in ('requests_per_second', 'p50_ms', 'p99_ms'):
+            if old[key] and result[key] is not None:
+                changes.append('{} {:+.1%}'.format(key, result[key] / old[key] - 1))
+        print('{:<14} {:<18} {}'.format(result['mode'], result['scenario'], ', '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=2000,
+                        help='requests per scenario (scaled down for the slower scenarios)')
+    parser.add_argument('-c', '--clients', type=int, default=8, help='concurrent client threads')
+    parser.add_argument('-m', '--mode', action='append', choices=list(MODES),
+                        help='server mode to run; may be repeated (default: all available)')
+    parser.add_argument('-s', '--scenario', action='append', choices=list(SCENARIOS),
+                        help='scenario to run; may be repeated (default: all)')
+    parser.add_argument('--large-size', type=int, default=1024 ** 3, metavar='BYTES',
+                        help='the size of the file of the large-file scenario (default: 1 GiB)')
+    parser.add_argument('--listing-size', type=int, default=20000, metavar='N',
+                        help='the number of files in the directory of the huge-listing scenario')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write the results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with the JSON of an earlier run')
+    args = parser.parse_args()
+
+    modes = args.mode or [mode for mode in MODES if mode != 'wsgi-workers' or hasattr(os, 'fork')]
+    scenarios = args.scenario or list(SCENARIOS)
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'clients': args.clients,
+        'results': []
+    }
+    with tempfile.TemporaryDirectory() as tree:
+        make_tree(tree, args.large_size, args.listing_size)
+        print('{:<14} {:<18} {:>10} {:>10} {:>10} {:>8} {:>10}'.format(
+            'mode', 'scenario', 'req/s', 'p50 ms', 'p99 ms', 'errors', 'rss KiB'))
+        for mode in modes:
+            for scenario in scenarios:
+                result = run(tree, mode, scenario, args.requests, args.clients)
+                report['results'].append(result)
+                print('{mode:<14} {scenario:<18} {requests_per_second:>10} {p50_ms:>10} {p99_ms:>10} '
+                      '{errors:>8} {server_peak_rss_kib!s:>10}'.format(**result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report['results'], json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Measure the time and memory allocated per call on the hot path of the application.
+
+Run from the root of the repository:
+
+    python benchmarks/micro.py [--number N] [--output results.json]
+
+Each case calls the application (or one of the methods it uses to build a
+response) directly with a synthetic environ, so no server or socket is
+involved. The time per call is the best of several repeats. The peak memory
+allocated during a call is measured with tracemalloc, as is any memory retained
+after many calls. Results may be written as JSON with `--output` and compared
+with the JSON of an earlier run with `--compare`.
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+from email import utils as rfc822
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rheostatic import __version__                      # noqa: E402
+from rheostatic.base import Rheostatic                   # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rheostatic', 'tests', 'data')
+
+
+def make_environ(path, method='GET', **extra):
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.url_scheme': 'http',
+    }
+    environ.update(extra)
+    return environ
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def call(app, environ):
+    """ Return a function which makes a request of app and consumes the body. """
+    def request():
+        body = app(dict(environ), start_response)
+        for chunk in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+    return request
+
+
+def get_cases():
+    """ Return a dict of the name of each case and the function it calls. """
+    app = Rheostatic(ROOT)
+    cached = Rheostatic(ROOT, cache_size=128)
+    preloaded = Rheostatic(ROOT, preload=True, cache_size=128)
+    extension = Rheostatic(ROOT, default_extension='.html')
+    negative = Rheostatic(ROOT, negative_cache_size=128)
+    routed = Rheostatic(ROOT, routes=True, default_extension='.html')
+    environ = make_environ('/other.html')
+    headers_stat = os.stat(os.path.join(ROOT, 'other.html'))
+    return {
+        'call-file': call(app, environ),
+        'call-file-cached': call(cached, environ),
+        'call-file-preloaded': call(preloaded, environ),
+        'call-head': call(cached, make_environ('/other.html', 'HEAD')),
+        'call-not-modified': call(cached, make_environ('/other.html', HTTP_IF_NONE_MATCH=cached.resolve(
+            '/other.html').etag)),
+        'call-range': call(cached, make_environ('/other.html', HTTP_RANGE='bytes=10-19')),
+        'call-404-page': call(app, make_environ('/missing.html')),
+        'call-404-negative-cache': call(negative, make_environ('/missing.html')),
+        'call-file-routes': call(routed, environ),
+        'call-404-routes': call(routed, make_environ('/missing.html')),
+        'call-default-extension-routes': call(routed, make_environ('/other')),
+        'call-405': call(app, make_environ('/other.html', 'POST')),
+        'call-redirect': call(app, make_environ('/subdir')),
+        'call-listing': call(app, make_environ('/subdir/')),
+        'call-default-extension': call(extension, make_environ('/other')),
+        'get_full_path': lambda: app.get_full_path('/subdir/subpage.html'),
+        'get_full_path-default-extension': lambda: extension.get_full_path('/other'),
+        'guess_type': lambda: app.guess_type('/srv/site/style.css'),
+        'formatdate': lambda: rfc822.formatdate(usegmt=True),
+        'get_file_headers': lambda: app.get_file_headers(environ['PATH_INFO'], headers_stat),
+        'get_status': lambda: app.get_status(404),
+        'simple_error': lambda: app.simple_error(404, environ, start_response),
+    }
+
+
+def time_per_call(func, number, repeat):
+    """ Return the best time of `repeat` runs of `number` calls, per call, in seconds. """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def memory_per_call(func, number):
+    """ Return the mean peak bytes allocated during a call and the bytes retained per call. """
+    func()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        peaks = 0
+        for i in range(number):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks += tracemalloc.get_traced_memory()[1] - before
+        retained = tracemalloc.get_traced_memory()[0] - base
+    finally:
+        tracemalloc.stop()
+    return peaks / number, retained / number
+
+
+def compare(results, baseline):
+    """ Print the change of each result against a baseline run. """
+    previous = {r['case']: r for r in baseline['results']}
+    print('\nChange against {} (rheostatic {}):'.format(baseline.get('started'), baseline.get('version')))
+    for result in results:
+        old = previous.get(result['case'])
+        if old is None:
+            continue
+        changes = []
+        for key in ('usec_per_call', 'peak_bytes_per_call'):
+            if old[key]:
+                changes.append('{} {:+.1%}'.format(key, result[key] / old[key] - 1))
+        print('{:<34} {}'.format(result['case'], ', '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=2000, help='calls per repeat')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='repeats, of which the best is taken')
+    parser.add_argument('-k', '--case', action='append', help='case to run; may be repeated (default: all)')
+    parser.add_argument('-o', '--output', metavar='FILE', help='write the results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with the JSON of an earlier run')
+    args = parser.parse_args()
+
+    cases = get_cases()
+    names = args.case or list(cases)
+    unknown = set(names) - set(cases)
+    if unknown:
+        parser.error('unknown case(s): {}; choose from {}'.format(', '.join(sorted(unknown)), ', '.join(cases)))
+
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': []
+    }
+    print('{:<34} {:>12} {:>12} {:>14}'.format('case', 'usec/call', 'peak B/call', 'retained B/call'))
+    for name in names:
+        seconds = time_per_call(cases[name], args.number, args.repeat)
+        peak, retained = memory_per_call(cases[name], min(args.number, 500))
+        result = {
+            'case': name,
+            'usec_per_call': round(seconds * 1e6, 3),
+            'peak_bytes_per_call': round(peak, 1),
+            'retained_bytes_per_call': round(retained, 1)
+        }
+        report['results'].append(result)
+        print('{case:<34} {usec_per_call:>12} {peak_bytes_per_call:>12} {retained_bytes_per_call:>14}'.format(
+            **result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report['results'], json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Compare the throughput of the built-in WSGI server with and without the wsgiref
+validator.
+
+Run from the root of the repository:
+
+    python benchmarks/validator.py [--requests N] [--url URL]
+
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import http.client
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rheostatic.base import Rheostatic                   # noqa: E402
+from rheostatic.server import make_wsgi_server           # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'rheostatic', 'tests', 'data')
+
+
+def requests_per_second(validate, requests, url):
+    server = make_wsgi_server(('127.0.0.1', 0), Rheostatic(ROOT), validate=validate, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        start = time.perf_counter()
+        for i in range(requests):
+            client = http.client.HTTPConnection(*server.server_address)
+            client.request('GET', url)
+            client.getresponse().read()
+            client.close()
+        return requests / (time.perf_counter() - start)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=2000, help='requests per mode')
+    parser.add_argument('-u', '--url', default='/other.html', help='URL to request')
+    args = parser.parse_args()
+
+    results = {}
+    for validate in (True, False):
+        results[validate] = requests_per_second(validate, args.requests, args.url)
+        print('validate={!s:<5} {:10.1f} requests/sec'.format(validate, results[validate]))
+    print('speedup without validator: {:.1%}'.format(results[False] / results[True] - 1))
+
+
+if __name__ == '__main__':
+    main()
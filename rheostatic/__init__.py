@@ -25,6 +25,7 @@ SOFTWARE.
 """
 
 from .server import serve
+from .aioserver import serve_async
 from .utils import __version__  # noqa: F401
 
-__all__ = ['serve']
+__all__ = ['serve', 'serve_async']
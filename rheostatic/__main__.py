@@ -25,22 +25,59 @@ SOFTWARE.
 """
 
 import os
+import sys
 import argparse
 
-from . import serve, __version__
+from . import serve, serve_async, utils, __version__
+from .tree import write_pack
+
+
+def cache_control_rule(value):
+    """ Parse a GLOB=VALUE rule of the --cache-control argument. """
+    pattern, sep, cache_control = value.partition('=')
+    if not pattern or not sep or not cache_control:
+        raise argparse.ArgumentTypeError(f'expected GLOB=VALUE, got {value!r}')
+    return pattern, cache_control
 
 
 def parse_args(*args):
     parser = argparse.ArgumentParser(prog='rheostatic',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter,
-                                     description='Rheostatic - A Static File Server with options.')
-    parser.add_argument('root', default='.', nargs='?', help='set the root directory of the server')
+                                     description='Rheostatic - A Static File Server with options.',
+                                     epilog='Run "%(prog)s pack --help" for packing a directory into a single file.')
+    parser.add_argument('root', default='.', nargs='?',
+                        help='set the root directory (or pack file, zip or tar archive) of the server')
     parser.add_argument('-V', '--version', action='version', version='%(prog)s '+__version__,
                         help='show the current version and exit')
     parser.add_argument('-o', '--host', default='localhost',
                         help='set the host (or IP address) of the server')
     parser.add_argument('-p', '--port', default='8000', type=int,
                         help='set the port of the server')
+    parser.add_argument('-E', '--engine', default=argparse.SUPPRESS, choices=['wsgi', 'asyncio'],
+                        help='serve with the threaded WSGI server or the asyncio server (default: wsgi)')
+    parser.add_argument('-w', '--workers', default=argparse.SUPPRESS, type=int, metavar='N',
+                        help='serve requests from N forked worker processes (default: 1)')
+    parser.add_argument('-T', '--threads', default=argparse.SUPPRESS, type=int, metavar='N',
+                        help='serve requests from a pool of N threads in each worker (default: 1)')
+    parser.add_argument('-k', '--keepalive-timeout', default=argparse.SUPPRESS, type=float, metavar='SECONDS',
+                        help='close persistent connections after SECONDS idle; 0 disables them '
+                             '(default: 5, or 0 for the single threaded WSGI server)')
+    parser.add_argument('--max-requests', default=argparse.SUPPRESS, type=int, metavar='N',
+                        help='close persistent connections after N requests (default: 100)')
+    parser.add_argument('--max-connections', default=argparse.SUPPRESS, type=int, metavar='N',
+                        help='serve no more than N connections at once (in each worker), and send others a 503 '
+                             'response (default: no limit)')
+    parser.add_argument('--max-connections-per-ip', default=argparse.SUPPRESS, type=int, metavar='N',
+                        help='serve no more than N connections at once from each client address (in each worker)'
+                             ', and send others a 503 response (default: no limit)')
+    parser.add_argument('--retry-after', default=argparse.SUPPRESS, type=int, metavar='SECONDS',
+                        help='ask clients sent a 503 response to retry after SECONDS (default: 5)')
+    parser.add_argument('--drain-timeout', default=argparse.SUPPRESS, type=float, metavar='SECONDS',
+                        help='on SIGTERM, wait up to SECONDS for responses in progress to finish (default: 30)')
+    parser.add_argument('--validate', action='store_true', default=argparse.SUPPRESS,
+                        help='check all requests and responses with wsgiref.validate (slow; for debugging)')
+    parser.add_argument('-q', '--quiet', action='store_true', default=argparse.SUPPRESS,
+                        help='do not log each request')
     parser.add_argument('-i', '--index-file', default='index.html', metavar='FILENAME',
                         help='set the filename to use for index files')
     parser.add_argument('-t', '--default-type', default='application/octet-stream', metavar='TYPE',
@@ -49,6 +86,74 @@ def parse_args(*args):
                         help='set the encoding with which all files are served')
     parser.add_argument('-x', '--default-extension', default=argparse.SUPPRESS, metavar='.EXT',
                         help='set the default extension to append to URLs')
+    parser.add_argument('--cache-size', default=argparse.SUPPRESS, type=int, metavar='N',
+                        help='cache the resolved path and headers of up to N URLs')
+    parser.add_argument('--cache-ttl', default=argparse.SUPPRESS, type=float, metavar='SECONDS',
+                        help='expire cached URLs after SECONDS')
+    parser.add_argument('--cache-validate', action='store_true', default=argparse.SUPPRESS,
+                        help='confirm cached files are unchanged with a single stat per request')
+    parser.add_argument('--negative-cache-size', default=argparse.SUPPRESS, type=int, metavar='N',
+                        help='cache up to N URLs which were not found, and hold error pages in memory')
+    parser.add_argument('--negative-cache-ttl', default=argparse.SUPPRESS, type=float, metavar='SECONDS',
+                        help='expire URLs cached as not found and error pages after SECONDS')
+    parser.add_argument('--negative-cache-no-validate', dest='negative_cache_validate', action='store_false',
+                        default=argparse.SUPPRESS,
+                        help='trust URLs cached as not found and error pages until they expire, '
+                             'without a stat per request')
+    parser.add_argument('--etag', default=argparse.SUPPRESS, choices=['stat', 'hash', 'none'],
+                        help="build ETags from each file's status or a hash of its content (default: stat)")
+    parser.add_argument('--cache-control', action='append', default=argparse.SUPPRESS, type=cache_control_rule,
+                        metavar='GLOB=VALUE',
+                        help='send files matching GLOB with a Cache-Control header of VALUE (such as '
+                             '"*.css=max-age=3600"); may be repeated, the first match is used')
+    parser.add_argument('--expires', action='store_true', default=argparse.SUPPRESS,
+                        help='send an Expires header matching the max-age of the Cache-Control header')
+    parser.add_argument('--fingerprint-pattern', default=argparse.SUPPRESS, metavar='REGEX',
+                        help='the pattern of the names of files which contain a hash of their content '
+                             '(default: names such as app.3f9a2c.js)')
+    parser.add_argument('--no-fingerprint', dest='fingerprint_pattern', action='store_const', const=None,
+                        default=argparse.SUPPRESS,
+                        help='do not detect files which contain a hash of their content')
+    parser.add_argument('--fingerprint-cache-control', default=argparse.SUPPRESS, metavar='VALUE',
+                        help='the Cache-Control header of files which contain a hash of their content '
+                             '(default: "public, max-age=31536000, immutable")')
+    parser.add_argument('-z', '--precompressed', action='append', default=argparse.SUPPRESS,
+                        choices=['br', 'gzip', 'zstd'], metavar='ENCODING',
+                        help='serve precompressed copies of files in ENCODING (br, gzip or zstd) to clients '
+                             'which accept it; may be repeated in order of preference')
+    parser.add_argument('-c', '--compress', action='append', default=argparse.SUPPRESS,
+                        choices=list(utils.compressors), metavar='ENCODING',
+                        help='compress files of compressible types on the fly in ENCODING (%(choices)s) for '
+                             'clients which accept it; may be repeated in order of preference')
+    parser.add_argument('--compress-min-size', default=argparse.SUPPRESS, type=int, metavar='BYTES',
+                        help='do not compress files smaller than BYTES on the fly (default: 256)')
+    parser.add_argument('--compress-cache-size', default=argparse.SUPPRESS, type=int, metavar='BYTES',
+                        help='keep up to BYTES of files compressed on the fly in memory (default: 16777216)')
+    parser.add_argument('--listing-cache-size', default=argparse.SUPPRESS, type=int, metavar='BYTES',
+                        help='keep up to BYTES of rendered directory listings in memory (default: 4194304)')
+    parser.add_argument('--listing-stream', action='store_true', default=argparse.SUPPRESS,
+                        help='send directory listings as they are rendered')
+    parser.add_argument('--preload', action='store_true', default=argparse.SUPPRESS,
+                        help='load the files in root into memory at startup')
+    parser.add_argument('--preload-file-size', default=argparse.SUPPRESS, type=int, metavar='BYTES',
+                        help='serve preloaded files larger than BYTES from disk (default: 1048576)')
+    parser.add_argument('--preload-max-size', default=argparse.SUPPRESS, type=int, metavar='BYTES',
+                        help='load no more than BYTES of files into memory (default: 268435456)')
+    parser.add_argument('--bandwidth-limit', default=argparse.SUPPRESS, type=int, metavar='BYTES',
+                        help='send files to each client address no faster than BYTES a second')
+    parser.add_argument('--bandwidth-burst', default=argparse.SUPPRESS, type=int, metavar='BYTES',
+                        help='allow each client address to exceed the bandwidth limit by up to BYTES '
+                             '(default: one second of the limit)')
+    parser.add_argument('--timing', action='store_true', default=argparse.SUPPRESS,
+                        help='report the time spent handling each request in a Server-Timing header')
+    parser.add_argument('--routes', action='store_true', default=argparse.SUPPRESS,
+                        help='scan the root at startup and resolve URLs from a table of routes')
+    parser.add_argument('--rescan-interval', default=argparse.SUPPRESS, type=float, metavar='SECONDS',
+                        help='scan the root for the table of routes again every SECONDS')
+    parser.add_argument('--metrics', action='store_true', default=argparse.SUPPRESS,
+                        help='serve metrics in the Prometheus text format at /_rheostatic/metrics')
+    parser.add_argument('--metrics-path', default=argparse.SUPPRESS, metavar='PATH',
+                        help='serve metrics at PATH (default: /_rheostatic/metrics)')
     # A hidden argument for testing purposes.
     # When set, uses the `rheostatic/tests/data/` dir as root
     parser.add_argument('--test', action='store_true', default=argparse.SUPPRESS,
@@ -56,6 +161,14 @@ def parse_args(*args):
 
     args = vars(parser.parse_args(*args))
 
+    if args.get('engine') == 'asyncio' and sys.version_info < (3, 7):
+        parser.error('the asyncio engine requires Python 3.7 or later')
+    if args.get('engine') == 'asyncio' and ('workers' in args or 'threads' in args or 'validate' in args):
+        parser.error('--workers, --threads and --validate are not supported by the asyncio engine')
+
+    if args.get('etag') == 'none':
+        args['etag'] = None
+
     address = (args.pop('host'), args.pop('port'))
     root = args.pop('root')
     if 'test' in args:                                      # pragma: no cover
@@ -65,9 +178,28 @@ def parse_args(*args):
     return address, root, args
 
 
+def parse_pack_args(*args):
+    parser = argparse.ArgumentParser(prog='rheostatic pack',
+                                     description='Pack a directory into a single file which rheostatic can serve.')
+    parser.add_argument('root', help='the directory to pack')
+    parser.add_argument('output', help='the pack file to write')
+    args = parser.parse_args(*args)
+    return args.root, args.output
+
+
 def cli():                                                  # pragma: no cover
+    if sys.argv[1:2] == ['pack']:
+        root, output = parse_pack_args(sys.argv[2:])
+        count = write_pack(root, output)
+        print('Wrote %d entries to %s' % (count, output))
+        return
     address, root, args = parse_args()
-    serve(address, root, **args)
+    # On SIGUSR2, start a new server with the same arguments, which inherits the listening socket
+    args['restart_command'] = [sys.executable, '-m', 'rheostatic'] + sys.argv[1:]
+    if args.pop('engine', 'wsgi') == 'asyncio':
+        serve_async(address, root, **args)
+    else:
+        serve(address, root, **args)
 
 
 if __name__ == '__main__':                                  # pragma: no cover
@@ -0,0 +1,455 @@
+"""
+Rheostatic - A Static File Server with options.
+
+MIT License
+
+Copyright (c) 2016 Waylan Limberg
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import io
+import sys
+import time
+import signal
+import asyncio
+import weakref
+import traceback
+import http.client
+from urllib.parse import unquote, urlsplit
+
+from .base import Rheostatic
+from .server import get_inherited_sockets, spawn_successor
+from . import utils
+
+
+class AsyncServer:
+    """
+    An asyncio based HTTP/1.1 server for a WSGI application.
+
+    The application is called in a thread pool, so that blocking filesystem
+    calls do not stall the event loop. File bodies are sent with
+    `loop.sendfile` and connections are kept alive between requests.
+
+    If `connection_limits` (a `utils.ConnectionLimits`) is set, a connection
+    over a limit is sent a 503 (Service Unavailable) response with a
+    Retry-After header of `retry_after` seconds and closed at once.
+
+    """
+
+    server_version = 'rheostatic/' + utils.__version__
+    request_timeout = 30
+    keepalive_timeout = 5
+    max_requests = 100
+    max_header_size = 65536
+    retry_after = 5
+    draining = False
+
+    def __init__(self, app, address, quiet=False, keepalive_timeout=None, max_requests=None,
+                 connection_limits=None, retry_after=None):
+        self.app = app
+        self.address = address
+        self.quiet = quiet
+        if keepalive_timeout is not None:
+            self.keepalive_timeout = keepalive_timeout
+        if max_requests is not None:
+            self.max_requests = max_requests
+        self.connection_limits = connection_limits
+        if retry_after is not None:
+            self.retry_after = retry_after
+        self.servers = []
+        self._tasks = weakref.WeakSet()
+        self._idle = weakref.WeakSet()
+
+    @property
+    def sockets(self):
+        """ The listening sockets. """
+        return [sock for server in self.servers for sock in server.sockets]
+
+    async def start(self, sockets=None):
+        """
+        Start listening on address, or on the given listening `sockets`.
+
+        The address may resolve to several addresses (such as both 127.0.0.1
+        and ::1 for localhost), each of which is listened on.
+
+        """
+        if not sockets:
+            self.servers = [await asyncio.start_server(self.handle, self.address[0], self.address[1],
+                                                       limit=self.max_header_size)]
+        else:
+            self.servers = [await asyncio.start_server(self.handle, sock=sock, limit=self.max_header_size)
+                            for sock in sockets]
+        self.address = self.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        if not self.servers:
+            await self.start()
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in self.servers))
+        finally:
+            self.close()
+
+    def close(self):
+        """ Stop listening. """
+        for server in self.servers:
+            server.close()
+
+    async def run(self, drain_timeout=30, restart_command=None, sockets=None):
+        """
+        Serve until a SIGTERM, then drain the server.
+
+        Connections in progress are given up to `drain_timeout` seconds to
+        finish. A SIGHUP reloads the application (in a thread) to pick up
+        changed files and flush its caches. If `restart_command` is given, a
+        SIGUSR2 starts it as a new server, which takes over all the listening
+        sockets, and then drains this one.
+
+        """
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+
+        def restart():
+            if not stop.is_set():
+                spawn_successor([sock.fileno() for sock in self.sockets], restart_command)
+                stop.set()
+
+        handlers = {
+            'SIGTERM': stop.set,
+            'SIGHUP': lambda: loop.run_in_executor(None, self.app.reload),
+            'SIGUSR2': restart if restart_command else None
+        }
+        await self.start(sockets)
+        for name, handler in handlers.items():
+            if handler is not None and hasattr(signal, name):
+                loop.add_signal_handler(getattr(signal, name), handler)
+        await stop.wait()
+        await self.drain(drain_timeout)
+
+    async def drain(self, timeout):
+        """
+        Stop accepting connections and wait up to timeout seconds for those open to close.
+
+        Idle persistent connections are closed at once and others once their
+        current response is sent. Any still open at the deadline are closed.
+
+        """
+        self.draining = True
+        self.close()
+        for task in list(self._idle):
+            task.cancel()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # Connections accepted before the socket closed may not have started their task yet
+        await asyncio.sleep(0)
+        while self._tasks:
+            done, pending = await asyncio.wait(set(self._tasks), timeout=max(deadline - loop.time(), 0))
+            if pending:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                break
+
+    async def handle(self, reader, writer):
+        """ Serve requests from a connection until either side closes it. """
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self.handle_limited(reader, writer)
+        except asyncio.CancelledError:
+            # Cancelled by drain. Return normally, as asyncio logs a connection callback which is cancelled
+            if not self.draining:
+                raise
+        finally:
+            self._tasks.discard(task)
+
+    async def handle_limited(self, reader, writer):
+        if self.connection_limits is None:
+            return await self.handle_connection(reader, writer)
+        peer = writer.get_extra_info('peername')
+        address = peer[0] if isinstance(peer, tuple) else ''
+        if not self.connection_limits.acquire(address):
+            try:
+                writer.write(utils.service_unavailable(self.retry_after))
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+            return
+        try:
+            await self.handle_connection(reader, writer)
+        finally:
+            self.connection_limits.release(address)
+
+    async def handle_connection(self, reader, writer):
+        requests = 0
+        task = asyncio.current_task()
+        try:
+            while True:
+                timeout = self.keepalive_timeout if requests else self.request_timeout
+                if requests:
+                    if self.draining:
+                        break
+                    self._idle.add(task)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                finally:
+                    self._idle.discard(task)
+                environ = self.get_environ(head, writer)
+                if environ is None:
+                    await self.send_error(writer)
+                    break
+                requests += 1
+                last = not self.keepalive_timeout or (self.max_requests and requests >= self.max_requests)
+                if not await self.respond(environ, writer, last):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def get_environ(self, head, writer):
+        """ Return a WSGI environ for the request head, or None if it is malformed. """
+        request_line, _, header_block = head.partition(b'\r\n')
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+            headers = http.client.parse_headers(io.BytesIO(header_block))
+        except (ValueError, http.client.HTTPException):
+            return None
+        if not version.startswith('HTTP/1.'):
+            return None
+        if '://' in target:
+            # Absolute form
+            parts = urlsplit(target)
+            target = parts.path + ('?' + parts.query if parts.query else '')
+        path, _, query = target.partition('?')
+        peer = writer.get_extra_info('peername')
+
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path, 'iso-8859-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.address[0],
+            'SERVER_PORT': str(self.address[1]),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0] if peer else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': utils.FileWrapper,
+        }
+        for name, value in headers.items():
+            key = name.upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+        return environ
+
+    def call_app(self, environ):
+        """ Call the application and return its status, headers and body. """
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, list(headers)]
+
+        body = self.app(environ, start_response)
+        return response[0], response[1], body
+
+    def keep_alive(self, environ):
+        """ Return True if the connection may be reused after this request. """
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if environ.get('CONTENT_LENGTH', '0') not in ('', '0') or 'HTTP_TRANSFER_ENCODING' in environ:
+            # The request body is not read, so the connection cannot be reused
+            return False
+        if environ['SERVER_PROTOCOL'] == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    async def respond(self, environ, writer, last=False):
+        """
+        Send the response to a request and return True to keep the connection alive.
+
+        The connection is always closed after the `last` request. If the
+        application raises an error, it is logged to `wsgi.errors` and the
+        connection is closed, after a 500 (Internal Server Error) response if
+        the head of the response has not been sent.
+
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            status, headers, body = await loop.run_in_executor(None, self.call_app, environ)
+        except Exception:
+            await self.handle_error(environ, writer)
+            return False
+        sent = False
+        try:
+            keep_alive = not last and not self.draining and self.keep_alive(environ)
+            names = {name.lower() for name, value in headers}
+            # The body of some responses must be discarded
+            bodyless = environ['REQUEST_METHOD'] == 'HEAD' or status.startswith(('1', '204', '304'))
+            chunked = False
+            if 'content-length' not in names and not bodyless:
+                if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                    chunked = True
+                    headers.append(('Transfer-Encoding', 'chunked'))
+                else:
+                    keep_alive = False
+            if 'date' not in names:
+                headers.append(('Date', utils.http_date_now()))
+            headers.append(('Server', self.server_version))
+            headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+
+            writer.write(self.format_head(status, headers))
+            sent = True
+            if bodyless:
+                length = 0
+                await writer.drain()
+            else:
+                length = await self.send_body(body, writer, chunked)
+            if not self.quiet:
+                self.log_request(environ, status, length)
+        except ConnectionError:
+            raise
+        except Exception:
+            await self.handle_error(environ, writer, sent)
+            return False
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        return keep_alive
+
+    def format_head(self, status, headers):
+        lines = ['HTTP/1.1 ' + status]
+        lines.extend('%s: %s' % header for header in headers)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def send_body(self, body, writer, chunked=False):
+        """ Write the body to the client and return the number of bytes sent. """
+        loop = asyncio.get_running_loop()
+        if isinstance(body, utils.FileWrapper) and not chunked:
+            f, offset, count = body.span()
+            await writer.drain()
+            return await loop.sendfile(writer.transport, f, offset, count)
+
+        length = 0
+        if isinstance(body, (list, tuple)):
+            for chunk in body:
+                length += self.write_chunk(writer, chunk, chunked)
+                await writer.drain()
+        elif hasattr(body, 'pieces'):
+            # A throttled body. Wait on the loop, so that a throttled client does not hold a thread of the executor
+            iterator = body.pieces()
+            while True:
+                piece = await loop.run_in_executor(None, next, iterator, None)
+                if piece is None:
+                    break
+                chunk, delay = piece
+                if delay:
+                    await asyncio.sleep(delay)
+                length += self.write_chunk(writer, chunk, chunked)
+                await writer.drain()
+        else:
+            # Reading from a generator may block on disk
+            iterator = iter(body)
+            while True:
+                chunk = await loop.run_in_executor(None, next, iterator, None)
+                if chunk is None:
+                    break
+                length += self.write_chunk(writer, chunk, chunked)
+                await writer.drain()
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        return length
+
+    def write_chunk(self, writer, chunk, chunked):
+        if chunk:
+            writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+        return len(chunk)
+
+    async def handle_error(self, environ, writer, sent=False):
+        """ Log the error raised by the application and, unless the head of the response was `sent`, send a 500. """
+        traceback.print_exc(file=environ['wsgi.errors'])
+        if not sent:
+            status = '500 Internal Server Error'
+            await self.send_error(writer, status)
+            if not self.quiet:
+                self.log_request(environ, status, len(status))
+
+    async def send_error(self, writer, status='400 Bad Request'):
+        """ Send a plain text response of status and close the connection. """
+        writer.write(self.format_head(status, [
+            ('Content-Length', str(len(status))),
+            ('Content-type', 'text/plain'),
+            ('Connection', 'close')
+        ]) + status.encode('latin-1'))
+        await writer.drain()
+
+    def log_request(self, environ, status, length):
+        sys.stderr.write('%s - - [%s] "%s %s %s" %s %d\n' % (
+            environ['REMOTE_ADDR'],
+            time.strftime('%d/%b/%Y %H:%M:%S'),
+            environ['REQUEST_METHOD'],
+            environ['PATH_INFO'],
+            environ['SERVER_PROTOCOL'],
+            status.split(' ', 1)[0],
+            length
+        ))
+
+
+def serve_async(address, root, quiet=False, keepalive_timeout=None, max_requests=None,  # pragma: no cover
+                max_connections=None, max_connections_per_ip=None, retry_after=None, drain_timeout=30,
+                restart_command=None, **kwargs):
+    """
+    Serve static files from root directory with the asyncio engine.
+
+    Signals are handled as by `serve` (see `AsyncServer.run`).
+
+    """
+
+    if sys.version_info < (3, 7):
+        raise RuntimeError('The asyncio engine requires Python 3.7 or later')
+    app = Rheostatic(root, **kwargs)
+    connection_limits = None
+    if max_connections or max_connections_per_ip:
+        connection_limits = utils.ConnectionLimits(max_connections, max_connections_per_ip)
+    server = AsyncServer(app, address, quiet=quiet, keepalive_timeout=keepalive_timeout,
+                         max_requests=max_requests, connection_limits=connection_limits,
+                         retry_after=retry_after)
+
+    try:
+        sockets = get_inherited_sockets()
+        if sockets:
+            address = sockets[0].getsockname()[:2]
+        print('Starting asyncio server at http://%s:%d/...' % address)
+        print('Serving files from %s' % app.root)
+        print('Press ctrl+c to stop.')
+        asyncio.run(server.run(drain_timeout, restart_command, sockets))
+    except KeyboardInterrupt:
+        print('Quiting...')
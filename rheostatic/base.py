@@ -25,22 +25,43 @@ SOFTWARE.
 """
 
 import os
-import io
+import re
+import stat
+import time
+import json
+import uuid
+import zlib
+import fnmatch
+import hashlib
+import functools
+import contextlib
+import threading
 import posixpath
 import wsgiref
 from email import utils as rfc822
 from urllib.parse import unquote as urlunquote
 from urllib.parse import quote as urlquote
+from urllib.parse import parse_qs
 from html import escape as html_escape
+from collections import namedtuple
 from . import utils
+from .tree import Tree, walk
+from .metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+
+# A resolved request target. `kind` is one of 'file', 'compressed', 'directory'
+# or 'redirect'.
+# `variants` holds (encoding, Resource) pairs for any precompressed copies.
+Resource = namedtuple('Resource', 'kind path stat headers etag variants')
 
 
 class Rheostatic:
     """
     Static File Server with options.
 
-    Serve static files from the given root directory and any subdirectories.
-    Responds to GET and HEAD requests.
+    Serve static files from the given root directory and any subdirectories,
+    or from a pack file written by `tree.write_pack`, a zip archive or an
+    uncompressed tar archive. Responds to GET and HEAD requests.
 
     """
 
@@ -50,6 +71,44 @@ class Rheostatic:
     default_type = 'application/octet-stream'
     encoding = 'utf-8'
     directory_template = utils.directory_template
+    cache_size = 0
+    cache_ttl = None
+    cache_validate = False
+    negative_cache_size = 0
+    negative_cache_ttl = None
+    negative_cache_validate = True
+    etag = 'stat'
+    cache_control = ()
+    expires = False
+    fingerprint_pattern = utils.fingerprint_pattern
+    fingerprint_cache_control = 'public, max-age=31536000, immutable'
+    precompressed = ()
+    compress = ()
+    compress_min_size = 256
+    compress_stream_size = 1024 * 1024
+    compress_cache_size = 16 * 1024 * 1024
+    listing_cache_size = 4 * 1024 * 1024
+    listing_stream = False
+    preload = False
+    preload_file_size = 1024 * 1024
+    preload_max_size = 256 * 1024 * 1024
+    routes = False
+    rescan_interval = None
+    bandwidth_limit = None
+    bandwidth_burst = None
+    timing = False
+    timing_callback = None
+    metrics = False
+    metrics_path = '/_rheostatic/metrics'
+
+    # The methods which are timed when timing is enabled, by the name of their phase
+    timed_methods = {
+        'resolve': 'resolve',
+        'get_full_path': 'path',
+        'stat': 'stat',
+        'get_index': 'index',
+        'list_directory': 'listing'
+    }
 
     def __init__(self, root, **kwargs):
         self.root = os.path.abspath(root)
@@ -57,75 +116,978 @@ class Rheostatic:
         for key, value in kwargs.items():
             setattr(self, key, value)
 
+        self._cache = utils.LRUCache(self.cache_size, self.cache_ttl) if self.cache_size else None
+        self._negative_cache = None
+        self._error_pages = None
+        self._error_pages_validate = self.negative_cache_validate
+        if self.negative_cache_size:
+            self._negative_cache = utils.LRUCache(self.negative_cache_size, self.negative_cache_ttl)
+            self._error_pages = utils.LRUCache(len(utils.http_status), self.negative_cache_ttl)
+        elif self.routes:
+            # Error pages are held until the root is scanned again
+            self._error_pages = utils.LRUCache(len(utils.http_status))
+            self._error_pages_validate = self.cache_validate
+        self._etag_cache = utils.LRUCache(1024)
+        self._compress_cache = utils.LRUCache(self.compress_cache_size, sizeof=len)
+        self._listing_cache = utils.LRUCache(self.listing_cache_size, sizeof=len)
+        self._content_types = {
+            extension: f'{content_type}; charset={self.encoding}'
+            for extension, content_type in utils.types_map.items()
+        }
+        self._default_content_type = f'{self.default_type}; charset={self.encoding}'
+        self._fingerprint = re.compile(self.fingerprint_pattern) if self.fingerprint_pattern else None
+        rules = self.cache_control.items() if isinstance(self.cache_control, dict) else self.cache_control
+        self._cache_control = [
+            (re.compile(fnmatch.translate(pattern.lstrip('/'))), '/' in pattern, value)
+            for pattern, value in rules
+        ]
+        # The tree served from and the prepared resources of its files, swapped as one
+        self._index = (None, {})
+        self._index_local = threading.local()
+        self._index_lock = threading.Lock()
+        self._timing_local = None
+        self._metrics = Metrics() if self.metrics else None
+        self._buckets = utils.LRUCache(4096) if self.bandwidth_limit else None
+        self._routes = None
+        self._rescan_at = float('inf')
+        self._rescan_lock = threading.Lock()
+
+        for encoding in self.compress:
+            if encoding not in utils.compressors:
+                raise ValueError(f'Unsupported compression encoding: {encoding!r}')
+
+        if self.timing or self.timing_callback is not None or self.metrics:
+            self.instrument()
+
+        self._archive_key = None
+        if os.path.isfile(self.root):
+            self.load_archive()
+        elif self.preload:
+            self.preload_tree()
+
+        if self.routes:
+            self._routes = self.build_routes()
+            if self.rescan_interval:
+                self._rescan_at = time.monotonic() + self.rescan_interval
+
     def __call__(self, environ, start_response):
+        while True:
+            index = self._index
+            tree = index[0]
+            if tree is None:
+                return self.dispatch(environ, start_response)
+            if tree.acquire():
+                break
+        try:
+            # Serve the whole response from one tree, even if it is replaced meanwhile
+            with self.using_index(index):
+                body = self.dispatch(environ, start_response)
+        except BaseException:
+            tree.release()
+            raise
+        if not tree.fds or isinstance(body, (list, tuple)):
+            # The body reads from no file of the tree
+            tree.release()
+            return body
+        if isinstance(body, utils.FileWrapper):
+            on_close = body.on_close
+
+            def release():
+                try:
+                    if on_close is not None:
+                        on_close()
+                finally:
+                    tree.release()
+            body.on_close = release
+            return body
+        return utils.ClosingBody(body, tree.release)
+
+    def dispatch(self, environ, start_response):
+        if self._timing_local is not None:
+            return self.call_timed(environ, start_response)
+        return self.handle(environ, start_response)
+
+    @property
+    def _tree(self):
+        return self.get_current_index()[0]
+
+    @property
+    def _tree_resources(self):
+        return self.get_current_index()[1]
+
+    def get_current_index(self):
+        """ Return the tree and prepared resources which the current request is served from. """
+        return getattr(self._index_local, 'index', None) or self._index
+
+    @contextlib.contextmanager
+    def using_index(self, index):
+        """ Serve from index (or from the current tree if None) in this thread for the duration. """
+        pinned = getattr(self._index_local, 'index', None)
+        self._index_local.index = index
+        try:
+            yield
+        finally:
+            self._index_local.index = pinned
+
+    def instrument(self):
+        """ Wrap each of the `timed_methods` of this instance to record its duration. """
+        self._timing_local = threading.local()
+        for name, phase in self.timed_methods.items():
+            setattr(self, name, self.timed(getattr(self, name), phase))
+
+    def timed(self, method, phase):
+        """ Return a wrapper of method which adds its duration to the timings of the current request. """
+        local = self._timing_local
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            timings = getattr(local, 'timings', None)
+            if timings is None:
+                return method(*args, **kwargs)
+            timings.begin(phase)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timings.end(phase)
+        return wrapper
+
+    def call_timed(self, environ, start_response):
+        """
+        Handle a request, recording the time spent in each phase.
+
+        The timings are stored in the environ as `rheostatic.timings`. When
+        `timing` is set, the phases are reported in a Server-Timing header.
+        Once the body has been sent, the timings and the environ are passed to
+        the `timing_callback` and recorded in the metrics.
+
+        """
+        timings = environ['rheostatic.timings'] = utils.Timings()
+        content_length = []
+
+        def timed_start_response(status, headers, exc_info=None):
+            timings.status = int(status[:3])
+            content_length[:] = [v for k, v in headers if k == 'Content-Length']
+            if self.timing:
+                headers.append(('Server-Timing', timings.server_timing()))
+            if exc_info is None:
+                return start_response(status, headers)
+            return start_response(status, headers, exc_info)    # pragma: no cover
+
+        def finish(bytes_sent):
+            timings.finish(bytes_sent)
+            if self._metrics is not None:
+                self._metrics.finish(timings)
+            if self.timing_callback is not None:
+                self.timing_callback(timings, environ)
+
+        if self._metrics is not None:
+            self._metrics.start()
+        self._timing_local.timings = timings
+        try:
+            body = self.handle(environ, timed_start_response)
+        finally:
+            self._timing_local.timings = None
+        timings.responded = time.perf_counter()
+        if isinstance(body, utils.FileWrapper):
+            # Leave the body for the server to send with sendfile
+            body.on_close = functools.partial(finish, int(content_length[0]) if content_length else 0)
+            return body
+        return utils.TimedBody(body, finish)
+
+    def handle(self, environ, start_response):
         """ Send the response code and MIME headers. """
         if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
             # Unsupported method
             headers = [('Allow', 'GET, HEAD')]
             return self.error(405, environ, start_response, headers)
 
-        path_info = environ.get('PATH_INFO', '')
+        if self._metrics is not None and environ.get('PATH_INFO') == self.metrics_path:
+            return self.send_metrics(environ, start_response)
+
+        resource = self.resolve(environ.get('PATH_INFO', ''))
+
+        if resource is None:
+            return self.error(404, environ, start_response)
+
+        if resource.kind == 'redirect':
+            # Dir does not end with /, redirect
+            location = wsgiref.util.request_uri(environ, include_query=False) + '/'
+            if environ.get('QUERY_STRING'):
+                location += '?' + environ.get('QUERY_STRING')  # pragma: no cover
+            headers = [('Location', location)]
+            return self.simple_error(301, environ, start_response, headers)
+
+        if resource.kind == 'directory':
+            return self.list_directory(resource.path, environ, start_response)
+
+        resource = self.negotiate(resource, environ)
+
+        headers = [('Date', utils.http_date_now())]
+        if self.expires:
+            headers.extend(self.get_expires_headers(resource))
+        if self.is_not_modified(resource, environ):
+            headers.extend(h for h in resource.headers if h[0] in ('Last-Modified', 'ETag', 'Cache-Control', 'Vary'))
+            start_response(self.get_status(304), headers)
+            return []
+
+        size = resource.stat.st_size
+        ranges = self.get_ranges(resource, environ)
+        if ranges is not None and not ranges:
+            headers = [('Content-Range', 'bytes */%d' % size)]
+            return self.error(416, environ, start_response, headers)
+
+        try:
+            if resource.kind == 'compressed':
+                status = 200
+                headers.extend(resource.headers)
+                body, length = self.get_compressed_body(resource, environ)
+                if length is not None:
+                    headers.append(('Content-Length', str(length)))
+            elif ranges is None:
+                status = 200
+                headers.extend(resource.headers)
+                body = self.get_body(resource.path, environ)
+            elif len(ranges) == 1:
+                status = 206
+                start, stop = ranges[0]
+                headers.extend(h for h in resource.headers if h[0] != 'Content-Length')
+                headers.extend([
+                    ('Content-Length', str(stop - start)),
+                    ('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1, size))
+                ])
+                body = self.get_body(resource.path, environ, start, stop - start)
+            else:
+                status = 206
+                body, length, content_type = self.get_multipart_body(resource, ranges, environ)
+                headers.extend(h for h in resource.headers
+                               if h[0] not in ('Content-Length', 'Content-type'))
+                headers.extend([
+                    ('Content-Length', str(length)),
+                    ('Content-type', content_type)
+                ])
+        except OSError:                      # pragma: no cover
+            self.forget(environ.get('PATH_INFO', ''))
+            return self.error(404, environ, start_response)
+        if self._buckets is not None and environ['REQUEST_METHOD'] != 'HEAD':
+            body = self.throttle(body, environ)
+        start_response(self.get_status(status), headers)
+        return body
+
+    def throttle(self, body, environ):
+        """
+        Return the body wrapped to be sent no faster than the `bandwidth_limit`.
+
+        The limit (in bytes a second) is shared by all responses to a client
+        address, which may exceed it by up to `bandwidth_burst` bytes (by
+        default, one second's worth). A throttled file is read in blocks rather
+        than sent by the server with `sendfile`.
+
+        """
+        address = environ.get('REMOTE_ADDR', '')
+        bucket = self._buckets.get(address)
+        if bucket is None:
+            bucket = utils.TokenBucket(self.bandwidth_limit, self.bandwidth_burst)
+            self._buckets.set(address, bucket)
+        return utils.ThrottledBody(body, bucket)
+
+    def send_metrics(self, environ, start_response):
+        """ Send the metrics and the statistics of the caches in the Prometheus text format. """
+        caches = {
+            'resolve': self._cache,
+            'negative': self._negative_cache,
+            'error_pages': self._error_pages,
+            'etag': self._etag_cache,
+            'compress': self._compress_cache,
+            'listing': self._listing_cache
+        }
+        content = self._metrics.render({name: cache for name, cache in caches.items() if cache is not None})
+        content = content.encode('utf-8')
+        start_response(self.get_status(200), [
+            ('Date', utils.http_date_now()),
+            ('Cache-Control', 'no-store'),
+            ('Content-Length', str(len(content))),
+            ('Content-type', METRICS_CONTENT_TYPE)
+        ])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return [b'']
+        return [content]
+
+    def resolve(self, path_info):
+        """
+        Return the Resource which path_info refers to or None if none exists.
+
+        When `cache_size` is set, resolved resources are cached by path_info so
+        that repeat requests for the same URL do not touch the filesystem. When
+        `negative_cache_size` is set, URLs which resolve to nothing are cached
+        likewise.
+
+        When `routes` is set, path_info is looked up in the route table instead.
+
+        """
+        if self._routes is not None:
+            return self.route(path_info)
+        if self._cache is not None:
+            resource = self._cache.get(path_info)
+            if resource is not None and self.is_fresh(resource):
+                return resource
+        if self._negative_cache is not None:
+            missing = self._negative_cache.get(path_info)
+            if missing is not None and self.is_still_missing(missing):
+                return None
+        resource = self.resolve_uncached(path_info)
+        if self.get_current_index() is not self._index:
+            # Resolved within a tree which has since been replaced
+            return resource
+        if resource is not None and self._cache is not None:
+            self._cache.set(path_info, resource)
+        if resource is None and self._negative_cache is not None:
+            self._negative_cache.set(path_info, self.get_missing_key(path_info))
+        return resource
+
+    def route(self, path_info):
+        """
+        Return the Resource which path_info refers to in the route table or None if none exists.
+
+        A URL which is not in the table as-is (such as one with a `..` segment
+        or an escaped character) is normalized and looked up again. Unless
+        `cache_validate` is set, files are not checked for changes since the
+        table was built.
+
+        """
+        if time.monotonic() >= self._rescan_at:
+            self.rescan(blocking=False)
+        routes = self._routes
+        resource = routes.get(path_info)
+        if resource is None:
+            key = self.get_route_key(path_info)
+            if key is None or key == path_info:
+                return None
+            resource = routes.get(key)
+        if resource is not None and resource.kind == 'file' and not self.is_fresh(resource):
+            resource = self.resolve_uncached(path_info)
+        return resource
+
+    def get_route_key(self, path_info):
+        """ Return the key of path_info in the route table, or None if it cannot be decoded. """
+        try:
+            path = utils.decode_path_info(path_info)
+        except UnicodeDecodeError:
+            return None
+        path = posixpath.normpath(urlunquote(path))
+        if path == '.':
+            return ''
+        path = '/' + path.lstrip('/')
+        if path_info.endswith('/') and path != '/':
+            path += '/'
+        return path.encode('utf-8').decode('iso-8859-1')
+
+    def rescan(self, blocking=True):
+        """
+        Build the route table, which maps every URL that resolves to a Resource.
+
+        This includes the redirect of each directory without a trailing slash,
+        the index file or listing of each directory with one and the
+        extensionless alias of each file with the `default_extension`. The
+        Resources of files which are unchanged since the last scan are reused.
+        A preloaded tree is loaded again.
+
+        Unless `blocking` is set, nothing is done while another thread is
+        scanning, which continues to use the current table meanwhile.
+
+        """
+        if not self._rescan_lock.acquire(blocking):
+            return
+        try:
+            if self.rescan_interval:
+                self._rescan_at = time.monotonic() + self.rescan_interval
+            else:
+                self._rescan_at = float('inf')
+            # Scan the tree being served, rather than one this thread's request was pinned to
+            with self.using_index(None):
+                if self.preload and not os.path.isfile(self.root):
+                    self.preload_tree()
+                previous = {}
+                if self._routes is not None:
+                    previous = {r.path: r for r in self._routes.values() if r.kind == 'file'}
+                self._routes = self.build_routes(previous)
+            self.forget()
+        finally:
+            self._rescan_lock.release()
+
+    def reload(self):
+        """
+        Load the root again and flush every cache.
+
+        An archive is indexed again if it has been replaced or modified since it
+        was loaded. The previous archive is closed once the responses in progress
+        which read from it are closed. A preloaded tree is loaded again and the
+        route table rebuilt.
+
+        """
+        if os.path.isfile(self.root):
+            self.load_archive()
+        elif self.preload and self._routes is None:
+            self.preload_tree()
+        if self._routes is not None:
+            self.rescan()
+        for cache in (self._etag_cache, self._compress_cache, self._listing_cache):
+            cache.clear()
+        self.forget()
+
+    def load_archive(self):
+        """ Serve from the index of the archive at the root, unless it is unchanged since it was loaded. """
+        root_stat = os.stat(self.root)
+        key = (root_stat.st_ino, root_stat.st_mtime_ns, root_stat.st_size)
+        if key != self._archive_key:
+            self.load_tree(Tree.from_archive(self.root))
+            self._archive_key = key
+
+    def build_routes(self, previous=None):
+        """ Return a new route table, reusing the unchanged Resources of files in `previous`. """
+        previous = previous or {}
+        if self._tree is not None and self._tree.complete:
+            entries = self._tree.stats.items()
+        else:
+            entries = ((path, file_stat) for path, file_stat, is_link in walk(self.root, unique=False))
+        stats = {}
+        for path, file_stat in entries:
+            if path == self.root or path.startswith(self.root + os.sep):
+                stats[path] = file_stat
+
+        routes = {}
+        files = {}
+        for path, file_stat in stats.items():
+            if stat.S_ISREG(file_stat.st_mode):
+                resource = previous.get(path)
+                if resource is None or (resource.stat.st_mtime_ns, resource.stat.st_size) != (
+                        file_stat.st_mtime_ns, file_stat.st_size):
+                    resource = self._tree_resources.get(path) or self.get_file_resource(path, file_stat)
+                files[path] = resource
+        for path, file_stat in stats.items():
+            url = path[len(self.root):].replace(os.sep, '/')
+            if stat.S_ISDIR(file_stat.st_mode):
+                self.add_route(routes, url, Resource('redirect', path, file_stat, None, None, ()))
+                resource = files.get(os.path.join(path, self.index_file))
+                if resource is None:
+                    resource = Resource('directory', path, file_stat, None, None, ())
+                self.add_route(routes, url + '/', resource)
+            elif path in files:
+                self.add_route(routes, url, files[path])
+        if self.default_extension:
+            for url, resource in list(routes.items()):
+                alias = url[:-len(self.default_extension)]
+                if (resource.kind == 'file' and url.endswith(self.default_extension) and
+                        alias and posixpath.splitext(alias)[1] == '' and alias not in routes):
+                    self.add_route(routes, alias, resource)
+        return routes
+
+    def add_route(self, routes, url, resource):
+        # Add a URL in its WSGI form, unless requests for it would be normalized to another
+        key = url.encode('utf-8', 'surrogateescape').decode('iso-8859-1')
+        if self.get_route_key(key) == key:
+            routes[key] = resource
+
+    def get_missing_key(self, path_info):
+        """
+        Return the path and modification time of the nearest existing directory
+        above the path which path_info refers to.
+
+        Creating the missing path (or any directory leading to it) changes the
+        modification time of that directory. (None, None) is returned if there
+        is no such directory within the root or `negative_cache_validate` is not
+        set.
+
+        """
+        if self.negative_cache_validate:
+            parent = os.path.dirname(self.get_full_path(path_info))
+            while parent.startswith(self.root):
+                try:
+                    return parent, self.stat(parent).st_mtime_ns
+                except OSError:
+                    parent = os.path.dirname(parent)
+        return None, None
+
+    def is_still_missing(self, key):
+        """
+        Return True if a URL cached as missing may still be treated as missing.
+
+        Unless `negative_cache_validate` is unset, a single `os.stat` confirms
+        that the nearest existing directory is unchanged.
+
+        """
+        parent, mtime_ns = key
+        if parent is None:
+            return True
+        try:
+            return self.stat(parent).st_mtime_ns == mtime_ns
+        except OSError:
+            return False
+
+    def preload_tree(self):
+        """
+        Walk the root directory and load its files into memory.
+
+        The content of each file up to `preload_file_size` bytes is read into
+        memory until a total of `preload_max_size` bytes is reached. Larger files
+        are read from disk.
+
+        """
+        self.load_tree(Tree.from_directory(self.root, self.preload_file_size, self.preload_max_size))
+
+    def load_tree(self, tree):
+        """
+        Serve from an index of the tree.
+
+        The headers of every file in the index are prepared, so that resolving a
+        URL within the tree needs no system calls. The tree and its headers then
+        replace the previous tree at once, which is retired.
+
+        """
+        with self.using_index((tree, {})):
+            resources = {
+                path: self.get_file_resource(path, file_stat)
+                for path, file_stat in tree.stats.items() if stat.S_ISREG(file_stat.st_mode)
+            }
+        with self._index_lock:
+            previous = self._index[0]
+            self._index = (tree, resources)
+        self.forget()
+        if previous is not None:
+            previous.retire()
+
+    def stat(self, path):
+        """ Return `os.stat(path)`, using the index of the tree if possible. """
+        if self._tree is not None:
+            return self._tree.stat(path)
+        return os.stat(path)
+
+    def open_file(self, path):
+        """ Open a file for reading in binary mode, using the index of the tree if possible. """
+        if self._tree is not None:
+            return self._tree.open(path)
+        return open(path, 'rb')
+
+    def read_file(self, path):
+        """ Return the content of a file, using the index of the tree if possible. """
+        if self._tree is not None and path in self._tree.data:
+            return self._tree.data[path]
+        with self.open_file(path) as f:
+            return f.read()
+
+    def resolve_uncached(self, path_info):
+        """ Resolve path_info against the filesystem. """
         path = self.get_full_path(path_info)
 
         if not path.startswith(self.root):              # pragma: no cover
             # Outside server root
-            return self.error(404, environ, start_response)
+            return None
+
+        try:
+            file_stat = self.stat(path)
+        except OSError:
+            return None
 
-        if os.path.isdir(path):
+        if stat.S_ISDIR(file_stat.st_mode):
             if not path_info.endswith('/'):
-                # Dir does not end with /, redirect
-                location = wsgiref.util.request_uri(environ, include_query=False) + '/'
-                if environ.get('QUERY_STRING'):
-                    location += '?' + environ.get('QUERY_STRING')  # pragma: no cover
-                headers = [('Location', location)]
-                return self.simple_error(301, environ, start_response, headers)
-            index = os.path.join(path, self.index_file)
-            if os.path.isfile(index):
-                path = index
-            else:
-                return self.list_directory(path, environ, start_response)
+                return Resource('redirect', path, file_stat, None, None, ())
+            index = self.get_index(path)
+            if index is None:
+                return Resource('directory', path, file_stat, None, None, ())
+            path, file_stat = index
+
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+
+        resource = self._tree_resources.get(path)
+        if resource is None:
+            resource = self.get_file_resource(path, file_stat)
+        return resource
+
+    def get_index(self, path):
+        """ Return the path and status of the index file of a directory, or None if it has none. """
+        index = os.path.join(path, self.index_file)
+        try:
+            index_stat = self.stat(index)
+        except OSError:
+            return None
+        if not stat.S_ISREG(index_stat.st_mode):
+            return None
+        return index, index_stat
+
+    def get_file_resource(self, path, file_stat):
+        """
+        Return a Resource for a regular file.
 
-        if os.path.isfile(path):
+        A deflated member of a zip archive has a gzip variant, which is sent
+        without being inflated.
+
+        """
+        etag = self.get_etag(path, file_stat)
+        headers = self.get_file_headers(path, file_stat, etag)
+        variants = self.get_variants(path)
+        deflated = self._tree is not None and path in self._tree.deflated
+        if variants or deflated or self.should_compress(path, file_stat):
+            headers.append(('Vary', 'Accept-Encoding'))
+        resource = Resource('file', path, file_stat, headers, etag, variants)
+        if deflated:
+            variant = self.get_compressed_resource(resource, 'gzip')
+            resource = resource._replace(variants=variants + (('gzip', variant),))
+        return resource
+
+    def get_variants(self, path):
+        """
+        Return (encoding, Resource) pairs for precompressed copies of a file.
+
+        A copy shares the name of the file with an extension for the encoding
+        appended (for example `style.css.gz`) and is served with the ContentType
+        of the original file.
+
+        """
+        variants = []
+        for encoding in self.precompressed:
+            variant_path = path + utils.encoding_extensions[encoding]
             try:
-                file_stat = os.stat(path)
-                headers = [
-                    ('Date', rfc822.formatdate(usegmt=True)),
-                    ('Last-Modified', rfc822.formatdate(file_stat.st_mtime, usegmt=True)),
-                    ('Content-Length', str(file_stat.st_size)),
-                    ('Content-type', '{}; charset={}'.format(self.guess_type(path),
-                                                             self.encoding))
-                ]
-                # TODO: add support for HTTP_IF_MODIFIED_SINCE and HTTP_IF_NONE_MATCH
-                start_response(self.get_status(200), headers)
-                return self.get_body(path, environ)
-            except OSError:                  # pragma: no cover
-                return self.error(404, environ, start_response)
-
-        return self.error(404, environ, start_response)
+                variant_stat = self.stat(variant_path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(variant_stat.st_mode):
+                continue
+            etag = self.get_etag(variant_path, variant_stat)
+            headers = self.get_file_headers(path, variant_stat, etag)
+            headers.extend([('Content-Encoding', encoding), ('Vary', 'Accept-Encoding')])
+            variants.append((encoding, Resource('file', variant_path, variant_stat, headers, etag, ())))
+        return tuple(variants)
+
+    def negotiate(self, resource, environ):
+        """
+        Return the variant of resource which best suits the client.
+
+        Precompressed copies are preferred. Failing that, a compressible file
+        may be compressed on the fly. Neither compressed variant is used if the
+        client requested a range.
+
+        """
+        ranged = 'HTTP_RANGE' in environ
+        compress = self.should_compress(resource.path, resource.stat) and not ranged
+        if not resource.variants and not compress:
+            return resource
+        accepted = utils.parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        best, best_q = resource, 0
+        for encoding, variant in resource.variants:
+            if ranged and variant.kind == 'compressed':
+                continue
+            q = accepted.get(encoding, accepted.get('*', 0))
+            if q > best_q:
+                best, best_q = variant, q
+        if best is resource and compress:
+            for encoding in self.compress:
+                q = accepted.get(encoding, accepted.get('*', 0))
+                if q > best_q:
+                    best, best_q = self.get_compressed_resource(resource, encoding), q
+        return best
+
+    def should_compress(self, path, file_stat):
+        """ Return True if the file may be compressed on the fly. """
+        return bool(self.compress and
+                    file_stat.st_size >= self.compress_min_size and
+                    utils.is_compressible(self.guess_type(path)))
+
+    def get_compressed_resource(self, resource, encoding):
+        """
+        Return a Resource for a file compressed on the fly.
+
+        The Content-Length is left for `get_compressed_body` to determine.
+
+        """
+        etag = resource.etag and '{}-{}"'.format(resource.etag[:-1], encoding)
+        headers = [h for h in resource.headers if h[0] not in ('Content-Length', 'Accept-Ranges', 'ETag')]
+        if etag:
+            headers.append(('ETag', etag))
+        headers.append(('Content-Encoding', encoding))
+        return Resource('compressed', resource.path, resource.stat, headers, etag, ())
+
+    def get_compressed_body(self, resource, environ):
+        """
+        Return the body of a compressed Resource and its length.
+
+        Files up to `compress_stream_size` are compressed in one pass and kept
+        in a cache bounded to `compress_cache_size` bytes. Larger files are
+        compressed as they are streamed, so their length is unknown (None). The
+        deflated data of a zip archive member is sent as gzip as it is.
+
+        """
+        encoding = dict(resource.headers)['Content-Encoding']
+        if encoding == 'gzip' and self._tree is not None and resource.path in self._tree.deflated:
+            fd, start, end, crc = self._tree.deflated[resource.path]
+            length = end - start + utils.GZIP_OVERHEAD
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                return [b''], length
+            body = utils.iter_gzip_member(utils.PositionalFile(fd, start, end), crc, resource.stat.st_size)
+            return body, length
+        if resource.stat.st_size <= self.compress_stream_size:
+            key = (resource.path, resource.stat.st_mtime_ns, resource.stat.st_size, encoding)
+            data = self._compress_cache.get(key)
+            if data is None:
+                data = utils.compress(self.read_file(resource.path), encoding)
+                self._compress_cache.set(key, data)
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                return [b''], len(data)
+            return [data], len(data)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return [b''], None
+        return utils.iter_compressed(self.open_file(resource.path), encoding), None
+
+    def is_fresh(self, resource):
+        """
+        Return True if a cached resource may be served as-is.
+
+        Unless `cache_validate` is set, cached resources are trusted until they
+        expire. Otherwise a single `os.stat` confirms the file is unchanged.
+
+        """
+        if not self.cache_validate:
+            return True
+        try:
+            file_stat = self.stat(resource.path)
+        except OSError:
+            return False
+        return (file_stat.st_mtime_ns == resource.stat.st_mtime_ns and
+                file_stat.st_size == resource.stat.st_size)
+
+    def forget(self, path_info=None):
+        """ Drop path_info (or everything if not given) from the caches. """
+        for cache in (self._cache, self._negative_cache):
+            if cache is not None:
+                if path_info is None:
+                    cache.clear()
+                else:
+                    cache.pop(path_info)
+        if path_info is None and self._error_pages is not None:
+            self._error_pages.clear()
+
+    def get_file_headers(self, path, file_stat, etag=None):
+        """ Return the headers which only depend upon the file itself. """
+        headers = [
+            ('Last-Modified', utils.http_date(file_stat.st_mtime)),
+            ('Content-Length', str(file_stat.st_size)),
+            ('Content-type', self.get_content_type(path)),
+            ('Accept-Ranges', 'bytes')
+        ]
+        if etag:
+            headers.append(('ETag', etag))
+        cache_control = self.get_cache_control(path)
+        if cache_control:
+            headers.append(('Cache-Control', cache_control))
+        return headers
+
+    def get_cache_control(self, path):
+        """
+        Return the Cache-Control header value for a file, or None if it should have none.
+
+        A file whose name matches the `fingerprint_pattern` (as it contains a hash
+        of its content) gets the `fingerprint_cache_control`. Otherwise, the value
+        of the first of the `cache_control` rules whose glob pattern matches is
+        used. A pattern which contains a slash is matched against the path of the
+        file within the root and any other pattern against its name.
+
+        """
+        name = os.path.basename(path)
+        if self._fingerprint is not None and self._fingerprint.search(name):
+            return self.fingerprint_cache_control
+        if self._cache_control:
+            relpath = path[len(self.root) + 1:].replace(os.sep, '/')
+            for pattern, match_path, value in self._cache_control:
+                if pattern.match(relpath if match_path else name):
+                    return value
+        return None
+
+    def get_expires_headers(self, resource):
+        """ Return an Expires header for a Resource which has a Cache-Control max-age, or none. """
+        for name, value in resource.headers:
+            if name == 'Cache-Control':
+                max_age = utils.parse_max_age(value)
+                if max_age is not None:
+                    return [('Expires', utils.http_date(time.time() + max_age))]
+        return []
+
+    def get_etag(self, path, file_stat):
+        """
+        Return the entity tag for a file as set by the `etag` option.
+
+        A 'stat' tag is built from the modification time and size of the file. A
+        'hash' tag is a digest of the file content, which is only recalculated
+        when the modification time or size of the file changes. A pack records
+        a hash of each file, which is used whatever the `etag` option (unless
+        it is None).
+
+        """
+        if self.etag and self._tree is not None and path in self._tree.etags:
+            return self._tree.etags[path]
+        if self.etag == 'stat':
+            return '"{:x}-{:x}"'.format(file_stat.st_mtime_ns, file_stat.st_size)
+        if self.etag == 'hash':
+            key = (path, file_stat.st_mtime_ns, file_stat.st_size)
+            etag = self._etag_cache.get(key)
+            if etag is None:
+                digest = hashlib.blake2b(digest_size=16)
+                with self.open_file(path) as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        digest.update(chunk)
+                etag = '"{}"'.format(digest.hexdigest())
+                self._etag_cache.set(key, etag)
+            return etag
+        return None
+
+    def is_not_modified(self, resource, environ):
+        """
+        Return True if the client's cached copy of the resource is current.
+
+        As required by RFC 7232, If-Modified-Since is ignored when the request
+        includes If-None-Match.
+
+        """
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+            if resource.etag is None:
+                return False
+            # Use the weak comparison function
+            etag = resource.etag[2:] if resource.etag.startswith('W/') else resource.etag
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag == etag:
+                    return True
+            return False
+
+        if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            date = rfc822.parsedate_tz(if_modified_since)
+            if date is None:
+                return False
+            return int(resource.stat.st_mtime) <= rfc822.mktime_tz(date)
+        return False
 
     def get_full_path(self, path_info):
         """ Get local filename path from path_info. """
         path_info = utils.decode_path_info(path_info)
         path_info = posixpath.normpath(urlunquote(path_info))
         path = os.path.normpath(self.root + path_info)
-        if (self.default_extension and
-                not os.path.exists(path) and
-                os.path.splitext(path)[1] == '' and
-                os.path.isfile(path + self.default_extension)):
-            path += self.default_extension
+        if self.default_extension and os.path.splitext(path)[1] == '':
+            try:
+                self.stat(path)
+            except OSError:
+                try:
+                    if stat.S_ISREG(self.stat(path + self.default_extension).st_mode):
+                        path += self.default_extension
+                except OSError:
+                    pass
         return path
 
+    def get_ranges(self, resource, environ):
+        """
+        Return the list of (start, stop) byte ranges requested by the client.
+
+        None is returned when the entire file should be sent, either because no
+        valid Range header was received or an If-Range precondition failed. An
+        empty list means that none of the requested ranges can be satisfied.
+
+        """
+        range_header = environ.get('HTTP_RANGE')
+        if range_header is None:
+            return None
+
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range is not None:
+            if_range = if_range.strip()
+            if if_range.startswith(('"', 'W/')):
+                # Only a strong comparison is allowed here
+                if if_range.startswith('W/') or if_range != resource.etag:
+                    return None
+            else:
+                date = rfc822.parsedate_tz(if_range)
+                if date is None or rfc822.mktime_tz(date) != int(resource.stat.st_mtime):
+                    return None
+
+        return utils.parse_range(range_header, resource.stat.st_size)
+
     def get_status(self, code):
-        return '%d %s' % (code, utils.http_status[code])
+        return utils.status_lines[code]
 
-    def get_body(self, path, environ):
+    def get_body(self, path, environ, offset=0, length=None):
         if environ['REQUEST_METHOD'] == 'HEAD':
             return [b'']
+        elif self._tree is not None and path in self._tree.data:
+            data = self._tree.data[path]
+            return [data if length is None else data[offset:offset + length]]
         else:
             file_wrapper = environ.get('wsgi.file_wrapper', wsgiref.util.FileWrapper)
-            return file_wrapper(open(path, 'rb'))
+            f = self.open_file(path)
+            inflated = isinstance(f, utils.InflatedFile)
+            if length is not None:
+                f = utils.FileRange(f, offset, length)
+            if inflated:
+                # There is no file for a server to send directly
+                return utils.iter_file(f)
+            return file_wrapper(f)
+
+    def get_multipart_body(self, resource, ranges, environ):
+        """
+        Return a `multipart/byteranges` body, its length and content type.
+
+        Each part is read directly from the file as the body is iterated.
+
+        """
+        boundary = uuid.uuid4().hex
+        part_type = dict(resource.headers)['Content-type']
+        size = resource.stat.st_size
+        parts = []
+        length = 0
+        for start, stop in ranges:
+            header = '\r\n--{}\r\nContent-type: {}\r\nContent-Range: bytes {}-{}/{}\r\n\r\n'.format(
+                boundary, part_type, start, stop - 1, size
+            ).encode('latin-1')
+            parts.append((header, start, stop))
+            length += len(header) + stop - start
+        trailer = '\r\n--{}--\r\n'.format(boundary).encode('latin-1')
+        length += len(trailer)
+        content_type = 'multipart/byteranges; boundary=' + boundary
+
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return [b''], length, content_type
+
+        if self._tree is not None and resource.path in self._tree.data:
+            data = self._tree.data[resource.path]
+            body = []
+            for header, start, stop in parts:
+                body.extend([header, data[start:stop]])
+            body.append(trailer)
+            return body, length, content_type
+
+        f = self.open_file(resource.path)
+
+        def body():
+            with f:
+                for header, start, stop in parts:
+                    yield header
+                    part = utils.FileRange(f, start, stop - start)
+                    for chunk in iter(lambda: part.read(65536), b''):
+                        yield chunk
+                yield trailer
+
+        return body(), length, content_type
+
+    def get_content_type(self, path):
+        """ Return the value of the Content-type header of a file, from a table prepared at startup. """
+        if self._tree is not None and path in self._tree.types:
+            return f'{self._tree.types[path]}; charset={self.encoding}'
+        return self._content_types.get(os.path.splitext(path)[1].lower(), self._default_content_type)
 
     def guess_type(self, path):
+        if self._tree is not None and path in self._tree.types:
+            return self._tree.types[path]
         extension = os.path.splitext(path)[1].lower()
         return utils.types_map.get(extension, self.default_type)
 
@@ -138,21 +1100,66 @@ class Rheostatic:
 
         """
         headers = headers or []
+        if self._error_pages is not None:
+            page = self.get_error_page(code)
+            if page is None:
+                return self.simple_error(code, environ, start_response, headers)
+            page_headers, content = page
+            headers.extend(page_headers)
+            start_response(self.get_status(code), headers)
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                return [b'']
+            return [content]
         path = os.path.join(self.root, f'{code}.html')
-        if os.path.isfile(path):
-            try:
-                file_stat = os.stat(path)
-                headers.extend([
-                    ('Content-Length', str(file_stat.st_size)),
-                    ('Content-type', '{}; charset={}'.format(self.guess_type(path),
-                                                             self.encoding))
-                ])
-                start_response(self.get_status(code), headers)
-                return self.get_body(path, environ)
-            except OSError:                  # pragma: no cover
+        try:
+            file_stat = self.stat(path)
+            if not stat.S_ISREG(file_stat.st_mode):
                 return self.simple_error(code, environ, start_response, headers)
-        else:
+            body = self.get_body(path, environ)
+        except OSError:
             return self.simple_error(code, environ, start_response, headers)
+        headers.extend([
+            ('Content-Length', str(file_stat.st_size)),
+            ('Content-type', self.get_content_type(path))
+        ])
+        start_response(self.get_status(code), headers)
+        return body
+
+    def get_error_page(self, code):
+        """
+        Return the headers and content of the error page for code, or None if there is none.
+
+        Pages (and their absence) are held in memory for up to `negative_cache_ttl`
+        seconds. Unless `negative_cache_validate` is unset, a single `os.stat`
+        confirms that a page is unchanged. With `routes` but no negative cache,
+        pages are held until the root is scanned again and `cache_validate`
+        applies instead.
+
+        """
+        path = os.path.join(self.root, f'{code}.html')
+        cached = self._error_pages.get(code)
+        if cached is not None and (not self._error_pages_validate or cached[0] == self.get_page_key(path)):
+            return cached[1]
+        key = self.get_page_key(path)
+        page = None
+        if key is not None:
+            try:
+                content = self.read_file(path)
+            except OSError:                             # pragma: no cover
+                return None
+            page = ([('Content-Length', str(len(content))), ('Content-type', self.get_content_type(path))], content)
+        self._error_pages.set(code, (key, page))
+        return page
+
+    def get_page_key(self, path):
+        # The modification time and size of a regular file or None
+        try:
+            file_stat = self.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        return file_stat.st_mtime_ns, file_stat.st_size
 
     def simple_error(self, code, environ, start_response, headers=None):
         """ Send a plain text error. """
@@ -163,43 +1170,156 @@ class Rheostatic:
             ('Content-type', f'text/plain; charset={self.encoding}')
         ])
         start_response(status, headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return [b'']
         return [status.encode(self.encoding)]
 
     def list_directory(self, path, environ, start_response):
-        """ Return a directory listing. """
+        """
+        Return a directory listing.
+
+        The query string may select a JSON listing (`format=json`) and a page of
+        entries (`offset` and `limit`). HTML listings carry a weak ETag derived
+        from the modification time of the directory. As a JSON listing includes
+        the size and modification time of each entry, which may change without
+        the directory changing, its weak ETag is a hash of its content.
+
+        Rendered HTML listings are cached until the modification time of the
+        directory changes. With `listing_stream` set, an HTML listing is instead
+        sent as it is rendered, without a Content-Length.
+
+        """
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        listing_format = query.get('format', ['html'])[-1]
         try:
-            names = os.listdir(path)
-        except os.error:                                # pragma: no cover
+            offset = int(query.get('offset', ['0'])[-1])
+            limit = int(query['limit'][-1]) if 'limit' in query else None
+        except ValueError:
+            offset = -1
+        if listing_format not in ('html', 'json') or offset < 0 or (limit is not None and limit < 0):
+            return self.error(400, environ, start_response)
+
+        try:
+            dir_stat = self.stat(path)
+            displaypath = html_escape(urlunquote(wsgiref.util.request_uri(environ)))
+            etag = 'W/"{:x}-{:x}"'.format(dir_stat.st_mtime_ns, zlib.crc32(displaypath.encode('utf-8')))
+            content = None
+            if listing_format == 'json':
+                entries = self.get_listing_entries(path)
+                total = len(entries)
+                entries = entries[offset:None if limit is None else offset + limit]
+                content = self.render_listing_json(path, entries, environ, offset, limit, total)
+                etag = 'W/"{}"'.format(hashlib.blake2b(content, digest_size=16).hexdigest())
+            resource = Resource('directory', path, dir_stat, None, etag, ())
+            headers = [('ETag', etag)]
+            if self.is_not_modified(resource, environ):
+                start_response(self.get_status(304), headers)
+                return []
+            key = (path, dir_stat.st_mtime_ns, displaypath)
+            if content is None:
+                content = self._listing_cache.get(key)
+            if content is None:
+                entries = self.get_listing_entries(path)
+                entries = entries[offset:None if limit is None else offset + limit]
+        except OSError:                                 # pragma: no cover
             return self.error(404, environ, start_response)
-        names.sort(key=lambda a: a.lower())
 
-        items = []
-        for name in names:
-            fullname = os.path.join(path, name)
-            displayname = linkname = name
-            # Append / for directories or @ for symbolic links
-            if os.path.isdir(fullname):
-                displayname = name + "/"
-                linkname = name + "/"
-            if os.path.islink(fullname):
-                displayname = name + "@"
-                # Note: a link to a directory displays with @ and links with /
-            items.append('<li><a href="{}">{}</a></li>'.format(
-                urlquote(linkname), html_escape(displayname)
-            ))
-
-        f = io.BytesIO()
-        f.write(self.directory_template.format(
-            displaypath=html_escape(urlunquote(wsgiref.util.request_uri(environ))),
-            items=os.linesep.join(items)
-        ).encode(self.encoding))
-        length = f.tell()
-        f.seek(0)
+        if listing_format == 'json':
+            headers.append(('Content-type', 'application/json'))
+        else:
+            headers.append(('Content-type', f'text/html; charset={self.encoding}'))
 
-        headers = [
-            ('Content-Length', str(length)),
-            ('Content-type', f'text/html; charset={self.encoding}')
-        ]
+        if content is None and self.listing_stream:
+            start_response(self.get_status(200), headers)
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                return [b'']
+            return self.render_listing(entries, displaypath)
+
+        if content is None:
+            content = b''.join(self.render_listing(entries, displaypath))
+            self._listing_cache.set(key, content)
+
+        headers.append(('Content-Length', str(len(content))))
         start_response(self.get_status(200), headers)
-        file_wrapper = environ.get('wsgi.file_wrapper', wsgiref.util.FileWrapper)
-        return file_wrapper(f)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return [b'']
+        return [content]
+
+    def get_listing_entries(self, path):
+        """
+        Return a sorted list of (name, is_dir, is_link) for the entries in a directory.
+
+        The type of each entry is usually known from the directory itself, so
+        no further system calls are needed.
+
+        """
+        if self._tree is not None and path in self._tree.children:
+            entries = list(self._tree.children[path])
+        else:
+            with os.scandir(path) as it:
+                entries = [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in it]
+        # Break ties between names which differ only in case for a stable order
+        entries.sort(key=lambda entry: (entry[0].lower(), entry[0]))
+        return entries
+
+    def render_listing_json(self, path, entries, environ, offset, limit, total):
+        """
+        Render a JSON listing of the entries.
+
+        The size and modification time of each entry (following symbolic links)
+        are included, which requires a stat call per entry. Both are `null` for
+        a broken link.
+
+        """
+        items = []
+        for name, is_dir, is_link in entries:
+            try:
+                entry_stat = self.stat(os.path.join(path, name))
+                size, mtime = entry_stat.st_size, entry_stat.st_mtime
+            except OSError:
+                size = mtime = None
+            items.append({
+                'name': name,
+                'type': 'directory' if is_dir else 'file',
+                'link': is_link,
+                'size': size,
+                'mtime': mtime
+            })
+        return json.dumps({
+            'path': utils.decode_path_info(environ.get('PATH_INFO', '')),
+            'offset': offset,
+            'limit': limit,
+            'total': total,
+            'entries': items
+        }).encode('utf-8')
+
+    def render_listing(self, entries, displaypath, batch_size=500):
+        """ Render the `directory_template` for the entries, yielding encoded chunks. """
+        template = self.directory_template
+        if template.count('{items}') != 1:
+            yield template.format(
+                displaypath=displaypath,
+                items=os.linesep.join(self.render_listing_item(*entry) for entry in entries)
+            ).encode(self.encoding)
+            return
+
+        head, _, tail = template.partition('{items}')
+        yield head.format(displaypath=displaypath).encode(self.encoding)
+        for start in range(0, len(entries), batch_size):
+            items = os.linesep.join(self.render_listing_item(*entry)
+                                    for entry in entries[start:start + batch_size])
+            if start:
+                items = os.linesep + items
+            yield items.encode(self.encoding)
+        yield tail.format(displaypath=displaypath).encode(self.encoding)
+
+    def render_listing_item(self, name, is_dir, is_link):
+        displayname = linkname = name
+        # Append / for directories or @ for symbolic links
+        if is_dir:
+            displayname = name + "/"
+            linkname = name + "/"
+        if is_link:
+            displayname = name + "@"
+            # Note: a link to a directory displays with @ and links with /
+        return '<li><a href="{}">{}</a></li>'.format(urlquote(linkname), html_escape(displayname))
@@ -0,0 +1,141 @@
+"""
+Rheostatic - A Static File Server with options.
+
+MIT License
+
+Copyright (c) 2016 Waylan Limberg
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import bisect
+import threading
+
+from . import utils
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The upper bounds (in seconds) of the buckets of the latency histogram
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Shard:
+    # The counters updated by a single thread
+    def __init__(self):
+        self.started = 0
+        self.finished = 0
+        self.statuses = {}
+        self.bytes_sent = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.duration = 0.0
+
+
+class Metrics:
+    """
+    Request metrics in the Prometheus text format.
+
+    Each thread updates its own counters, so recording a request takes no lock.
+    The counters of all threads are summed when the metrics are rendered.
+
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def start(self):
+        """ Record the start of a request. """
+        self._shard().started += 1
+
+    def finish(self, timings):
+        """ Record a request once its response has been sent, given its `utils.Timings`. """
+        shard = self._shard()
+        shard.finished += 1
+        shard.statuses[timings.status] = shard.statuses.get(timings.status, 0) + 1
+        shard.bytes_sent += timings.bytes_sent
+        shard.buckets[bisect.bisect_left(BUCKETS, timings.duration)] += 1
+        shard.duration += timings.duration
+
+    def render(self, caches=None):
+        """ Return the metrics, and the statistics of a dict of named `utils.LRUCache`s, as text. """
+        with self._lock:
+            shards = list(self._shards)
+        statuses = dict.fromkeys(utils.http_status, 0)
+        buckets = [0] * (len(BUCKETS) + 1)
+        started = finished = bytes_sent = 0
+        duration = 0.0
+        for shard in shards:
+            started += shard.started
+            finished += shard.finished
+            bytes_sent += shard.bytes_sent
+            duration += shard.duration
+            for status, count in list(shard.statuses.items()):
+                statuses[status] = statuses.get(status, 0) + count
+            for i, count in enumerate(shard.buckets):
+                buckets[i] += count
+
+        lines = [
+            '# HELP rheostatic_requests_total Requests served by HTTP status code.',
+            '# TYPE rheostatic_requests_total counter'
+        ]
+        lines.extend(f'rheostatic_requests_total{{code="{status}"}} {count}'
+                     for status, count in sorted(statuses.items()))
+        lines.extend([
+            '# HELP rheostatic_response_bytes_total Bytes of response bodies sent.',
+            '# TYPE rheostatic_response_bytes_total counter',
+            f'rheostatic_response_bytes_total {bytes_sent}',
+            '# HELP rheostatic_request_duration_seconds Time from receiving a request to sending the last byte.',
+            '# TYPE rheostatic_request_duration_seconds histogram'
+        ])
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), buckets):
+            cumulative += count
+            lines.append(f'rheostatic_request_duration_seconds_bucket{{le="{bound}"}} {cumulative}')
+        lines.extend([
+            f'rheostatic_request_duration_seconds_sum {duration:.6f}',
+            f'rheostatic_request_duration_seconds_count {cumulative}',
+            '# HELP rheostatic_requests_in_flight Requests being served.',
+            '# TYPE rheostatic_requests_in_flight gauge',
+            f'rheostatic_requests_in_flight {max(started - finished, 0)}'
+        ])
+        if caches:
+            for name, help_text, kind, value in (
+                ('hits_total', 'Cache lookups which found an entry.', 'counter', lambda c: c.hits),
+                ('misses_total', 'Cache lookups which found no entry.', 'counter', lambda c: c.misses),
+                ('hit_ratio', 'The share of cache lookups which found an entry.', 'gauge',
+                 lambda c: round(c.hits / (c.hits + c.misses), 6) if c.hits + c.misses else 0.0),
+                ('entries', 'Entries in the cache.', 'gauge', len),
+                ('size', 'The size of the cache, in entries or bytes as it is bounded.', 'gauge',
+                 lambda c: c.currsize)
+            ):
+                lines.extend([f'# HELP rheostatic_cache_{name} {help_text}', f'# TYPE rheostatic_cache_{name} {kind}'])
+                lines.extend(f'rheostatic_cache_{name}{{cache="{cache}"}} {value(caches[cache])}'
+                             for cache in caches)
+        return '\n'.join(lines) + '\n'
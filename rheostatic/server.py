@@ -24,23 +24,496 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import os
+import socket
+import signal
+import threading
+import functools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from wsgiref.validate import validator
-from wsgiref.simple_server import make_server
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler, ServerHandler
 
 from .base import Rheostatic
+from . import utils
 
 
-def serve(address, root, **kwargs):                     # pragma: no cover
-    """ Serve static files from root directory. """
+class SendfileServerHandler(ServerHandler):
+    """
+    A wsgiref server handler which sends file bodies without copying them.
+
+    Files are copied straight to the socket with `os.sendfile`. Where that is
+    not available, slices of the memory mapped file are written instead.
+
+    Responses are HTTP/1.1 and the connection is marked to be closed unless the
+    length of the response is known.
+
+    """
+
+    wsgi_file_wrapper = utils.FileWrapper
+    http_version = '1.1'
+
+    def sendfile(self):
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        if hasattr(os, 'sendfile'):
+            self.bytes_sent += self.result.sendfile(self.request_handler.connection)
+        else:                                           # pragma: no cover
+            for chunk in self.result.iter_mmap():
+                self._write(chunk)
+                self.bytes_sent += len(chunk)
+            self._flush()
+        return True
+
+    def write(self, data):
+        if self.environ['REQUEST_METHOD'] == 'HEAD':
+            # Never send a body in response to HEAD
+            data = b''
+        super().write(data)
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        request_handler = self.request_handler
+        if ('Content-Length' not in self.headers and
+                self.environ['REQUEST_METHOD'] != 'HEAD' and
+                not self.status.startswith(('204', '304'))):
+            request_handler.close_connection = True
+        if getattr(request_handler.server, 'draining', False):
+            request_handler.close_connection = True
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+        elif request_handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+
+class RequestHandler(WSGIRequestHandler):
+    """
+    A wsgiref request handler which supports persistent connections.
+
+    Requests are read from a connection until the client closes it, it has
+    been idle for `server.keepalive_timeout` seconds or `server.max_requests`
+    requests have been served.
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+    server_handler_class = SendfileServerHandler
+
+    def setup(self):
+        super().setup()
+        # The headers and body of a response are written separately, which Nagle's
+        # algorithm would delay on a persistent connection until the client ACKs
+        if self.connection.family in (socket.AF_INET, socket.AF_INET6):
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        """ Handle requests until the connection is to be closed. """
+        self.requests = 0
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        """ Handle a single HTTP request. """
+        keepalive_timeout = getattr(self.server, 'keepalive_timeout', 0)
+        max_requests = getattr(self.server, 'max_requests', 0)
+
+        set_idle = getattr(self.server, 'set_idle', None)
+        if self.requests:
+            if set_idle is not None and not set_idle(self.connection, True):
+                # The server is draining
+                self.close_connection = True
+                return
+            # Wait no longer than the keep-alive timeout for the next request
+            self.connection.settimeout(keepalive_timeout)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+        finally:
+            self.connection.settimeout(self.timeout)
+            if self.requests and set_idle is not None:
+                set_idle(self.connection, False)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request():                    # An error code has been sent, just exit
+            return
+
+        self.requests += 1
+        if (not keepalive_timeout or
+                (max_requests and self.requests >= max_requests) or
+                # The request body is never read, so it would be mistaken for the next request
+                self.headers.get('Content-Length', '0') != '0' or
+                'Transfer-Encoding' in self.headers):
+            self.close_connection = True
+
+        handler = self.server_handler_class(
+            self.rfile, self.wfile, self.get_stderr(), self.get_environ(),
+            multithread=getattr(self.server, 'multithread', False),
+            multiprocess=getattr(self.server, 'multiprocess', False)
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        self.wfile.flush()
+
+
+class QuietRequestHandler(RequestHandler):
+    """ A request handler which only logs errors, not every request. """
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+class ManagedWSGIServer(WSGIServer):
+    """
+    A WSGI server which tracks its open connections, so that it may limit and drain them.
+
+    If `connection_limits` (a `utils.ConnectionLimits`) is set, a connection
+    over a limit is sent a 503 (Service Unavailable) response with a
+    Retry-After header of `retry_after` seconds and closed at once, rather than
+    waiting for others to finish.
+
+    The `multithread` and `multiprocess` flags are passed to the application
+    in the environ as `wsgi.multithread` and `wsgi.multiprocess`.
+
+    """
+
+    connection_limits = None
+    retry_after = 5
+    draining = False
+    multithread = False
+    multiprocess = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._connections = {}
+        self._idle = set()
+        self._condition = threading.Condition()
+
+    def verify_request(self, request, client_address):
+        address = client_address[0] if isinstance(client_address, tuple) else ''
+        if self.connection_limits is not None and not self.connection_limits.acquire(address):
+            self.reject_request(request)
+            return False
+        with self._condition:
+            self._connections[request] = address
+        return True
+
+    def reject_request(self, request):
+        """ Send a 503 (Service Unavailable) response without waiting for a slow client. """
+        try:
+            request.setblocking(False)
+            request.send(utils.service_unavailable(self.retry_after))
+            request.shutdown(socket.SHUT_WR)
+            # Discard the request, which if unread would reset the connection
+            request.recv(65536)
+        except OSError:
+            pass
+
+    def shutdown_request(self, request):
+        with self._condition:
+            address = self._connections.pop(request, None)
+            self._idle.discard(request)
+            self._condition.notify_all()
+        if address is not None and self.connection_limits is not None:
+            self.connection_limits.release(address)
+        super().shutdown_request(request)
+
+    def set_idle(self, request, idle):
+        """
+        Mark a connection as waiting for its next request, or as no longer waiting.
+
+        Return False, rather than mark a connection idle, if the server is draining.
+
+        """
+        with self._condition:
+            if not idle:
+                self._idle.discard(request)
+            elif self.draining:
+                return False
+            else:
+                self._idle.add(request)
+        return True
+
+    def drain(self, timeout):
+        """
+        Stop accepting connections and wait up to timeout seconds for those open to close.
+
+        Idle persistent connections are closed at once and others once their
+        current response is sent. Any still open at the deadline are closed.
+        `serve_forever` must have returned first.
+
+        """
+        with self._condition:
+            self.draining = True
+            self.socket.close()
+            for request in self._idle:
+                try:
+                    request.shutdown(socket.SHUT_RD)
+                except OSError:                         # pragma: no cover
+                    pass
+            self._condition.wait_for(lambda: not self._connections, timeout)
+            remaining = list(self._connections)
+        for request in remaining:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:                             # pragma: no cover
+                pass
+
+
+class ThreadPoolWSGIServer(ManagedWSGIServer):
+    """
+    A WSGI server which handles each request in a thread from a fixed size pool.
+
+    While every thread is busy, no further connections are accepted, so excess
+    clients wait in the listen backlog rather than in an unbounded queue.
+
+    """
+
+    daemon_threads = True
+    multithread = True
+
+    def __init__(self, *args, threads=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        self._executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=False)
+
+
+def prefork(server, workers, target=None, restart_command=None):  # pragma: no cover
+    """
+    Run `target` (by default `server.serve_forever`) in the given number of forked worker processes.
+
+    The workers inherit and share the listening socket of the server, and the
+    kernel distributes incoming connections among them. A SIGTERM or SIGHUP
+    is passed on to the workers. A SIGUSR2 starts a new server, as for
+    `serve_until_stopped`, and stops the workers.
+
+    """
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                (target or server.serve_forever)()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def forward(signum, frame=None):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def restart(signum, frame):
+        spawn_successor([server.socket.fileno()], restart_command)
+        forward(signal.SIGTERM)
+
+    handle_signal('SIGTERM', forward)
+    handle_signal('SIGHUP', forward)
+    if restart_command:
+        handle_signal('SIGUSR2', restart)
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        raise
+
+
+def handle_signal(name, handler):                       # pragma: no cover
+    """ Set the handler of the named signal, where the platform supports it. """
+    signum = getattr(signal, name, None)
+    if signum is not None:
+        signal.signal(signum, handler)
+
+
+def get_inherited_sockets():
+    """
+    Return the listening sockets inherited from the process which started this one.
+
+    The sockets are passed as file descriptors, either as a comma separated
+    list in the `RHEOSTATIC_FD` environment variable by a server which is
+    being replaced (see `spawn_successor`) or by systemd socket activation
+    (`LISTEN_FDS`). The list is empty if no socket was passed.
+
+    """
+    fds = os.environ.pop('RHEOSTATIC_FD', None)
+    if fds is not None:
+        return [socket.socket(fileno=int(fd)) for fd in fds.split(',')]
+    if os.environ.get('LISTEN_PID') == str(os.getpid()):
+        os.environ.pop('LISTEN_PID')
+        start = 3                                       # SD_LISTEN_FDS_START
+        return [socket.socket(fileno=fd) for fd in range(start, start + int(os.environ.pop('LISTEN_FDS', 0)))]
+    return []
+
+
+def spawn_successor(fds, command):                      # pragma: no cover
+    """ Start a new server with command, which inherits the listening socket fds, and return its process. """
+    env = dict(os.environ, RHEOSTATIC_FD=','.join(str(fd) for fd in fds))
+    return subprocess.Popen(command, env=env, pass_fds=fds)
+
+
+def serve_until_stopped(server, app, drain_timeout=30, restart_command=None):  # pragma: no cover
+    """
+    Run `server.serve_forever` until a SIGTERM, then drain the server.
+
+    Connections in progress are given up to `drain_timeout` seconds to finish.
+    A SIGHUP reloads app (in the background) to pick up changed files and flush
+    its caches. If `restart_command` is given, a SIGUSR2 starts it as a new
+    server, which takes over the listening socket, and then drains this one.
+
+    """
+    stopping = []
+
+    def stop(signum=None, frame=None):
+        if not stopping:
+            stopping.append(signum)
+            # shutdown waits for serve_forever, which this thread is running
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    def reload(signum, frame):
+        threading.Thread(target=app.reload, daemon=True).start()
+
+    def restart(signum, frame):
+        if not stopping:
+            spawn_successor([server.socket.fileno()], restart_command)
+            stop()
+
+    handle_signal('SIGTERM', stop)
+    handle_signal('SIGHUP', reload)
+    handle_signal('SIGUSR2', restart if restart_command else signal.SIG_IGN)
+    server.serve_forever()
+    if stopping:
+        server.drain(drain_timeout)
+
+
+def make_wsgi_server(address, app, threads=1, validate=False, quiet=False,
+                     keepalive_timeout=None, max_requests=100,
+                     max_connections=None, max_connections_per_ip=None, retry_after=5, sock=None):
+    """
+    Return a WSGI server for app bound to address, or listening on `sock` if given.
+
+    The wsgiref validator, which checks every request and response for
+    compliance with the WSGI specification at some cost, is only used when
+    `validate` is set. Access logging is disabled when `quiet` is set.
+
+    Connections are kept alive for up to `keepalive_timeout` seconds between
+    requests and for at most `max_requests` requests. As an idle connection
+    occupies a thread, the timeout defaults to 5 seconds when there are
+    multiple threads and otherwise to 0, which disables persistent connections.
+
+    No more than `max_connections` connections in total, and no more than
+    `max_connections_per_ip` from each client address, are served at once
+    (by each worker process). Others are sent a 503 (Service Unavailable)
+    response which asks them to retry after `retry_after` seconds.
+
+    """
+    server_class = ManagedWSGIServer
+    if threads > 1:
+        server_class = functools.partial(ThreadPoolWSGIServer, threads=threads)
+    handler_class = QuietRequestHandler if quiet else RequestHandler
+    if validate:
+        app = validator(app)
+    if sock is None:
+        server = make_server(address[0], address[1], app, server_class=server_class, handler_class=handler_class)
+    else:
+        server = server_class(address, handler_class, bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()
+        server.server_name = socket.getfqdn(server.server_address[0])
+        server.server_port = server.server_address[1]
+        server.setup_environ()
+        server.set_app(app)
+    if keepalive_timeout is None:
+        keepalive_timeout = 5 if threads > 1 else 0
+    server.keepalive_timeout = keepalive_timeout
+    server.max_requests = max_requests
+    if max_connections or max_connections_per_ip:
+        server.connection_limits = utils.ConnectionLimits(max_connections, max_connections_per_ip)
+    server.retry_after = retry_after
+    return server
+
+
+def serve(address, root, workers=1, threads=1, validate=False, quiet=False,  # pragma: no cover
+          keepalive_timeout=None, max_requests=100, max_connections=None, max_connections_per_ip=None,
+          retry_after=5, drain_timeout=30, restart_command=None, **kwargs):
+    """
+    Serve static files from root directory.
+
+    The server stops gracefully on SIGTERM, reloads on SIGHUP and, given a
+    `restart_command`, hands its listening socket over to a new server on
+    SIGUSR2 (see `serve_until_stopped`). A listening socket inherited from a
+    previous server or systemd is used in place of binding to address (the
+    first, if several are passed).
+
+    """
 
     app = Rheostatic(root, **kwargs)
 
-    server = make_server(address[0], address[1], validator(app))
+    if workers > 1 and not hasattr(os, 'fork'):
+        raise ValueError('Multiple workers are not supported on this platform.')
+
+    sockets = get_inherited_sockets()
+    for sock in sockets[1:]:
+        sock.close()
+    server = make_wsgi_server(address, app, threads=threads, validate=validate, quiet=quiet,
+                              keepalive_timeout=keepalive_timeout, max_requests=max_requests,
+                              max_connections=max_connections, max_connections_per_ip=max_connections_per_ip,
+                              retry_after=retry_after, sock=sockets[0] if sockets else None)
+    server.multiprocess = workers > 1
 
     try:
-        print('Starting server at http://%s:%d/...' % address)
+        print('Starting server at http://%s:%d/...' % server.server_address[:2])
         print('Serving files from %s' % app.root)
+        if workers > 1 or threads > 1:
+            print('Using %d worker process(es) with %d thread(s) each' % (workers, threads))
+        if validate:
+            print('Validating requests and responses with wsgiref.validate')
         print('Press ctrl+c to stop.')
-        server.serve_forever()
+        if workers > 1:
+            prefork(server, workers, functools.partial(serve_until_stopped, server, app, drain_timeout),
+                    restart_command)
+        else:
+            serve_until_stopped(server, app, drain_timeout, restart_command)
     except KeyboardInterrupt:
         print('Quiting...')
+    finally:
+        server.server_close()
@@ -0,0 +1,333 @@
+"""
+Rheostatic - A Static File Server with options.
+
+MIT License
+
+Copyright (c) 2016 Waylan Limberg
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import io
+import os
+import sys
+import time
+import gzip
+import socket
+import asyncio
+import threading
+import concurrent.futures
+from unittest import TestCase, mock, skipUnless
+import http.client as http_lib
+
+from rheostatic import utils
+from rheostatic.base import Rheostatic
+from rheostatic.aioserver import AsyncServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def get_file_content(path):
+    with open(os.path.join(ROOT, path), 'rb') as f:
+        return f.read()
+
+
+@skipUnless(sys.version_info >= (3, 7), 'the asyncio engine requires Python 3.7')
+class TestAsyncServer(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        app = Rheostatic(ROOT, compress=['gzip'], compress_min_size=0, compress_stream_size=10)
+        cls.loop = asyncio.new_event_loop()
+        cls.server = AsyncServer(app, ('127.0.0.1', 0), quiet=True, max_requests=4)
+        cls.loop.run_until_complete(cls.server.start())
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        asyncio.run_coroutine_threadsafe(cls.server.drain(5), cls.loop).result(10)
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.loop.close()
+
+    def setUp(self):
+        self.client = http_lib.HTTPConnection(*self.server.address)
+        self.addCleanup(self.client.close)
+
+    def request(self, method, url, headers=None):
+        self.client.request(method, url, headers=headers or {})
+        response = self.client.getresponse()
+        return response, response.read()
+
+    def test_get(self):
+        response, content = self.request('GET', '/other.html')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-type'), 'text/html; charset=utf-8')
+        self.assertEqual(response.getheader('Connection'), 'keep-alive')
+        self.assertEqual(content, get_file_content('other.html'))
+
+    def test_keep_alive(self):
+        self.request('GET', '/other.html')
+        sock = self.client.sock
+        response, content = self.request('HEAD', '/subdir')
+        self.assertEqual(response.status, 301)
+        self.assertEqual(content, b'')
+        response, content = self.request('GET', '/nonexistant.html')
+        self.assertEqual(response.status, 404)
+        self.assertEqual(content, get_file_content('404.html'))
+        self.assertIs(self.client.sock, sock)
+        # The connection is closed after max_requests
+        response, content = self.request('GET', '/other.html')
+        self.assertEqual(response.getheader('Connection'), 'close')
+
+    def test_connection_close(self):
+        response, content = self.request('GET', '/other.html', {'Connection': 'close'})
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertEqual(content, get_file_content('other.html'))
+
+    def test_range(self):
+        response, content = self.request('GET', '/other.html', {'Range': 'bytes=10-19'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(content, get_file_content('other.html')[10:20])
+
+    def test_chunked(self):
+        response, content = self.request('GET', '/other.html', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEqual(gzip.decompress(content), get_file_content('other.html'))
+
+    def test_bad_request(self):
+        with socket.create_connection(self.server.address) as sock:
+            sock.sendall(b'NONSENSE\r\n\r\n')
+            self.assertTrue(sock.recv(1024).startswith(b'HTTP/1.1 400 Bad Request\r\n'))
+
+
+@skipUnless(sys.version_info >= (3, 7), 'the asyncio engine requires Python 3.7')
+class TestLimitedAsyncServer(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.server = AsyncServer(Rheostatic(ROOT), ('127.0.0.1', 0), quiet=True,
+                                 connection_limits=utils.ConnectionLimits(1), retry_after=7)
+        cls.loop.run_until_complete(cls.server.start())
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        asyncio.run_coroutine_threadsafe(cls.server.drain(5), cls.loop).result(10)
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join()
+        cls.loop.close()
+
+    def wait_for_connections(self, count):
+        deadline = time.monotonic() + 5
+        while self.server.connection_limits.total != count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.connection_limits.total, count)
+
+    def test_connection_limit(self):
+        idle = socket.create_connection(self.server.address)
+        self.wait_for_connections(1)
+        client = http_lib.HTTPConnection(*self.server.address)
+        self.addCleanup(client.close)
+        client.request('GET', '/other.html')
+        response = client.getresponse()
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader('Retry-After'), '7')
+        self.assertEqual(response.read(), b'503 Service Unavailable')
+        idle.close()
+        self.wait_for_connections(0)
+        client.close()
+        client.request('GET', '/other.html')
+        self.assertEqual(client.getresponse().status, 200)
+
+
+@skipUnless(sys.version_info >= (3, 7), 'the asyncio engine requires Python 3.7')
+class TestThrottledAsyncServer(TestCase):
+    app_options = {}
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        # A small executor, which throttled clients would exhaust if they slept in it
+        self.loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(2))
+        app = Rheostatic(ROOT, bandwidth_limit=100, bandwidth_burst=200, **self.app_options)
+        self.server = AsyncServer(app, ('127.0.0.1', 0), quiet=True)
+        self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.loop.call_soon_threadsafe, self.loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(self.server.drain(0), self.loop).result(5))
+
+    def test_throttled(self):
+        # Each download after the first from 127.0.0.1 waits a second or more
+        for i in range(6):
+            throttled = socket.create_connection(self.server.address)
+            self.addCleanup(throttled.close)
+            throttled.sendall(b'GET /other.html HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        time.sleep(0.2)
+        # Another client is served at once
+        start = time.monotonic()
+        client = http_lib.HTTPConnection(*self.server.address, source_address=('127.0.0.2', 0))
+        self.addCleanup(client.close)
+        client.request('GET', '/other.html')
+        response = client.getresponse()
+        self.assertEqual(response.read(), get_file_content('other.html'))
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class TestThrottledMetricsAsyncServer(TestThrottledAsyncServer):
+    # The metrics wrap the throttled body
+    app_options = {'metrics': True}
+
+
+@skipUnless(sys.version_info >= (3, 7), 'the asyncio engine requires Python 3.7')
+class TestAsyncServerErrors(TestCase):
+
+    @staticmethod
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/raise':
+            raise RuntimeError('raised by the app')
+        start_response('200 OK', [('Content-type', 'text/plain')])
+
+        def body():
+            yield b'partial'
+            raise RuntimeError('raised by the body')
+        return body()
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = AsyncServer(self.app, ('127.0.0.1', 0), quiet=True)
+        self.errors = []
+        self.loop.set_exception_handler(lambda loop, context: self.errors.append(context))
+        self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.loop.call_soon_threadsafe, self.loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(self.server.drain(5), self.loop).result(10))
+        self.stderr = io.StringIO()
+        patcher = mock.patch('sys.stderr', self.stderr)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_app_error(self):
+        client = http_lib.HTTPConnection(*self.server.address)
+        self.addCleanup(client.close)
+        client.request('GET', '/raise')
+        response = client.getresponse()
+        self.assertEqual(response.status, 500)
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertEqual(response.read(), b'500 Internal Server Error')
+        self.assertIn('RuntimeError: raised by the app', self.stderr.getvalue())
+        self.assertEqual(self.errors, [])
+
+    def test_body_error(self):
+        with socket.create_connection(self.server.address) as sock:
+            sock.sendall(b'GET /body HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            sock.settimeout(5)
+            received = b''
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                received += data
+        # The response is cut short and the connection closed
+        self.assertTrue(received.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertNotIn(b'0\r\n\r\n', received)
+        self.assertIn('RuntimeError: raised by the body', self.stderr.getvalue())
+        self.assertEqual(self.errors, [])
+
+
+@skipUnless(sys.version_info >= (3, 7), 'the asyncio engine requires Python 3.7')
+class TestAsyncServerSockets(TestCase):
+
+    def test_sockets(self):
+        # Listening sockets, as inherited from a previous server
+        listeners = []
+        for host in ('127.0.0.1', '127.0.0.2'):
+            listener = socket.socket()
+            self.addCleanup(listener.close)
+            listener.bind((host, 0))
+            listener.listen()
+            listeners.append(listener)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        server = AsyncServer(Rheostatic(ROOT), ('localhost', 1), quiet=True)
+        loop.run_until_complete(server.start(listeners))
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+        self.addCleanup(lambda: asyncio.run_coroutine_threadsafe(server.drain(5), loop).result(10))
+        # All of them are listened on and would be passed to a successor
+        self.assertEqual([sock.fileno() for sock in server.sockets], [sock.fileno() for sock in listeners])
+        self.assertEqual(server.address, listeners[0].getsockname())
+        for listener in listeners:
+            client = http_lib.HTTPConnection(*listener.getsockname())
+            self.addCleanup(client.close)
+            client.request('GET', '/other.html')
+            self.assertEqual(client.getresponse().read(), get_file_content('other.html'))
+
+
+@skipUnless(sys.version_info >= (3, 7), 'the asyncio engine requires Python 3.7')
+class TestAsyncServerDrain(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.server = AsyncServer(Rheostatic(ROOT), ('127.0.0.1', 0), quiet=True)
+        self.errors = []
+        self.loop.set_exception_handler(lambda loop, context: self.errors.append(context))
+        self.loop.run_until_complete(self.server.start())
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.addCleanup(self.loop.close)
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.loop.call_soon_threadsafe, self.loop.stop)
+
+    def test_drain(self):
+        idle = http_lib.HTTPConnection(*self.server.address)
+        self.addCleanup(idle.close)
+        idle.request('GET', '/other.html')
+        idle.getresponse().read()
+        busy = socket.create_connection(self.server.address)
+        self.addCleanup(busy.close)
+        busy.sendall(b'GET /other.html HTTP/1.1\r\n')
+        deadline = time.monotonic() + 5
+        while len(self.server._tasks) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        drain = asyncio.run_coroutine_threadsafe(self.server.drain(5), self.loop)
+        # The idle connection is closed at once and the busy one after its response
+        idle.sock.settimeout(5)
+        self.assertEqual(idle.sock.recv(1024), b'')
+        self.assertFalse(drain.done())
+        busy.sendall(b'Host: localhost\r\n\r\n')
+        response = http_lib.HTTPResponse(busy)
+        response.begin()
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertEqual(response.read(), get_file_content('other.html'))
+        drain.result(5)
+        self.assertRaises(OSError, socket.create_connection, self.server.address, 1)
+        # Cancelling the idle connection is not reported as an error
+        self.assertEqual(self.errors, [])
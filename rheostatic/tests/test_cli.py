@@ -24,9 +24,10 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from unittest import TestCase
+import sys
+from unittest import TestCase, mock, skipUnless
 
-from rheostatic.__main__ import parse_args
+from rheostatic.__main__ import parse_args, parse_pack_args
 
 
 class TestCli(TestCase):
@@ -143,3 +144,333 @@ class TestCli(TestCase):
                 }
             )
         )
+
+    def test_cache_args(self):
+        self.assertEqual(
+            parse_args(['--cache-size', '100', '--cache-ttl', '2.5', '--cache-validate']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'cache_size': 100,
+                    'cache_ttl': 2.5,
+                    'cache_validate': True
+                }
+            )
+        )
+
+    def test_negative_cache_args(self):
+        self.assertEqual(
+            parse_args(['--negative-cache-size', '1000', '--negative-cache-ttl', '60',
+                        '--negative-cache-no-validate']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'negative_cache_size': 1000,
+                    'negative_cache_ttl': 60.0,
+                    'negative_cache_validate': False
+                }
+            )
+        )
+
+    def test_routes_args(self):
+        self.assertEqual(
+            parse_args(['--routes', '--rescan-interval', '300']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'routes': True,
+                    'rescan_interval': 300.0
+                }
+            )
+        )
+
+    def test_cache_control_args(self):
+        self.assertEqual(
+            parse_args(['--cache-control', '*.css=max-age=3600', '--cache-control', 'static/*=no-cache',
+                        '--expires', '--no-fingerprint']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'cache_control': [('*.css', 'max-age=3600'), ('static/*', 'no-cache')],
+                    'expires': True,
+                    'fingerprint_pattern': None
+                }
+            )
+        )
+
+    def test_fingerprint_args(self):
+        self.assertEqual(
+            parse_args(['--fingerprint-pattern', r'\.[0-9a-f]{8}\.', '--fingerprint-cache-control', 'max-age=600']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'fingerprint_pattern': r'\.[0-9a-f]{8}\.',
+                    'fingerprint_cache_control': 'max-age=600'
+                }
+            )
+        )
+
+    def test_invalid_cache_control_arg(self):
+        with mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, parse_args, ['--cache-control', '*.css'])
+
+    def test_etag_arg(self):
+        self.assertEqual(
+            parse_args(['--etag', 'hash']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'etag': 'hash'
+                }
+            )
+        )
+
+    def test_etag_none_arg(self):
+        self.assertEqual(parse_args(['--etag', 'none'])[2]['etag'], None)
+
+    def test_precompressed_arg(self):
+        self.assertEqual(
+            parse_args(['-z', 'br', '--precompressed', 'gzip']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'precompressed': ['br', 'gzip']
+                }
+            )
+        )
+
+    def test_compress_args(self):
+        self.assertEqual(
+            parse_args(['--compress', 'gzip', '--compress-min-size', '100', '--compress-cache-size', '1000']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'compress': ['gzip'],
+                    'compress_min_size': 100,
+                    'compress_cache_size': 1000
+                }
+            )
+        )
+
+    def test_concurrency_args(self):
+        self.assertEqual(
+            parse_args(['--workers', '4', '--threads', '16']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'workers': 4,
+                    'threads': 16
+                }
+            )
+        )
+
+    @skipUnless(sys.version_info >= (3, 7), 'the asyncio engine requires Python 3.7')
+    def test_engine_arg(self):
+        self.assertEqual(
+            parse_args(['--engine', 'asyncio']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'engine': 'asyncio'
+                }
+            )
+        )
+
+    def test_engine_arg_with_workers(self):
+        with mock.patch('sys.stderr'):
+            self.assertRaises(SystemExit, parse_args, ['--engine', 'asyncio', '--workers', '2'])
+
+    def test_engine_arg_unsupported_python(self):
+        with mock.patch('sys.stderr'), mock.patch('sys.version_info', (3, 6, 15)):
+            self.assertRaises(SystemExit, parse_args, ['--engine', 'asyncio'])
+
+    def test_validate_and_quiet_args(self):
+        self.assertEqual(
+            parse_args(['--validate', '--quiet']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'validate': True,
+                    'quiet': True
+                }
+            )
+        )
+
+    def test_keepalive_args(self):
+        self.assertEqual(
+            parse_args(['--keepalive-timeout', '2.5', '--max-requests', '10']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'keepalive_timeout': 2.5,
+                    'max_requests': 10
+                }
+            )
+        )
+
+    def test_connection_limit_args(self):
+        self.assertEqual(
+            parse_args(['--max-connections', '64', '--max-connections-per-ip', '4', '--retry-after', '10']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'max_connections': 64,
+                    'max_connections_per_ip': 4,
+                    'retry_after': 10
+                }
+            )
+        )
+
+    def test_bandwidth_args(self):
+        self.assertEqual(
+            parse_args(['--bandwidth-limit', '1048576', '--bandwidth-burst', '4194304']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'bandwidth_limit': 1048576,
+                    'bandwidth_burst': 4194304
+                }
+            )
+        )
+
+    def test_drain_timeout_arg(self):
+        self.assertEqual(
+            parse_args(['--drain-timeout', '60']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'drain_timeout': 60.0
+                }
+            )
+        )
+
+    def test_listing_args(self):
+        self.assertEqual(
+            parse_args(['--listing-cache-size', '0', '--listing-stream']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'listing_cache_size': 0,
+                    'listing_stream': True
+                }
+            )
+        )
+
+    def test_preload_args(self):
+        self.assertEqual(
+            parse_args(['--preload', '--preload-file-size', '1000', '--preload-max-size', '10000']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'preload': True,
+                    'preload_file_size': 1000,
+                    'preload_max_size': 10000
+                }
+            )
+        )
+
+    def test_pack_args(self):
+        self.assertEqual(parse_pack_args(['path/to/root', 'site.pack']), ('path/to/root', 'site.pack'))
+
+    @mock.patch('sys.stderr')
+    def test_pack_args_missing_output(self, mock_stderr):
+        self.assertRaises(SystemExit, parse_pack_args, ['path/to/root'])
+
+    def test_timing_args(self):
+        self.assertEqual(
+            parse_args(['--timing']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'timing': True
+                }
+            )
+        )
+
+    def test_metrics_args(self):
+        self.assertEqual(
+            parse_args(['--metrics', '--metrics-path', '/metrics']),
+            (
+                ('localhost', 8000),
+                '.',
+                {
+                    'index_file': 'index.html',
+                    'default_type': 'application/octet-stream',
+                    'encoding': 'utf-8',
+                    'metrics': True,
+                    'metrics_path': '/metrics'
+                }
+            )
+        )
@@ -25,12 +25,22 @@ SOFTWARE.
 """
 
 import os
-from unittest import TestCase
+import stat
+import gzip
+import json
+import time
+import shutil
+import tarfile
+import zipfile
+import tempfile
+from unittest import TestCase, mock
 from wsgi_intercept import (
     http_client_intercept, add_wsgi_intercept, remove_wsgi_intercept
 )
 import http.client as http_lib
 from rheostatic.base import Rheostatic
+from rheostatic.tree import Tree, write_pack
+from rheostatic import utils
 
 ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
@@ -41,18 +51,42 @@ def make_app(**kwargs):
     return wrapper
 
 
+def make_pack(testcase):
+    """ Pack ROOT into a temporary pack file for the test case and return its path. """
+    tmpdir = tempfile.mkdtemp()
+    testcase.addCleanup(shutil.rmtree, tmpdir)
+    path = os.path.join(tmpdir, 'site.pack')
+    write_pack(ROOT, path)
+    return path
+
+
+def make_zip(testcase):
+    """ Zip some files of ROOT (without an entry for subdir/) into a temporary archive and return its path. """
+    tmpdir = tempfile.mkdtemp()
+    testcase.addCleanup(shutil.rmtree, tmpdir)
+    path = os.path.join(tmpdir, 'site.zip')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.write(os.path.join(ROOT, 'index.html'), 'index.html', zipfile.ZIP_DEFLATED)
+        archive.write(os.path.join(ROOT, 'other.html'), 'other.html', zipfile.ZIP_STORED)
+        archive.write(os.path.join(ROOT, '404.html'), '404.html', zipfile.ZIP_DEFLATED)
+        archive.write(os.path.join(ROOT, 'subdir/subpage.html'), 'subdir/subpage.html', zipfile.ZIP_DEFLATED)
+        archive.writestr('../outside.html', b'outside')
+    return path
+
+
 def get_file_content(path):
     with open(os.path.join(ROOT, path), 'rb') as f:
         return f.read()
 
 
 class TestResponses(TestCase):
-    def assertResponse(self, app, method, url, status=None, headers=None, content=None):
+    def assertResponse(self, app, method, url, status=None, headers=None, content=None,
+                       request_headers=None):
         host, port = 'localhost', 80
         http_client_intercept.install()
         add_wsgi_intercept(host, port, app)
         client = http_lib.HTTPConnection(host, port)
-        client.request(method, url)
+        client.request(method, url, headers=request_headers or {})
         response = client.getresponse()
 
         if status is not None:
@@ -349,3 +383,1275 @@ class TestResponses(TestCase):
             headers={'Content-type': 'text/plain; charset=utf-8'},
             content=b''
         )
+
+    def test_get_cached(self):
+        app = Rheostatic(ROOT, cache_size=10)
+        for i in range(2):
+            self.assertResponse(
+                app=lambda: app,
+                method='GET',
+                url='/other.html',
+                status=200,
+                headers={'Content-type': 'text/html; charset=utf-8'},
+                content=get_file_content('other.html')
+            )
+        self.assertEqual(app._cache.hits, 1)
+
+    def test_get_cached_redirect(self):
+        app = Rheostatic(ROOT, cache_size=10)
+        for i in range(2):
+            self.assertResponse(
+                app=lambda: app,
+                method='GET',
+                url='/subdir',
+                status=301,
+                headers={'Location': 'http://localhost/subdir/'},
+                content=b'301 Moved Permanently'
+            )
+        self.assertEqual(app._cache.hits, 1)
+
+    def test_cache_size_limit(self):
+        app = Rheostatic(ROOT, cache_size=1)
+        app.resolve('/index.html')
+        app.resolve('/other.html')
+        self.assertEqual(len(app._cache), 1)
+        self.assertIsNone(app._cache.get('/index.html'))
+
+    def test_cache_validate(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'page.html')
+        with open(path, 'wb') as f:
+            f.write(b'old')
+        app = Rheostatic(root, cache_size=10, cache_validate=True)
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', content=b'old')
+        with open(path, 'wb') as f:
+            f.write(b'changed')
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/page.html',
+            status=200,
+            headers={'Content-Length': '7'},
+            content=b'changed'
+        )
+        os.remove(path)
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', status=404)
+
+    def test_negative_cache(self):
+        app = Rheostatic(ROOT, negative_cache_size=10)
+        for i in range(2):
+            self.assertResponse(
+                app=lambda: app,
+                method='GET',
+                url='/missing.html',
+                status=404,
+                headers={'Content-type': 'text/html; charset=utf-8'},
+                content=get_file_content('404.html')
+            )
+        self.assertEqual(app._negative_cache.hits, 1)
+        self.assertEqual(app._error_pages.hits, 1)
+
+    def test_negative_cache_head(self):
+        app = Rheostatic(ROOT, negative_cache_size=10)
+        self.assertResponse(
+            app=lambda: app,
+            method='HEAD',
+            url='/missing.html',
+            status=404,
+            headers={'Content-Length': str(len(get_file_content('404.html')))},
+            content=b''
+        )
+
+    def test_negative_cache_without_page(self):
+        app = Rheostatic(ROOT, negative_cache_size=10)
+        for i in range(2):
+            self.assertResponse(
+                app=lambda: app,
+                method='POST',
+                url='/other.html',
+                status=405,
+                headers={'Content-type': 'text/plain; charset=utf-8'},
+                content=b'405 Method Not Allowed'
+            )
+        self.assertEqual(app._error_pages.hits, 1)
+
+    def test_negative_cache_size_limit(self):
+        app = Rheostatic(ROOT, negative_cache_size=1)
+        app.resolve('/missing1.html')
+        app.resolve('/missing2.html')
+        self.assertEqual(len(app._negative_cache), 1)
+        self.assertIsNone(app._negative_cache.get('/missing1.html'))
+
+    def test_negative_cache_validate(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        app = Rheostatic(root, negative_cache_size=10)
+        self.assertResponse(app=lambda: app, method='GET', url='/sub/page.html', status=404)
+        self.assertResponse(app=lambda: app, method='GET', url='/sub/page.html', status=404)
+        self.assertEqual(app._negative_cache.hits, 1)
+        # Creating the file (and its directory) changes the mtime of the root
+        os.mkdir(os.path.join(root, 'sub'))
+        os.utime(root, ns=(0, 0))
+        with open(os.path.join(root, 'sub', 'page.html'), 'wb') as f:
+            f.write(b'new')
+        self.assertResponse(app=lambda: app, method='GET', url='/sub/page.html', status=200, content=b'new')
+
+    def test_negative_cache_validate_error_page(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        app = Rheostatic(root, negative_cache_size=10)
+        self.assertResponse(app=lambda: app, method='GET', url='/missing.html', status=404,
+                            content=b'404 Not Found')
+        with open(os.path.join(root, '404.html'), 'wb') as f:
+            f.write(b'<p>gone</p>')
+        self.assertResponse(app=lambda: app, method='GET', url='/missing.html', status=404,
+                            headers={'Content-Length': '11'}, content=b'<p>gone</p>')
+
+    def test_negative_cache_no_validate(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        app = Rheostatic(root, negative_cache_size=10, negative_cache_validate=False)
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', status=404)
+        with open(os.path.join(root, 'page.html'), 'wb') as f:
+            f.write(b'new')
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', status=404)
+        app.forget('/page.html')
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', status=200, content=b'new')
+
+    def test_routes(self):
+        app = Rheostatic(ROOT, routes=True)
+        self.assertEqual(app._routes['/'].path, os.path.join(ROOT, 'index.html'))
+        self.assertIs(app._routes['/'], app._routes['/index.html'])
+        self.assertEqual(app._routes['/subdir'].kind, 'redirect')
+        self.assertEqual(app._routes['/subdir/'].kind, 'directory')
+        self.assertIn('/subdir/link_to_empty_dir/filler', app._routes)
+        self.assertNotIn('/other', app._routes)
+        self.assertResponse(app=lambda: app, method='GET', url='/missing.html', status=404)
+        with mock.patch('rheostatic.base.os.stat') as os_stat:
+            self.assertResponse(
+                app=lambda: app,
+                method='GET',
+                url='/other.html',
+                status=200,
+                headers={'Content-type': 'text/html; charset=utf-8'},
+                content=get_file_content('other.html')
+            )
+            self.assertResponse(app=lambda: app, method='GET', url='/subdir', status=301)
+            self.assertResponse(app=lambda: app, method='GET', url='/missing.html', status=404,
+                                content=get_file_content('404.html'))
+        os_stat.assert_not_called()
+
+    def test_routes_default_extension(self):
+        app = Rheostatic(ROOT, routes=True, default_extension='.html')
+        self.assertIs(app._routes['/other'], app._routes['/other.html'])
+        self.assertResponse(app=lambda: app, method='GET', url='/subdir/subpage', status=200,
+                            content=get_file_content('subdir/subpage.html'))
+
+    def test_routes_normalized(self):
+        app = Rheostatic(ROOT, routes=True)
+        self.assertIs(app.resolve('/subdir/../other.html'), app._routes['/other.html'])
+        self.assertIs(app.resolve('//other.html'), app._routes['/other.html'])
+        self.assertIs(app.resolve('/%6Fther.html'), app._routes['/other.html'])
+        self.assertIs(app.resolve('/subdir/./'), app._routes['/subdir/'])
+        self.assertIsNone(app.resolve('/../tests/data/other.html'))
+
+    def test_routes_packed(self):
+        app = Rheostatic(make_pack(self), routes=True)
+        self.addCleanup(app._tree.close)
+        self.assertIs(app._routes['/other.html'], app._tree_resources[os.path.join(app.root, 'other.html')])
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200,
+                            content=get_file_content('other.html'))
+
+    def test_routes_rescan(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'page.html'), 'wb') as f:
+            f.write(b'page')
+        app = Rheostatic(root, routes=True)
+        resource = app._routes['/page.html']
+        with open(os.path.join(root, 'new.html'), 'wb') as f:
+            f.write(b'new')
+        self.assertResponse(app=lambda: app, method='GET', url='/new.html', status=404)
+        app.rescan()
+        self.assertResponse(app=lambda: app, method='GET', url='/new.html', status=200, content=b'new')
+        # Unchanged files keep their resources
+        self.assertIs(app._routes['/page.html'], resource)
+
+    def test_routes_rescan_interval(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        app = Rheostatic(root, routes=True, rescan_interval=60)
+        with open(os.path.join(root, 'new.html'), 'wb') as f:
+            f.write(b'new')
+        self.assertIsNone(app.resolve('/new.html'))
+        with mock.patch('rheostatic.base.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNotNone(app.resolve('/new.html'))
+
+    def test_routes_validate(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'page.html')
+        with open(path, 'wb') as f:
+            f.write(b'old')
+        app = Rheostatic(root, routes=True, cache_validate=True)
+        with open(path, 'wb') as f:
+            f.write(b'changed')
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', status=200,
+                            headers={'Content-Length': '7'}, content=b'changed')
+        os.remove(path)
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', status=404)
+
+    def test_no_cache_control(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={'Cache-Control': None, 'Expires': None},
+            content=get_file_content('other.html')
+        )
+
+    def test_cache_control_rules(self):
+        app = Rheostatic(ROOT, cache_control=[
+            ('subdir/*.html', 'no-cache'),
+            ('*.html', 'max-age=60'),
+            ('*.ico', 'max-age=86400')
+        ])
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200,
+                            headers={'Cache-Control': 'max-age=60'})
+        self.assertResponse(app=lambda: app, method='GET', url='/subdir/subpage.html', status=200,
+                            headers={'Cache-Control': 'no-cache'})
+        self.assertResponse(app=lambda: app, method='GET', url='/favicon.ico', status=200,
+                            headers={'Cache-Control': 'max-age=86400'})
+        self.assertResponse(app=lambda: app, method='GET', url='/subdir/unknown-file-type.abc', status=200,
+                            headers={'Cache-Control': None})
+
+    def test_cache_control_dict(self):
+        app = Rheostatic(ROOT, cache_control={'/other.html': 'max-age=60'})
+        self.assertEqual(app.get_cache_control(os.path.join(ROOT, 'other.html')), 'max-age=60')
+        self.assertIsNone(app.get_cache_control(os.path.join(ROOT, 'index.html')))
+
+    def test_cache_control_not_modified(self):
+        app = Rheostatic(ROOT, cache_control={'*.html': 'max-age=60'}, expires=True)
+        etag = app.resolve('/other.html').etag
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=304,
+                            request_headers={'If-None-Match': etag},
+                            headers={'Cache-Control': 'max-age=60', 'Expires': mock.ANY})
+
+    def test_expires(self):
+        app = Rheostatic(ROOT, cache_control={'*.html': 'public, max-age=60', '*': 'no-store'}, expires=True)
+        with mock.patch('rheostatic.base.time.time', return_value=1000000000):
+            self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200,
+                                headers={'Expires': 'Sun, 09 Sep 2001 01:47:40 GMT'})
+            self.assertResponse(app=lambda: app, method='GET', url='/favicon.ico', status=200,
+                                headers={'Cache-Control': 'no-store', 'Expires': None})
+
+    def test_fingerprinted(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for name in ('app.3f9a2c.js', 'app.js'):
+            with open(os.path.join(root, name), 'wb') as f:
+                f.write(b'var a;')
+        app = Rheostatic(root, cache_control={'*.js': 'no-cache'})
+        self.assertResponse(app=lambda: app, method='GET', url='/app.3f9a2c.js', status=200,
+                            headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+        self.assertResponse(app=lambda: app, method='GET', url='/app.js', status=200,
+                            headers={'Cache-Control': 'no-cache'})
+        app = Rheostatic(root, fingerprint_pattern=None)
+        self.assertResponse(app=lambda: app, method='GET', url='/app.3f9a2c.js', status=200,
+                            headers={'Cache-Control': None})
+
+    def test_parse_max_age(self):
+        self.assertEqual(utils.parse_max_age('public, max-age=60'), 60)
+        self.assertEqual(utils.parse_max_age('Max-Age="3600", immutable'), 3600)
+        self.assertIsNone(utils.parse_max_age('s-maxage=60, no-cache'))
+
+    def test_bandwidth_limit(self):
+        app = Rheostatic(ROOT, bandwidth_limit=100, bandwidth_burst=1000)
+        with mock.patch('rheostatic.utils.time.sleep') as sleep:
+            self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200,
+                                content=get_file_content('other.html'))
+            self.assertResponse(app=lambda: app, method='HEAD', url='/other.html', status=200, content=b'')
+        size = len(get_file_content('other.html'))
+        bucket = app._buckets.get('127.0.0.1') or app._buckets.get('')
+        self.assertAlmostEqual(bucket.tokens, 1000 - size, delta=5)
+        self.assertEqual(sleep.called, size > 1000)
+
+    def test_reload(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'page.html')
+        with open(path, 'wb') as f:
+            f.write(b'old')
+        app = Rheostatic(root, cache_size=10, preload=True)
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', content=b'old')
+        with open(path, 'wb') as f:
+            f.write(b'changed')
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', content=b'old')
+        app.reload()
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', content=b'changed')
+
+    def test_reload_routes(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        app = Rheostatic(root, routes=True, preload=True)
+        with open(os.path.join(root, 'new.html'), 'wb') as f:
+            f.write(b'new')
+        self.assertResponse(app=lambda: app, method='GET', url='/new.html', status=404)
+        app.reload()
+        self.assertResponse(app=lambda: app, method='GET', url='/new.html', status=200, content=b'new')
+        self.assertIn(os.path.join(root, 'new.html'), app._tree.data)
+
+    def test_get_etag(self):
+        st = os.stat(os.path.join(ROOT, 'other.html'))
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={'ETag': '"{:x}-{:x}"'.format(st.st_mtime_ns, st.st_size)},
+            content=get_file_content('other.html')
+        )
+
+    def test_get_hash_etag(self):
+        app = Rheostatic(ROOT, etag='hash')
+        etag = app.resolve('/other.html').etag
+        self.assertRegex(etag, '^"[0-9a-f]{32}"$')
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={'ETag': etag},
+            content=get_file_content('other.html')
+        )
+
+    def test_get_no_etag(self):
+        self.assertResponse(
+            app=make_app(etag=None),
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={'ETag': None},
+            content=get_file_content('other.html')
+        )
+
+    def test_get_if_none_match(self):
+        etag = Rheostatic(ROOT).resolve('/other.html').etag
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'If-None-Match': '"foo", W/' + etag},
+            status=304,
+            headers={'ETag': etag, 'Content-Length': None},
+            content=b''
+        )
+
+    def test_get_if_none_match_changed(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'If-None-Match': '"foo"', 'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'},
+            status=200,
+            content=get_file_content('other.html')
+        )
+
+    def test_get_if_modified_since(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'},
+            status=304,
+            content=b''
+        )
+
+    def test_get_if_modified_since_changed(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'},
+            status=200,
+            content=get_file_content('other.html')
+        )
+
+    def test_get_range(self):
+        size = len(get_file_content('other.html'))
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=10-19'},
+            status=206,
+            headers={
+                'Accept-Ranges': 'bytes',
+                'Content-Length': '10',
+                'Content-Range': 'bytes 10-19/%d' % size,
+                'Content-type': 'text/html; charset=utf-8'
+            },
+            content=get_file_content('other.html')[10:20]
+        )
+
+    def test_get_suffix_range(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=-5'},
+            status=206,
+            content=get_file_content('other.html')[-5:]
+        )
+
+    def test_get_open_range(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=5-'},
+            status=206,
+            content=get_file_content('other.html')[5:]
+        )
+
+    def test_head_range(self):
+        self.assertResponse(
+            app=make_app(),
+            method='HEAD',
+            url='/other.html',
+            request_headers={'Range': 'bytes=0-0'},
+            status=206,
+            headers={'Content-Length': '1'},
+            content=b''
+        )
+
+    def test_get_multiple_ranges(self):
+        data = get_file_content('other.html')
+        host, port = 'localhost', 80
+        http_client_intercept.install()
+        add_wsgi_intercept(host, port, make_app())
+        client = http_lib.HTTPConnection(host, port)
+        client.request('GET', '/other.html', headers={'Range': 'bytes=0-4,-5'})
+        response = client.getresponse()
+        body = response.read()
+        client.close()
+        remove_wsgi_intercept(host, port)
+        http_client_intercept.uninstall()
+
+        self.assertEqual(response.status, 206)
+        content_type, _, boundary = response.getheader('Content-type').partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        self.assertEqual(int(response.getheader('Content-Length')), len(body))
+        parts = body.split(b'--' + boundary.encode())
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(parts[-1], b'--\r\n')
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + data[:5] + b'\r\n'))
+        self.assertIn(b'Content-Range: bytes 0-4/%d' % len(data), parts[1])
+        self.assertTrue(parts[2].endswith(b'\r\n\r\n' + data[-5:] + b'\r\n'))
+
+    def test_get_unsatisfiable_range(self):
+        size = len(get_file_content('other.html'))
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=%d-' % size},
+            status=416,
+            headers={'Content-Range': 'bytes */%d' % size},
+            content=b'416 Range Not Satisfiable'
+        )
+
+    def test_get_invalid_range(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=5-1'},
+            status=200,
+            content=get_file_content('other.html')
+        )
+
+    def test_get_if_range(self):
+        etag = Rheostatic(ROOT).resolve('/other.html').etag
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=0-4', 'If-Range': etag},
+            status=206,
+            content=get_file_content('other.html')[:5]
+        )
+
+    def test_get_if_range_changed(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=0-4', 'If-Range': '"changed"'},
+            status=200,
+            content=get_file_content('other.html')
+        )
+
+    def test_get_precompressed(self):
+        self.assertResponse(
+            app=make_app(precompressed=['br', 'gzip']),
+            method='GET',
+            url='/other.html',
+            request_headers={'Accept-Encoding': 'gzip, deflate'},
+            status=200,
+            headers={
+                'Content-Encoding': 'gzip',
+                'Vary': 'Accept-Encoding',
+                'Content-Length': str(len(get_file_content('other.html.gz'))),
+                'Content-type': 'text/html; charset=utf-8'
+            },
+            content=get_file_content('other.html.gz')
+        )
+
+    def test_get_precompressed_not_modified(self):
+        app = make_app(precompressed=['gzip'])
+        etag = app().negotiate(app().resolve('/other.html'), {'HTTP_ACCEPT_ENCODING': 'gzip'}).etag
+        self.assertResponse(
+            app=app,
+            method='GET',
+            url='/other.html',
+            request_headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag},
+            status=304,
+            headers={'ETag': etag, 'Vary': 'Accept-Encoding', 'Content-Encoding': None},
+            content=b''
+        )
+
+    def test_get_precompressed_not_accepted(self):
+        self.assertResponse(
+            app=make_app(precompressed=['gzip']),
+            method='GET',
+            url='/other.html',
+            request_headers={'Accept-Encoding': 'br, gzip;q=0'},
+            status=200,
+            headers={'Content-Encoding': None, 'Vary': 'Accept-Encoding'},
+            content=get_file_content('other.html')
+        )
+
+    def test_get_precompressed_missing(self):
+        self.assertResponse(
+            app=make_app(precompressed=['gzip']),
+            method='GET',
+            url='/index.html',
+            request_headers={'Accept-Encoding': 'gzip'},
+            status=200,
+            headers={'Content-Encoding': None, 'Vary': None},
+            content=get_file_content('index.html')
+        )
+
+    def test_get_precompressed_preference(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for name in ('page.css', 'page.css.br', 'page.css.gz'):
+            with open(os.path.join(root, name), 'wb') as f:
+                f.write(name.encode())
+        app = Rheostatic(root, precompressed=['br', 'gzip'])
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/page.css',
+            request_headers={'Accept-Encoding': 'gzip, br'},
+            headers={'Content-Encoding': 'br', 'Content-type': 'text/css; charset=utf-8'},
+            content=b'page.css.br'
+        )
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/page.css',
+            request_headers={'Accept-Encoding': 'gzip, br;q=0.5'},
+            headers={'Content-Encoding': 'gzip'},
+            content=b'page.css.gz'
+        )
+
+    def test_get_compressed(self):
+        app = Rheostatic(ROOT, compress=['gzip'], compress_min_size=0)
+        etag = app.resolve('/other.html').etag
+        data = utils.compress(get_file_content('other.html'), 'gzip')
+        for i in range(2):
+            self.assertResponse(
+                app=lambda: app,
+                method='GET',
+                url='/other.html',
+                request_headers={'Accept-Encoding': 'gzip'},
+                status=200,
+                headers={
+                    'Content-Encoding': 'gzip',
+                    'Content-Length': str(len(data)),
+                    'Content-type': 'text/html; charset=utf-8',
+                    'ETag': etag[:-1] + '-gzip"',
+                    'Vary': 'Accept-Encoding'
+                },
+                content=data
+            )
+        self.assertEqual(app._compress_cache.hits, 1)
+        self.assertEqual(len(app._compress_cache), 1)
+
+    def test_get_compressed_content(self):
+        app = Rheostatic(ROOT, compress=['gzip'], compress_min_size=0)
+        body, length = app.get_compressed_body(
+            app.get_compressed_resource(app.resolve('/other.html'), 'gzip'),
+            {'REQUEST_METHOD': 'GET'}
+        )
+        self.assertEqual(gzip.decompress(b''.join(body)), get_file_content('other.html'))
+        self.assertEqual(length, len(b''.join(body)))
+
+    def test_get_compressed_stream(self):
+        app = Rheostatic(ROOT, compress=['gzip'], compress_min_size=0, compress_stream_size=10)
+        body, length = app.get_compressed_body(
+            app.get_compressed_resource(app.resolve('/other.html'), 'gzip'),
+            {'REQUEST_METHOD': 'GET'}
+        )
+        self.assertIsNone(length)
+        self.assertEqual(gzip.decompress(b''.join(body)), get_file_content('other.html'))
+        self.assertEqual(len(app._compress_cache), 0)
+
+    def test_get_compressed_not_accepted(self):
+        self.assertResponse(
+            app=make_app(compress=['gzip'], compress_min_size=0),
+            method='GET',
+            url='/other.html',
+            request_headers={'Accept-Encoding': 'identity'},
+            status=200,
+            headers={'Content-Encoding': None, 'Vary': 'Accept-Encoding'},
+            content=get_file_content('other.html')
+        )
+
+    def test_get_compressed_min_size(self):
+        self.assertResponse(
+            app=make_app(compress=['gzip']),
+            method='GET',
+            url='/other.html',
+            request_headers={'Accept-Encoding': 'gzip'},
+            status=200,
+            headers={'Content-Encoding': None, 'Vary': None},
+            content=get_file_content('other.html')
+        )
+
+    def test_get_compressed_uncompressible_type(self):
+        self.assertResponse(
+            app=make_app(compress=['gzip'], compress_min_size=0),
+            method='GET',
+            url='/subdir/unknown-file-type.abc',
+            request_headers={'Accept-Encoding': 'gzip'},
+            status=200,
+            headers={'Content-Encoding': None},
+            content=get_file_content('subdir/unknown-file-type.abc')
+        )
+
+    def test_get_compressed_range(self):
+        self.assertResponse(
+            app=make_app(compress=['gzip'], compress_min_size=0),
+            method='GET',
+            url='/other.html',
+            request_headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-4'},
+            status=206,
+            headers={'Content-Encoding': None},
+            content=get_file_content('other.html')[:5]
+        )
+
+    def test_compress_unsupported(self):
+        self.assertRaises(ValueError, Rheostatic, ROOT, compress=['unknown'])
+
+    def test_compress_cache_size(self):
+        app = Rheostatic(ROOT, compress=['gzip'], compress_min_size=0, compress_cache_size=10)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/other.html',
+            request_headers={'Accept-Encoding': 'gzip'},
+            status=200,
+            headers={'Content-Encoding': 'gzip'}
+        )
+        self.assertEqual(len(app._compress_cache), 0)
+        self.assertEqual(app._compress_cache.currsize, 0)
+
+    def test_get_dir_listing_cached(self):
+        app = Rheostatic(ROOT)
+        for i in range(2):
+            self.assertResponse(
+                app=lambda: app,
+                method='GET',
+                url='/subdir/',
+                status=200,
+                content=get_file_content('subdir/expected_dir_list.html')
+            )
+        self.assertEqual(app._listing_cache.hits, 1)
+
+    def test_get_dir_listing_changed(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        app = Rheostatic(root, directory_template='{items}')
+        self.assertResponse(app=lambda: app, method='GET', url='/', content=b'')
+        open(os.path.join(root, 'new.txt'), 'w').close()
+        os.utime(root, ns=(0, 0))
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/',
+            content=b'<li><a href="new.txt">new.txt</a></li>'
+        )
+
+    def test_get_dir_listing_stream(self):
+        self.assertResponse(
+            app=make_app(listing_stream=True),
+            method='GET',
+            url='/subdir/',
+            status=200,
+            headers={'Content-type': 'text/html; charset=utf-8', 'Content-Length': None},
+            content=get_file_content('subdir/expected_dir_list.html')
+        )
+
+    def test_dir_listing_stream_batches(self):
+        app = Rheostatic(ROOT)
+        entries = app.get_listing_entries(os.path.join(ROOT, 'subdir'))
+        chunks = list(app.render_listing(entries, 'http://localhost/subdir/', batch_size=2))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(b''.join(chunks), get_file_content('subdir/expected_dir_list.html'))
+
+    def test_get_dir_listing_json(self):
+        app = Rheostatic(ROOT)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/subdir/', 'QUERY_STRING': 'format=json',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+        listing = json.loads(b''.join(app(environ, lambda status, headers: None)))
+        self.assertEqual(listing['path'], '/subdir/')
+        self.assertEqual(listing['total'], 6)
+        self.assertEqual(listing['offset'], 0)
+        self.assertIsNone(listing['limit'])
+        self.assertEqual([entry['name'] for entry in listing['entries']], [
+            'empty_dir', 'expected_dir_list.html', 'link_to_empty_dir',
+            'link_to_subpage.html', 'subpage.html', 'unknown-file-type.abc'
+        ])
+        self.assertEqual(listing['entries'][0]['type'], 'directory')
+        self.assertEqual(listing['entries'][3]['type'], 'file')
+        self.assertTrue(listing['entries'][3]['link'])
+        self.assertEqual(listing['entries'][4]['size'], len(get_file_content('subdir/subpage.html')))
+
+    def test_get_dir_listing_json_page(self):
+        app = Rheostatic(ROOT)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/subdir/', 'QUERY_STRING': 'format=json&offset=4&limit=5',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+        listing = json.loads(b''.join(app(environ, lambda status, headers: None)))
+        self.assertEqual(listing['total'], 6)
+        self.assertEqual([entry['name'] for entry in listing['entries']], ['subpage.html', 'unknown-file-type.abc'])
+
+    def test_get_dir_listing_page(self):
+        self.assertResponse(
+            app=make_app(directory_template='{items}'),
+            method='GET',
+            url='/subdir/?offset=1&limit=1',
+            status=200,
+            headers={'Content-type': 'text/html; charset=utf-8'},
+            content=b'<li><a href="expected_dir_list.html">expected_dir_list.html</a></li>'
+        )
+
+    def test_get_dir_listing_bad_query(self):
+        for query in ('offset=-1', 'limit=x', 'format=xml'):
+            self.assertResponse(
+                app=make_app(),
+                method='GET',
+                url='/subdir/?' + query,
+                status=400,
+                content=b'400 Bad Request'
+            )
+
+    def test_get_dir_listing_if_none_match(self):
+        app = Rheostatic(ROOT)
+        headers = {}
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/subdir/', 'QUERY_STRING': '',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+        app(environ, lambda status, response_headers: headers.update(response_headers))
+        self.assertTrue(headers['ETag'].startswith('W/"'))
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/subdir/',
+            request_headers={'If-None-Match': headers['ETag']},
+            status=304,
+            content=b''
+        )
+
+    def test_get_dir_listing_json_if_none_match(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'file.txt')
+        with open(path, 'wb') as f:
+            f.write(b'old')
+        app = Rheostatic(root)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'QUERY_STRING': 'format=json',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+        headers = {}
+        app(dict(environ), lambda status, response_headers: headers.update(response_headers))
+        self.assertTrue(headers['ETag'].startswith('W/"'))
+        request = dict(environ, HTTP_IF_NONE_MATCH=headers['ETag'])
+        statuses = []
+        app(dict(request), lambda status, response_headers: statuses.append(status))
+        # A file changed in place leaves the modification time of its directory unchanged
+        dir_stat = os.stat(root)
+        with open(path, 'wb') as f:
+            f.write(b'changed')
+        os.utime(root, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+        listing = json.loads(b''.join(app(dict(request), lambda status, response_headers: statuses.append(status))))
+        self.assertEqual(statuses, ['304 Not Modified', '200 OK'])
+        self.assertEqual(listing['entries'][0]['size'], len(b'changed'))
+
+    def test_get_preloaded(self):
+        app = Rheostatic(ROOT, preload=True)
+        self.assertIn(os.path.join(ROOT, 'other.html'), app._tree.data)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={'Content-type': 'text/html; charset=utf-8'},
+            content=get_file_content('other.html')
+        )
+
+    def test_get_preloaded_index(self):
+        self.assertResponse(
+            app=make_app(preload=True),
+            method='GET',
+            url='/',
+            status=200,
+            content=get_file_content('index.html')
+        )
+
+    def test_get_preloaded_default_extension(self):
+        self.assertResponse(
+            app=make_app(preload=True, default_extension='.html'),
+            method='GET',
+            url='/other',
+            status=200,
+            content=get_file_content('other.html')
+        )
+
+    def test_get_preloaded_range(self):
+        self.assertResponse(
+            app=make_app(preload=True),
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=10-19'},
+            status=206,
+            content=get_file_content('other.html')[10:20]
+        )
+
+    def test_get_preloaded_not_found(self):
+        self.assertResponse(
+            app=make_app(preload=True),
+            method='GET',
+            url='/nonexistant.html',
+            status=404,
+            headers={'Content-type': 'text/html; charset=utf-8'},
+            content=get_file_content('404.html')
+        )
+
+    def test_preload_file_size(self):
+        app = Rheostatic(ROOT, preload=True, preload_file_size=200)
+        self.assertIn(os.path.join(ROOT, 'other.html'), app._tree.data)
+        self.assertNotIn(os.path.join(ROOT, 'index.html'), app._tree.data)
+        self.assertIn(os.path.join(ROOT, 'index.html'), app._tree.stats)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/index.html',
+            status=200,
+            content=get_file_content('index.html')
+        )
+
+    def test_preload_max_size(self):
+        app = Rheostatic(ROOT, preload=True, preload_max_size=0)
+        self.assertEqual(app._tree.data, {})
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', content=get_file_content('other.html'))
+
+    def test_preload_snapshot(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'page.html'), 'wb') as f:
+            f.write(b'preloaded')
+        app = Rheostatic(root, preload=True)
+        os.remove(os.path.join(root, 'page.html'))
+        self.assertResponse(app=lambda: app, method='GET', url='/page.html', status=200, content=b'preloaded')
+
+    def test_get_packed(self):
+        app = Rheostatic(make_pack(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={
+                'Content-type': 'text/html; charset=utf-8',
+                'ETag': Rheostatic(ROOT, etag='hash').resolve('/other.html').etag
+            },
+            content=get_file_content('other.html')
+        )
+
+    def test_write_pack_within_root(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        shutil.copy(os.path.join(ROOT, 'other.html'), root)
+        output = os.path.join(root, 'site.pack')
+        self.assertEqual(write_pack(root, output), 2)
+        size = os.path.getsize(output)
+        # Neither the earlier pack nor the partial pack is packed
+        self.assertEqual(write_pack(root, output), 2)
+        self.assertEqual(os.path.getsize(output), size)
+        self.assertEqual(sorted(os.listdir(root)), ['other.html', 'site.pack'])
+        app = Rheostatic(output)
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/site.pack', status=404)
+
+    def test_write_pack_error(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        output = os.path.join(root, 'site.pack')
+        with mock.patch('rheostatic.tree.walk', side_effect=OSError):
+            self.assertRaises(OSError, write_pack, ROOT, output)
+        self.assertEqual(os.listdir(root), [])
+
+    def test_get_packed_no_etag(self):
+        app = Rheostatic(make_pack(self), etag=None)
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200,
+                            headers={'ETag': None}, content=get_file_content('other.html'))
+
+    def test_get_packed_index(self):
+        app = Rheostatic(make_pack(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/', status=200,
+                            content=get_file_content('index.html'))
+
+    def test_get_packed_default_extension(self):
+        app = Rheostatic(make_pack(self), default_extension='.html')
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/other', status=200,
+                            content=get_file_content('other.html'))
+
+    def test_get_packed_range(self):
+        app = Rheostatic(make_pack(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=10-19,30-39'},
+            status=206
+        )
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/other.html',
+            request_headers={'Range': 'bytes=10-19'},
+            status=206,
+            content=get_file_content('other.html')[10:20]
+        )
+
+    def test_get_packed_not_found(self):
+        app = Rheostatic(make_pack(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/nonexistant.html',
+            status=404,
+            content=get_file_content('404.html')
+        )
+
+    def test_get_packed_dir_listing(self):
+        app = Rheostatic(make_pack(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/subdir/',
+            status=200,
+            content=get_file_content('subdir/expected_dir_list.html')
+        )
+        self.assertResponse(app=lambda: app, method='GET', url='/subdir', status=301)
+
+    def test_packed_replaced(self):
+        path = make_pack(self)
+        app = Rheostatic(path)
+        self.addCleanup(app._tree.close)
+        with open(path + '.new', 'wb') as f:
+            f.write(b'not a pack')
+        os.replace(path + '.new', path)
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200,
+                            content=get_file_content('other.html'))
+        self.assertRaises(ValueError, Rheostatic, path)
+
+    def test_reload_packed(self):
+        path = make_pack(self)
+        app = Rheostatic(path)
+        self.addCleanup(app._tree.close)
+        tree = app._tree
+        app.reload()
+        self.assertIs(app._tree, tree)
+        with zipfile.ZipFile(path + '.new', 'w') as archive:
+            archive.writestr('other.html', b'replaced')
+        os.replace(path + '.new', path)
+        app.reload()
+        self.addCleanup(app._tree.close)
+        self.assertEqual(tree.fds, [])
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200, content=b'replaced')
+
+    def test_reload_packed_open_body(self):
+        path = make_pack(self)
+        app = Rheostatic(path, timing=True)
+        tree = app._tree
+        self.addCleanup(tree.close)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/other.html', 'wsgi.file_wrapper': utils.FileWrapper}
+        body = app(environ, lambda status, response_headers: None)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/other.html', 'HTTP_RANGE': 'bytes=0-1,3-4'}
+        multipart = app(environ, lambda status, response_headers: None)
+        for content in (b'first', b'second'):
+            with zipfile.ZipFile(path + '.new', 'w') as archive:
+                archive.writestr('other.html', content)
+            os.replace(path + '.new', path)
+            app.reload()
+            self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200, content=b'second')
+        # The replaced archives are closed once their responses are
+        self.assertNotEqual(tree.fds, [])
+        self.assertEqual(b''.join(body), get_file_content('other.html'))
+        body.close()
+        self.assertNotEqual(tree.fds, [])
+        self.assertIn(get_file_content('other.html')[3:5], b''.join(multipart))
+        multipart.close()
+        self.assertEqual(tree.fds, [])
+
+    def test_load_tree_prepares_before_swap(self):
+        path = make_pack(self)
+        app = Rheostatic(path)
+        index = app._index
+        self.addCleanup(index[0].close)
+        tree = Tree.from_archive(path)
+        self.addCleanup(tree.close)
+        seen = []
+        get_file_resource = app.get_file_resource
+
+        def prepare(path, file_stat):
+            seen.append((app._tree, app._index))
+            return get_file_resource(path, file_stat)
+
+        with mock.patch.object(app, 'get_file_resource', prepare):
+            app.load_tree(tree)
+        self.assertTrue(seen)
+        self.assertTrue(all(pinned is tree and current is index for pinned, current in seen))
+        self.assertIs(app._tree, tree)
+        self.assertEqual(set(app._tree_resources), {p for p, st in tree.stats.items() if stat.S_ISREG(st.st_mode)})
+        self.assertEqual(index[0].fds, [])
+
+    def test_get_zip_stored(self):
+        app = Rheostatic(make_zip(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={'Content-type': 'text/html; charset=utf-8', 'Content-Encoding': None},
+            content=get_file_content('other.html')
+        )
+
+    def test_get_zip_no_etag(self):
+        app = Rheostatic(make_zip(self), etag=None)
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200,
+                            headers={'ETag': None}, content=get_file_content('other.html'))
+        self.assertResponse(app=lambda: app, method='GET', url='/subdir/subpage.html', status=200,
+                            request_headers={'Accept-Encoding': 'gzip'}, headers={'ETag': None})
+
+    def test_get_zip_deflated(self):
+        app = Rheostatic(make_zip(self))
+        self.addCleanup(app._tree.close)
+        content = get_file_content('subdir/subpage.html')
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/subdir/subpage.html',
+            status=200,
+            headers={'Content-Length': str(len(content)), 'Content-Encoding': None, 'Vary': 'Accept-Encoding'},
+            content=content
+        )
+
+    def test_get_zip_deflated_range(self):
+        app = Rheostatic(make_zip(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(
+            app=lambda: app,
+            method='GET',
+            url='/index.html',
+            request_headers={'Range': 'bytes=10-19', 'Accept-Encoding': 'gzip'},
+            status=206,
+            headers={'Content-Encoding': None},
+            content=get_file_content('index.html')[10:20]
+        )
+
+    def test_get_zip_deflated_gzip(self):
+        app = Rheostatic(make_zip(self))
+        self.addCleanup(app._tree.close)
+        headers = {}
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/index.html', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+        body = b''.join(app(environ, lambda status, response_headers: headers.update(response_headers)))
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertEqual(gzip.decompress(body), get_file_content('index.html'))
+
+    def test_get_zip_index(self):
+        app = Rheostatic(make_zip(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/', status=200,
+                            content=get_file_content('index.html'))
+        self.assertResponse(app=lambda: app, method='GET', url='/subdir', status=301)
+
+    def test_get_zip_default_extension(self):
+        app = Rheostatic(make_zip(self), default_extension='.html')
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/other', status=200,
+                            content=get_file_content('other.html'))
+
+    def test_get_zip_not_found(self):
+        app = Rheostatic(make_zip(self))
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/outside.html', status=404,
+                            content=get_file_content('404.html'))
+
+    def test_get_zip_dir_listing(self):
+        app = Rheostatic(make_zip(self))
+        self.addCleanup(app._tree.close)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/subdir/', 'QUERY_STRING': 'format=json',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+        listing = json.loads(b''.join(app(environ, lambda status, headers: None)))
+        self.assertEqual([entry['name'] for entry in listing['entries']], ['subpage.html'])
+        self.assertEqual(listing['entries'][0]['size'], len(get_file_content('subdir/subpage.html')))
+
+    def test_get_tar(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'site.tar')
+        with tarfile.open(path, 'w') as archive:
+            archive.add(os.path.join(ROOT, 'subdir', 'subpage.html'), './subdir/subpage.html')
+        app = Rheostatic(path)
+        self.addCleanup(app._tree.close)
+        self.assertResponse(app=lambda: app, method='GET', url='/subdir/subpage.html', status=200,
+                            content=get_file_content('subdir/subpage.html'))
+        with tarfile.open(path + '.gz', 'w:gz') as archive:
+            archive.add(os.path.join(ROOT, 'index.html'), 'index.html')
+        self.assertRaises(ValueError, Rheostatic, path + '.gz')
+
+    def test_server_timing(self):
+        app = Rheostatic(ROOT, timing=True)
+        headers = {}
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/subdir/', 'QUERY_STRING': '',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+        body = app(environ, lambda status, response_headers: headers.update(response_headers))
+        body.close()
+        phases = [phase.split(';')[0] for phase in headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['resolve', 'path', 'stat', 'index', 'listing', 'app'])
+        self.assertEqual(environ['rheostatic.timings'].status, 200)
+
+    def test_no_server_timing(self):
+        self.assertResponse(
+            app=make_app(),
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={'Server-Timing': None}
+        )
+
+    def test_timing_callback(self):
+        calls = []
+        self.assertResponse(
+            app=make_app(timing_callback=lambda timings, environ: calls.append((timings, environ))),
+            method='GET',
+            url='/other.html',
+            status=200,
+            headers={'Server-Timing': None},
+            content=get_file_content('other.html')
+        )
+        self.assertEqual(len(calls), 1)
+        timings, environ = calls[0]
+        self.assertEqual(environ['PATH_INFO'], '/other.html')
+        self.assertEqual(timings.status, 200)
+        self.assertEqual(timings.bytes_sent, len(get_file_content('other.html')))
+        self.assertIn('body', timings.phases)
+        self.assertGreaterEqual(timings.duration, timings.phases['resolve'])
+
+    def test_timing_callback_file_wrapper(self):
+        calls = []
+        app = Rheostatic(ROOT, timing_callback=lambda timings, environ: calls.append(timings))
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/other.html', 'wsgi.file_wrapper': utils.FileWrapper}
+        body = app(environ, lambda status, response_headers: None)
+        self.assertIsInstance(body, utils.FileWrapper)
+        self.assertEqual(calls, [])
+        body.close()
+        self.assertEqual(calls[0].bytes_sent, len(get_file_content('other.html')))
+
+    def test_metrics(self):
+        app = Rheostatic(ROOT, metrics=True, cache_size=10)
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200)
+        self.assertResponse(app=lambda: app, method='GET', url='/other.html', status=200)
+        self.assertResponse(app=lambda: app, method='GET', url='/nonexistant.html', status=404)
+        headers = {}
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/_rheostatic/metrics'}
+        body = app(environ, lambda status, response_headers: headers.update(response_headers))
+        lines = b''.join(body).decode('utf-8').splitlines()
+        body.close()
+        self.assertEqual(headers['Content-type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('rheostatic_requests_total{code="200"} 2', lines)
+        self.assertIn('rheostatic_requests_total{code="404"} 1', lines)
+        self.assertIn('rheostatic_requests_total{code="416"} 0', lines)
+        self.assertIn('rheostatic_response_bytes_total {}'.format(
+            2 * len(get_file_content('other.html')) + len(get_file_content('404.html'))), lines)
+        self.assertIn('rheostatic_request_duration_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('rheostatic_request_duration_seconds_count 3', lines)
+        # The request for the metrics is in flight
+        self.assertIn('rheostatic_requests_in_flight 1', lines)
+        self.assertIn('rheostatic_cache_hits_total{cache="resolve"} 1', lines)
+        self.assertIn('rheostatic_cache_misses_total{cache="resolve"} 2', lines)
+        self.assertIn('rheostatic_cache_hit_ratio{cache="resolve"} 0.333333', lines)
+
+    def test_metrics_large_counters(self):
+        app = Rheostatic(ROOT, metrics=True, cache_size=10)
+        app._cache.hits = 1234567
+        app._cache.misses = 10000000
+        app._cache.currsize = 16777216
+        lines = app._metrics.render({'resolve': app._cache}).splitlines()
+        self.assertIn('rheostatic_cache_hits_total{cache="resolve"} 1234567', lines)
+        self.assertIn('rheostatic_cache_misses_total{cache="resolve"} 10000000', lines)
+        self.assertIn('rheostatic_cache_hit_ratio{cache="resolve"} 0.10989', lines)
+        self.assertIn('rheostatic_cache_size{cache="resolve"} 16777216', lines)
+
+    def test_metrics_disabled(self):
+        self.assertResponse(app=make_app(), method='GET', url='/_rheostatic/metrics', status=404)
+
+    def test_metrics_path(self):
+        self.assertResponse(
+            app=make_app(metrics=True, metrics_path='/metrics'),
+            method='GET',
+            url='/metrics',
+            status=200,
+            headers={'Content-type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    def test_http_date_now(self):
+        with mock.patch('rheostatic.utils.time.time', return_value=1000000000.25):
+            self.assertEqual(utils.http_date_now(), 'Sun, 09 Sep 2001 01:46:40 GMT')
+        with mock.patch('rheostatic.utils.time.time', return_value=1000000000.75), \
+                mock.patch('rheostatic.utils.rfc822.formatdate') as formatdate:
+            # Formatted no more than once a second
+            self.assertEqual(utils.http_date_now(), 'Sun, 09 Sep 2001 01:46:40 GMT')
+            formatdate.assert_not_called()
+
+    def test_content_type_table(self):
+        app = Rheostatic(ROOT, encoding='latin-1', default_type='text/plain')
+        self.assertEqual(app.get_content_type('/srv/style.CSS'), 'text/css; charset=latin-1')
+        self.assertEqual(app.get_content_type('/srv/file.abc'), 'text/plain; charset=latin-1')
+        self.assertEqual(app.get_status(416), '416 Range Not Satisfiable')
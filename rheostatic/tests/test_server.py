@@ -0,0 +1,424 @@
+"""
+Rheostatic - A Static File Server with options.
+
+MIT License
+
+Copyright (c) 2016 Waylan Limberg
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import time
+import shutil
+import socket
+import tempfile
+import threading
+from unittest import TestCase, mock
+import http.client as http_lib
+
+from rheostatic import utils
+from rheostatic.base import Rheostatic
+from rheostatic.server import make_wsgi_server, get_inherited_sockets
+from rheostatic.tree import write_pack
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def get_file_content(path):
+    with open(os.path.join(ROOT, path), 'rb') as f:
+        return f.read()
+
+
+class TestServer(TestCase):
+    server_options = {}
+
+    @classmethod
+    def get_app(cls):
+        return Rheostatic(ROOT)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = make_wsgi_server(('127.0.0.1', 0), cls.get_app(), quiet=True, **cls.server_options)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, args=(0.01,), daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.thread.join()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.client = http_lib.HTTPConnection(*self.server.server_address)
+        self.addCleanup(self.client.close)
+
+    def request(self, method, url, headers=None):
+        self.client.request(method, url, headers=headers or {})
+        response = self.client.getresponse()
+        return response, response.read()
+
+    def test_sendfile(self):
+        response, content = self.request('GET', '/other.html')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(content, get_file_content('other.html'))
+
+    def test_sendfile_range(self):
+        response, content = self.request('GET', '/other.html', {'Range': 'bytes=10-19'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(content, get_file_content('other.html')[10:20])
+
+    def test_connection_close(self):
+        response, content = self.request('GET', '/other.html')
+        self.assertEqual(response.getheader('Connection'), 'close')
+
+
+class TestValidatedServer(TestServer):
+    server_options = {'validate': True}
+
+
+class TestKeepAliveServer(TestServer):
+    server_options = {'threads': 2, 'max_requests': 4}
+
+    def test_connection_close(self):
+        response, content = self.request('GET', '/other.html', {'Connection': 'close'})
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertEqual(content, get_file_content('other.html'))
+
+    def test_keep_alive(self):
+        response, content = self.request('GET', '/other.html')
+        self.assertIsNone(response.getheader('Connection'))
+        sock = self.client.sock
+        response, content = self.request('HEAD', '/subdir')
+        self.assertEqual(response.status, 301)
+        response, content = self.request('HEAD', '/subdir/')
+        self.assertEqual(response.status, 200)
+        self.assertIs(self.client.sock, sock)
+        response, content = self.request('GET', '/nonexistant.html')
+        self.assertEqual(response.status, 404)
+        self.assertEqual(content, get_file_content('404.html'))
+        # The connection is closed after max_requests
+        self.assertEqual(response.getheader('Connection'), 'close')
+
+    def test_keep_alive_no_delay(self):
+        # Nagle's algorithm would hold back each body written after its headers
+        # until the client's delayed ACK (40ms or more on Linux)
+        self.request('GET', '/other.html')
+        start = time.monotonic()
+        for i in range(3):
+            response, content = self.request('GET', '/other.html')
+            self.assertEqual(content, get_file_content('other.html'))
+        self.assertLess(time.monotonic() - start, 0.06)
+
+    def test_keep_alive_http10(self):
+        self.client._http_vsn, self.client._http_vsn_str = 10, 'HTTP/1.0'
+        response, content = self.request('GET', '/other.html', {'Connection': 'keep-alive'})
+        self.assertEqual(response.getheader('Connection'), 'keep-alive')
+        self.assertEqual(content, get_file_content('other.html'))
+
+
+class TestWSGIFlags(TestCase):
+
+    def get_flags(self, **kwargs):
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-type', 'text/plain')])
+            return [('%s %s' % (environ['wsgi.multithread'], environ['wsgi.multiprocess'])).encode('ascii')]
+
+        server = make_wsgi_server(('127.0.0.1', 0), app, quiet=True, **kwargs)
+        self.addCleanup(server.server_close)
+        return server
+
+    def request(self, server):
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        client = http_lib.HTTPConnection(*server.server_address)
+        self.addCleanup(client.close)
+        client.request('GET', '/')
+        content = client.getresponse().read()
+        thread.join()
+        return content
+
+    def test_single_thread(self):
+        server = self.get_flags()
+        self.assertEqual(self.request(server), b'False False')
+
+    def test_threads(self):
+        server = self.get_flags(threads=2)
+        self.assertEqual(self.request(server), b'True False')
+
+    def test_workers(self):
+        server = self.get_flags()
+        # As set by serve for more than one worker
+        server.multiprocess = True
+        self.assertEqual(self.request(server), b'False True')
+
+
+class TestPackServer(TestServer):
+
+    @classmethod
+    def get_app(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(cls.tmpdir, 'site.pack')
+        write_pack(ROOT, path)
+        return Rheostatic(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.get_app()._tree.close()
+        shutil.rmtree(cls.tmpdir)
+
+
+class TestMetricsServer(TestServer):
+
+    @classmethod
+    def get_app(cls):
+        return Rheostatic(ROOT, metrics=True)
+
+    def test_metrics(self):
+        response, content = self.request('GET', '/other.html')
+        response, content = self.request('GET', '/_rheostatic/metrics')
+        lines = content.decode('utf-8').splitlines()
+        self.assertIn('rheostatic_requests_in_flight 1', lines)
+        requests = sum(int(line.split()[-1]) for line in lines if line.startswith('rheostatic_requests_total'))
+        self.assertGreaterEqual(requests, 1)
+        self.assertIn('rheostatic_request_duration_seconds_count {}'.format(requests), lines)
+
+
+class TestLimitedServer(TestServer):
+    server_options = {'threads': 4, 'keepalive_timeout': 0, 'max_connections_per_ip': 2, 'retry_after': 7}
+
+    def wait_for_connections(self, count):
+        deadline = time.monotonic() + 5
+        while self.server.connection_limits.total != count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.connection_limits.total, count)
+
+    def test_connection_limit(self):
+        self.wait_for_connections(0)
+        idle = [socket.create_connection(self.server.server_address) for i in range(2)]
+        self.wait_for_connections(2)
+        response, content = self.request('GET', '/other.html')
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader('Retry-After'), '7')
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertEqual(content, b'503 Service Unavailable')
+        for sock in idle:
+            sock.close()
+        self.wait_for_connections(0)
+        self.client.close()
+        response, content = self.request('GET', '/other.html')
+        self.assertEqual(response.status, 200)
+
+
+class TestThrottledServer(TestServer):
+
+    @classmethod
+    def get_app(cls):
+        return Rheostatic(ROOT, bandwidth_limit=10000, bandwidth_burst=100)
+
+    def test_throttled(self):
+        with mock.patch('rheostatic.utils.time.sleep') as sleep:
+            response, content = self.request('GET', '/other.html')
+        self.assertEqual(content, get_file_content('other.html'))
+        self.assertTrue(sleep.called)
+
+
+class TestDrain(TestCase):
+
+    def setUp(self):
+        self.server = make_wsgi_server(('127.0.0.1', 0), Rheostatic(ROOT), threads=4, quiet=True)
+        self.addCleanup(self.server.server_close)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        sock = socket.create_connection(self.server.server_address)
+        self.addCleanup(sock.close)
+        return sock
+
+    def read_response(self, sock):
+        response = http_lib.HTTPResponse(sock)
+        response.begin()
+        return response, response.read()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def stop(self, timeout):
+        self.server.shutdown()
+        self.thread.join()
+        drain = threading.Thread(target=self.server.drain, args=(timeout,))
+        drain.start()
+        self.wait_for(lambda: self.server.draining)
+        return drain
+
+    def test_drain(self):
+        idle = self.connect()
+        idle.sendall(b'GET /other.html HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response, content = self.read_response(idle)
+        self.assertEqual(response.status, 200)
+        self.wait_for(lambda: len(self.server._idle) == 1)
+        busy = self.connect()
+        busy.sendall(b'GET /other.html HTTP/1.1\r\n')
+        self.wait_for(lambda: len(self.server._connections) == 2)
+        drain = self.stop(5)
+        # The idle connection is closed at once and the busy one after its response
+        self.assertEqual(idle.recv(65536), b'')
+        self.assertTrue(drain.is_alive())
+        busy.sendall(b'Host: localhost\r\n\r\n')
+        response, content = self.read_response(busy)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Connection'), 'close')
+        self.assertEqual(content, get_file_content('other.html'))
+        drain.join(5)
+        self.assertFalse(drain.is_alive())
+        self.assertRaises(OSError, socket.create_connection, self.server.server_address, 1)
+
+    def test_drain_timeout(self):
+        busy = self.connect()
+        busy.sendall(b'GET /other.html HTTP/1.1\r\n')
+        self.wait_for(lambda: len(self.server._connections) == 1)
+        start = time.monotonic()
+        self.stop(0.1).join(5)
+        self.assertLess(time.monotonic() - start, 5)
+        busy.settimeout(5)
+        self.assertEqual(busy.recv(65536), b'')
+
+
+class TestInheritedSocket(TestCase):
+
+    def test_inherited_socket(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        with mock.patch.dict(os.environ, {'RHEOSTATIC_FD': str(listener.fileno())}):
+            sock, = get_inherited_sockets()
+            self.assertNotIn('RHEOSTATIC_FD', os.environ)
+        self.assertEqual(sock.fileno(), listener.fileno())
+        listener.detach()
+        server = make_wsgi_server(('0.0.0.0', 1), Rheostatic(ROOT), quiet=True, sock=sock)
+        self.addCleanup(server.server_close)
+        self.assertEqual(server.server_address, sock.getsockname())
+        thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        client = http_lib.HTTPConnection(*server.server_address)
+        self.addCleanup(client.close)
+        client.request('GET', '/other.html')
+        self.assertEqual(client.getresponse().read(), get_file_content('other.html'))
+
+    def test_inherited_sockets(self):
+        listeners = [socket.socket() for i in range(2)]
+        fds = [listener.fileno() for listener in listeners]
+        with mock.patch.dict(os.environ, {'RHEOSTATIC_FD': '{},{}'.format(*fds)}):
+            sockets = get_inherited_sockets()
+        for listener in listeners:
+            listener.detach()
+        for sock in sockets:
+            self.addCleanup(sock.close)
+        self.assertEqual([sock.fileno() for sock in sockets], fds)
+
+    def test_no_inherited_socket(self):
+        with mock.patch.dict(os.environ, {'LISTEN_PID': '1', 'LISTEN_FDS': '1'}):
+            self.assertEqual(get_inherited_sockets(), [])
+            self.assertEqual(os.environ['LISTEN_FDS'], '1')
+
+
+class TestConnectionLimits(TestCase):
+
+    def test_limits(self):
+        limits = utils.ConnectionLimits(3, 2)
+        self.assertTrue(limits.acquire('a'))
+        self.assertTrue(limits.acquire('a'))
+        self.assertFalse(limits.acquire('a'))
+        self.assertTrue(limits.acquire('b'))
+        self.assertFalse(limits.acquire('c'))
+        limits.release('a')
+        self.assertTrue(limits.acquire('c'))
+        limits.release('b')
+        self.assertEqual(limits.addresses, {'a': 1, 'c': 1})
+        self.assertEqual(limits.total, 2)
+
+
+class TestTokenBucket(TestCase):
+
+    def test_consume(self):
+        with mock.patch('rheostatic.utils.time.monotonic', return_value=100.0) as monotonic:
+            bucket = utils.TokenBucket(1000, 2000)
+            self.assertEqual(bucket.consume(1500), 0)
+            self.assertEqual(bucket.consume(1000), 0.5)
+            monotonic.return_value = 101.0
+            self.assertEqual(bucket.consume(500), 0)
+            self.assertEqual(bucket.consume(1000), 1.0)
+
+    def test_throttled_body(self):
+        bucket = utils.TokenBucket(100)
+        body = utils.ThrottledBody([b'x' * 250], bucket, blksize=100)
+        with mock.patch('rheostatic.utils.time.sleep') as sleep:
+            self.assertEqual(list(body), [b'x' * 100, b'x' * 100, b'x' * 50])
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_timed_throttled_body(self):
+        closed = []
+        body = utils.TimedBody(utils.ThrottledBody([b'x' * 250], utils.TokenBucket(100), blksize=100), closed.append)
+        pieces = list(body.pieces())
+        self.assertEqual([piece for piece, delay in pieces], [b'x' * 100, b'x' * 100, b'x' * 50])
+        self.assertEqual([delay > 0 for piece, delay in pieces], [False, True, True])
+        body.close()
+        self.assertEqual(closed, [250])
+        self.assertFalse(hasattr(utils.TimedBody([b'x'], closed.append), 'pieces'))
+
+
+class TestFileWrapper(TestCase):
+
+    def test_iter(self):
+        wrapper = utils.FileWrapper(open(os.path.join(ROOT, 'other.html'), 'rb'), blksize=16)
+        self.addCleanup(wrapper.close)
+        self.assertEqual(b''.join(wrapper), get_file_content('other.html'))
+
+    def test_iter_mmap(self):
+        wrapper = utils.FileWrapper(open(os.path.join(ROOT, 'other.html'), 'rb'), blksize=16)
+        self.addCleanup(wrapper.close)
+        chunks = [bytes(chunk) for chunk in wrapper.iter_mmap()]
+        self.assertEqual(len(chunks[0]), 16)
+        self.assertEqual(b''.join(chunks), get_file_content('other.html'))
+
+    def test_iter_mmap_range(self):
+        f = open(os.path.join(ROOT, 'other.html'), 'rb')
+        wrapper = utils.FileWrapper(utils.FileRange(f, 10, 20), blksize=16)
+        self.addCleanup(wrapper.close)
+        self.assertEqual(b''.join(bytes(chunk) for chunk in wrapper.iter_mmap()),
+                         get_file_content('other.html')[10:30])
+
+    def test_positional_file(self):
+        fd = os.open(os.path.join(ROOT, 'other.html'), os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        first, second = utils.PositionalFile(fd, 10, 30), utils.PositionalFile(fd, 5, 15)
+        self.assertEqual(first.read(5), get_file_content('other.html')[10:15])
+        self.assertEqual(second.read(), get_file_content('other.html')[5:15])
+        self.assertEqual(first.read(), get_file_content('other.html')[15:30])
+        wrapper = utils.FileWrapper(utils.FileRange(utils.PositionalFile(fd, 10, 30), 5, 10), blksize=4)
+        self.assertEqual(wrapper.span()[1:], (15, 10))
+        self.assertEqual(b''.join(bytes(chunk) for chunk in wrapper.iter_mmap()),
+                         get_file_content('other.html')[15:25])
@@ -0,0 +1,407 @@
+"""
+Rheostatic - A Static File Server with options.
+
+MIT License
+
+Copyright (c) 2016 Waylan Limberg
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import io
+import os
+import stat
+import json
+import time
+import errno
+import struct
+import hashlib
+import tarfile
+import threading
+import zipfile
+import posixpath
+from collections import namedtuple
+
+from . import utils
+
+
+# The status of an entry which is not on disk, with the fields Rheostatic uses
+TreeStat = namedtuple('TreeStat', 'st_mode st_size st_mtime st_mtime_ns')
+
+# A pack starts with a header of the magic bytes, the format version and the
+# offset and length of its JSON index. The content of the files follows.
+PACK_MAGIC = b'RHEOPACK'
+PACK_VERSION = 1
+_pack_header = struct.Struct('<8sIQQ')
+
+# The fixed size part of the local file header of a zip archive member
+_zip_local_header = struct.Struct('<4s5H3L2H')
+
+
+def walk(root, unique=True):
+    """
+    Yield (path, stat, is_link) for root and every file and directory within it.
+
+    Symbolic links are followed, but no directory is entered twice. If `unique`
+    is false, a directory is entered once for every path to it instead, and only
+    links to a directory's own ancestors are not followed. Entries which cannot
+    be read (such as broken links) are skipped.
+
+    """
+    root_stat = os.stat(root)
+    yield root, root_stat, False
+    seen = {(root_stat.st_dev, root_stat.st_ino)}
+    stack = [(root, seen)]
+    while stack:
+        dirpath, ancestors = stack.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError:                                 # pragma: no cover
+            continue
+        for entry in entries:
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                continue
+            yield entry.path, entry_stat, entry.is_symlink()
+            if stat.S_ISDIR(entry_stat.st_mode):
+                key = (entry_stat.st_dev, entry_stat.st_ino)
+                if unique and key not in seen:
+                    seen.add(key)
+                    stack.append((entry.path, seen))
+                elif not unique and key not in ancestors:
+                    stack.append((entry.path, ancestors | {key}))
+
+
+class Tree:
+    """
+    An index of the files and directories which Rheostatic serves.
+
+    The index maps the absolute path of every entry to its status and of every
+    directory to its entries. The content of a file may be held in memory
+    (`data`), be a span of an open file (`spans`) or be a span of raw deflate
+    data (`deflated`, with the CRC-32 of the content). Paths missing from the
+    index are looked up on disk, unless the index is `complete`, as for an
+    archive.
+
+    Responses reading from the index `acquire` it and `release` it once they
+    are closed. An index which is replaced is `retire`d: its files are closed
+    once the last response reading from them is closed.
+
+    """
+
+    def __init__(self, complete=False):
+        self.complete = complete
+        self.stats = {}
+        self.children = {}
+        self.data = {}
+        self.spans = {}
+        self.deflated = {}
+        self.types = {}
+        self.etags = {}
+        self.fds = []
+        self._users = 0
+        self._retired = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_directory(cls, root, file_size=0, max_size=0):
+        """
+        Index a directory, reading files of up to `file_size` bytes into memory
+        until a total of `max_size` bytes is reached.
+
+        """
+        tree = cls()
+        total = 0
+        for path, file_stat, is_link in walk(root):
+            tree.add(path, file_stat, is_link)
+            size = file_stat.st_size
+            if stat.S_ISREG(file_stat.st_mode) and size <= file_size and total + size <= max_size:
+                try:
+                    with open(path, 'rb') as f:
+                        tree.data[path] = f.read()
+                except OSError:                         # pragma: no cover
+                    continue
+                total += size
+        return tree
+
+    @classmethod
+    def from_archive(cls, path):
+        """ Index a pack, zip archive or uncompressed tar archive. """
+        with open(path, 'rb') as f:
+            magic = f.read(len(PACK_MAGIC))
+        if magic == PACK_MAGIC:
+            return cls.from_pack(path)
+        if zipfile.is_zipfile(path):
+            return cls.from_zip(path)
+        if tarfile.is_tarfile(path):
+            return cls.from_tar(path)
+        raise ValueError(f'Not a rheostatic pack, zip or tar archive: {path!r}')
+
+    @classmethod
+    def from_pack(cls, path):
+        """
+        Index a pack written by `write_pack`.
+
+        The entries are found at `path` joined with their names within the pack.
+        The pack is held open, so it may be replaced on disk without disturbing
+        the index.
+
+        """
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            magic, version, index_offset, index_length = _pack_header.unpack(
+                utils.pread(fd, _pack_header.size, 0).ljust(_pack_header.size, b'\0')
+            )
+            if magic != PACK_MAGIC or version != PACK_VERSION:
+                raise ValueError(f'Not a rheostatic pack: {path!r}')
+            index = json.loads(utils.pread(fd, index_length, index_offset).decode('utf-8'))
+        except Exception:
+            os.close(fd)
+            raise
+        tree = cls(complete=True)
+        tree.fds.append(fd)
+        for name, is_dir, is_link, offset, size, mtime_ns, content_type, etag in index['entries']:
+            entry_path = os.path.join(path, *name.split('/')) if name else path
+            mode = stat.S_IFDIR | 0o755 if is_dir else stat.S_IFREG | 0o644
+            tree.add(entry_path, TreeStat(mode, size, mtime_ns / 1e9, mtime_ns), is_link)
+            if not is_dir:
+                tree.spans[entry_path] = (fd, offset, offset + size)
+                if content_type:
+                    tree.types[entry_path] = content_type
+                tree.etags[entry_path] = etag
+        return tree
+
+    @classmethod
+    def from_zip(cls, path):
+        """
+        Index the central directory of a zip archive.
+
+        Stored members are spans of the archive. Deflated members are inflated
+        as they are read, or may be sent as they are wrapped as gzip. Members
+        which are encrypted or use other compression methods are left out, as
+        are any with unsafe names.
+
+        """
+        with zipfile.ZipFile(path) as archive:
+            infos = archive.infolist()
+        tree, fd = cls._open_archive(path)
+        try:
+            for info in sorted(infos, key=lambda info: info.filename):
+                entry_path = tree.get_member_path(path, info.filename)
+                if entry_path is None or entry_path in tree.stats:
+                    continue
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                if info.is_dir():
+                    tree.add_member(entry_path, TreeStat(stat.S_IFDIR | 0o755, 0, mtime, int(mtime * 1e9)))
+                    continue
+                if info.flag_bits & 0x1 or info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                    continue
+                header = _zip_local_header.unpack(utils.pread(fd, _zip_local_header.size, info.header_offset))
+                start = info.header_offset + _zip_local_header.size + header[-2] + header[-1]
+                end = start + info.compress_size
+                tree.add_member(entry_path, TreeStat(stat.S_IFREG | 0o644, info.file_size, mtime, int(mtime * 1e9)))
+                if info.compress_type == zipfile.ZIP_STORED:
+                    tree.spans[entry_path] = (fd, start, end)
+                else:
+                    tree.deflated[entry_path] = (fd, start, end, info.CRC)
+                tree.etags[entry_path] = '"{:08x}-{:x}"'.format(info.CRC, info.file_size)
+        except Exception:
+            tree.close()
+            raise
+        return tree
+
+    @classmethod
+    def from_tar(cls, path):
+        """
+        Index an uncompressed tar archive.
+
+        Regular files are spans of the archive. Links and other special members
+        are left out, as are any with unsafe names.
+
+        """
+        try:
+            with tarfile.open(path, 'r:') as archive:
+                members = archive.getmembers()
+        except tarfile.ReadError:
+            raise ValueError(f'Compressed tar archives cannot be served: {path!r}')
+        tree, fd = cls._open_archive(path)
+        for member in sorted(members, key=lambda member: member.name):
+            entry_path = tree.get_member_path(path, member.name)
+            if entry_path is None or entry_path in tree.stats:
+                continue
+            if member.isdir():
+                tree.add_member(entry_path, TreeStat(stat.S_IFDIR | 0o755, 0, member.mtime, int(member.mtime * 1e9)))
+            elif member.isreg():
+                tree.add_member(entry_path, TreeStat(stat.S_IFREG | 0o644, member.size,
+                                                     member.mtime, int(member.mtime * 1e9)))
+                tree.spans[entry_path] = (fd, member.offset_data, member.offset_data + member.size)
+        return tree
+
+    @classmethod
+    def _open_archive(cls, path):
+        # Return a complete tree holding the archive open, with the archive as the root directory
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        archive_stat = os.fstat(fd)
+        tree = cls(complete=True)
+        tree.fds.append(fd)
+        tree.add(path, TreeStat(stat.S_IFDIR | 0o755, 0, archive_stat.st_mtime, archive_stat.st_mtime_ns))
+        return tree, fd
+
+    @staticmethod
+    def get_member_path(root, name):
+        """ Return the path of an archive member within root, or None if the name is unsafe. """
+        name = posixpath.normpath(name.replace('\\', '/'))
+        if name.startswith(('/', '../')) or name in ('.', '..'):
+            return None
+        return os.path.join(root, *name.split('/'))
+
+    def add_member(self, path, file_stat):
+        """ Add an archive member, and any parent directories the archive leaves implicit. """
+        parent = os.path.dirname(path)
+        if parent not in self.stats:
+            parent_stat = TreeStat(stat.S_IFDIR | 0o755, 0, file_stat.st_mtime, file_stat.st_mtime_ns)
+            self.add_member(parent, parent_stat)
+        self.add(path, file_stat)
+
+    def add(self, path, file_stat, is_link=False):
+        """ Add an entry to the index and to the entries of its parent directory. """
+        self.stats[path] = file_stat
+        is_dir = stat.S_ISDIR(file_stat.st_mode)
+        if is_dir:
+            self.children.setdefault(path, [])
+        parent, name = os.path.split(path)
+        if name and parent in self.children:
+            self.children[parent].append((name, is_dir, is_link))
+
+    def stat(self, path):
+        """ Return the status of path. """
+        file_stat = self.stats.get(path)
+        if file_stat is None:
+            if self.complete:
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+            file_stat = os.stat(path)
+        return file_stat
+
+    def open(self, path):
+        """ Return a binary file-like object of the content of path. """
+        data = self.data.get(path)
+        if data is not None:
+            return io.BytesIO(data)
+        span = self.spans.get(path)
+        if span is not None:
+            return utils.PositionalFile(*span)
+        deflated = self.deflated.get(path)
+        if deflated is not None:
+            return utils.InflatedFile(utils.PositionalFile(*deflated[:3]))
+        if self.complete:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        return open(path, 'rb')
+
+    def acquire(self):
+        """ Record a response reading from the index. Return False if the index is retired. """
+        with self._lock:
+            if self._retired:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        """ Record that a response has been closed, closing the index if it is retired and no longer read. """
+        with self._lock:
+            self._users -= 1
+            unused = self._retired and not self._users
+        if unused:
+            self.close()
+
+    def retire(self):
+        """ Close the index once no response reads from it, and refuse new responses. """
+        with self._lock:
+            self._retired = True
+            unused = not self._users
+        if unused:
+            self.close()
+
+    def close(self):
+        """ Close any files held open by the index. """
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+def write_pack(root, output):
+    """
+    Write the files and directories within root to a single pack file.
+
+    The pack holds the content of every file followed by an index sorted by
+    name which records the type, size, modification time, ContentType and a
+    content hash ETag of every entry. The pack is written alongside `output` and
+    then renamed, so a server never sees a partial pack. If `output` is within
+    root, neither it nor the partial pack is packed. Return the number of
+    entries written.
+
+    """
+    root = os.path.abspath(root)
+    tmp = output + '.tmp'
+    entries = []
+    try:
+        with open(tmp, 'wb') as out:
+            # Files are matched by device and inode, whatever the path to them
+            excluded = {(st.st_dev, st.st_ino) for st in (os.fstat(out.fileno()), _stat_or_none(output)) if st}
+            out.write(_pack_header.pack(PACK_MAGIC, PACK_VERSION, 0, 0))
+            for path, file_stat, is_link in walk(root):
+                if (file_stat.st_dev, file_stat.st_ino) in excluded:
+                    continue
+                name = os.path.relpath(path, root).replace(os.sep, '/') if path != root else ''
+                if stat.S_ISDIR(file_stat.st_mode):
+                    entries.append([name, True, is_link, 0, 0, file_stat.st_mtime_ns, None, None])
+                    continue
+                if not stat.S_ISREG(file_stat.st_mode):     # pragma: no cover
+                    continue
+                offset = out.tell()
+                digest = hashlib.blake2b(digest_size=16)
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        digest.update(chunk)
+                        out.write(chunk)
+                content_type = utils.types_map.get(os.path.splitext(name)[1].lower())
+                entries.append([name, False, is_link, offset, out.tell() - offset, file_stat.st_mtime_ns,
+                                content_type, '"{}"'.format(digest.hexdigest())])
+            entries.sort(key=lambda entry: entry[0])
+            index = json.dumps({'entries': entries}, separators=(',', ':')).encode('utf-8')
+            index_offset = out.tell()
+            out.write(index)
+            out.seek(0)
+            out.write(_pack_header.pack(PACK_MAGIC, PACK_VERSION, index_offset, len(index)))
+        os.replace(tmp, output)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:                                 # pragma: no cover
+            pass
+        raise
+    return len(entries)
+
+
+def _stat_or_none(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
@@ -26,6 +26,20 @@ SOFTWARE.
 
 
 import os
+import re
+import mmap
+import time
+import zlib
+import struct
+import functools
+import threading
+from collections import OrderedDict
+from email import utils as rfc822
+
+try:
+    import brotli
+except ImportError:                                     # pragma: no cover
+    brotli = None
 
 
 # version_info should conform to PEP 386
@@ -64,16 +78,727 @@ def decode_path_info(path_info):
     return path_info.encode('iso-8859-1').decode('utf-8')
 
 
+_date_now = (None, '')
+
+
+def http_date_now():
+    """ Return the current time formatted for a Date header, formatting it at most once a second. """
+    global _date_now
+    now = int(time.time())
+    cached = _date_now
+    if cached[0] != now:
+        cached = _date_now = (now, rfc822.formatdate(now, usegmt=True))
+    return cached[1]
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_date(seconds):
+    return rfc822.formatdate(seconds, usegmt=True)
+
+
+def http_date(timestamp):
+    """ Return a timestamp formatted for an HTTP header such as Last-Modified. """
+    return _format_date(int(timestamp))
+
+
+class LRUCache:
+    """
+    A thread-safe, size bounded, least-recently-used cache.
+
+    Entries older than `ttl` seconds are treated as missing. A `ttl` of `None`
+    means entries never expire and are only evicted to make room for new ones.
+
+    By default `maxsize` is a number of entries. If a `sizeof` function is
+    given, `maxsize` is instead the sum of `sizeof(value)` for all entries and
+    values larger than `maxsize` are never stored.
+
+    """
+
+    def __init__(self, maxsize=128, ttl=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value, size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.currsize -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.currsize -= self._data.pop(key)[2]
+            if size > self.maxsize:
+                return
+            self._data[key] = (expires, value, size)
+            self.currsize += size
+            while self.currsize > self.maxsize:
+                self.currsize -= self._data.popitem(last=False)[1][2]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            expires, value, size = self._data.pop(key)
+            self.currsize -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.currsize = 0
+
+
+class FileRange:
+    """
+    A read-only view of `length` bytes of an open file starting at `offset`.
+
+    The underlying file is left positioned at `offset`, so a `wsgi.file_wrapper`
+    which offloads to `os.sendfile` (bounded by the Content-Length header) may
+    use `fileno` directly.
+
+    """
+
+    def __init__(self, f, offset, length):
+        f.seek(offset)
+        self.file = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def span(self):
+        f, offset, count = file_span(self.file)
+        return f, offset, min(count, self.remaining)
+
+    def close(self):
+        self.file.close()
+
+
+def _pread(fd, size, offset):                           # pragma: no cover
+    # Emulate os.pread where it is not available, at the cost of a lock
+    with _pread_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+_pread_lock = threading.Lock()
+pread = getattr(os, 'pread', _pread)
+
+
+class PositionalFile:
+    """
+    A read-only file of the bytes from `start` to `end` of a file descriptor.
+
+    The position of the file is its own, and reads use `pread`, so any number of
+    readers may share one descriptor at once. The descriptor is not closed.
+
+    """
+
+    mode = 'rb'
+
+    def __init__(self, fd, start=0, end=None):
+        if end is None:
+            end = os.fstat(fd).st_size
+        self.fd = fd
+        self.start = start
+        self.end = end
+        self.pos = start
+
+    def fileno(self):
+        return self.fd
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos - self.start
+        elif whence == os.SEEK_END:
+            offset += self.end - self.start
+        self.pos = min(max(self.start + offset, self.start), self.end)
+        return self.pos - self.start
+
+    def tell(self):
+        return self.pos - self.start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.end - self.pos:
+            size = self.end - self.pos
+        data = pread(self.fd, size, self.pos) if size else b''
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def span(self):
+        # Offsets passed to sendfile are relative to the whole descriptor
+        return PositionalFile(self.fd, 0, self.end), self.pos, self.end - self.pos
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class InflatedFile:
+    """
+    A read-only file of the data inflated from a file of raw deflate data, such
+    as a deflated member of a zip archive.
+
+    Data is inflated as it is read. Seeking forward inflates and discards the
+    data skipped, and seeking backward starts over.
+
+    """
+
+    def __init__(self, raw, blksize=65536):
+        self.raw = raw
+        self.blksize = blksize
+        self._reset()
+
+    def _reset(self):
+        self.raw.seek(0)
+        self.pos = 0
+        self._inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and not self._inflater.eof:
+            data = self._inflater.unconsumed_tail or self.raw.read(self.blksize)
+            if not data:
+                break
+            self._buffer += self._inflater.decompress(data, self.blksize)
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:                       # pragma: no cover
+            raise OSError('InflatedFile only supports seeking from the start')
+        if offset < self.pos:
+            self._reset()
+        while self.pos < offset and self.read(min(self.blksize, offset - self.pos)):
+            pass
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_file(f, blocksize=65536):
+    """ Yield the content of an open file in blocks and close it. """
+    try:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            yield chunk
+    finally:
+        f.close()
+
+
+def file_span(f):
+    """ Return a file with a descriptor and the offset and count of the bytes left to read from f. """
+    if hasattr(f, 'span'):
+        return f.span()
+    offset = f.tell()
+    return f, offset, os.fstat(f.fileno()).st_size - offset
+
+
+class FileWrapper:
+    """
+    A `wsgi.file_wrapper` which can send a file without copying it into Python.
+
+    Iterating the wrapper reads the file in blocks, as wsgiref's wrapper does.
+    Servers which recognize the wrapper may instead copy the file straight to a
+    socket with `sendfile` or write the slices of a memory map yielded by
+    `iter_mmap`. Any `FileRange` or `PositionalFile` is respected.
+
+    If `on_close` is set, it is called once the wrapper is closed.
+
+    """
+
+    on_close = None
+
+    def __init__(self, filelike, blksize=65536):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), b'')
+
+    def close(self):
+        try:
+            self.filelike.close()
+        finally:
+            if self.on_close is not None:
+                self.on_close()
+
+    def span(self):
+        """ Return the underlying file and the offset and count of bytes to send. """
+        return file_span(self.filelike)
+
+    def sendfile(self, sock):
+        """ Copy the file to a socket with `socket.sendfile` and return the bytes sent. """
+        f, offset, count = self.span()
+        if count <= 0:
+            return 0
+        return sock.sendfile(f, offset, count)
+
+    def iter_mmap(self):
+        """
+        Yield memoryview slices of the file mapped into memory.
+
+        Each slice is released once the next one is requested.
+
+        """
+        f, offset, count = self.span()
+        if count <= 0:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            for start in range(offset, offset + count, self.blksize):
+                chunk = view[start:min(start + self.blksize, offset + count)]
+                try:
+                    yield chunk
+                finally:
+                    chunk.release()
+        finally:
+            view.release()
+            mapped.close()
+
+
+class Timings:
+    """
+    The time spent in each phase of handling a request.
+
+    `phases` maps the name of each phase to its total duration in seconds, in
+    the order the phases began. A Server-Timing header includes the time so far
+    of any phase still running. Once the response has been sent, `status`,
+    `bytes_sent` and `duration` (the time to the last byte) are set and the
+    time spent sending the body is added as the `body` phase.
+
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.responded = None
+        self.phases = {}
+        self.running = {}
+        self.status = None
+        self.bytes_sent = 0
+        self.duration = None
+
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0.0) + duration
+
+    def begin(self, name):
+        self.phases.setdefault(name, 0.0)
+        self.running[name] = time.perf_counter()
+
+    def end(self, name):
+        self.add(name, time.perf_counter() - self.running.pop(name))
+
+    def server_timing(self):
+        """ Return the phases, and the time taken so far as `app`, as the value of a Server-Timing header. """
+        now = time.perf_counter()
+        phases = [(name, duration + now - self.running.get(name, now)) for name, duration in self.phases.items()]
+        phases.append(('app', now - self.started))
+        return ', '.join('{};dur={:.3f}'.format(name, duration * 1000) for name, duration in phases)
+
+    def finish(self, bytes_sent):
+        now = time.perf_counter()
+        self.bytes_sent = bytes_sent
+        self.duration = now - self.started
+        if self.responded is not None:
+            self.add('body', now - self.responded)
+
+
+class TimedBody:
+    """
+    A response body which counts the bytes sent and calls `on_close(bytes_sent)` once it is closed.
+
+    If the body has `pieces` (as a `ThrottledBody` does), so does this one.
+
+    """
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.bytes_sent = 0
+        if hasattr(body, 'pieces'):
+            self.pieces = self._pieces
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.bytes_sent += len(chunk)
+            yield chunk
+
+    def _pieces(self):
+        for piece, delay in self.body.pieces():
+            self.bytes_sent += len(piece)
+            yield piece, delay
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close(self.bytes_sent)
+
+
+class ClosingBody:
+    """
+    A response body which calls `on_close()` once it is closed.
+
+    If the body has `pieces` (as a `ThrottledBody` does), so does this one.
+
+    """
+
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        if hasattr(body, 'pieces'):
+            self.pieces = body.pieces
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close()
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket which refills at `rate` tokens a second, up to `capacity`.
+
+    Tokens may be borrowed, in which case the consumer is told how long to wait
+    for them, so concurrent consumers of one bucket share its rate.
+
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """ Take amount tokens and return the number of seconds to wait before using them. """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(-self.tokens / self.rate, 0)
+
+
+class ThrottledBody:
+    """
+    A response body which is sent no faster than a `TokenBucket` of bytes allows.
+
+    Iterating sleeps before each block as the bucket requires. A server which
+    must not block (such as an event loop) iterates over `pieces` instead and
+    waits the delay of each block itself.
+
+    """
+
+    def __init__(self, body, bucket, blksize=16384):
+        self.body = body
+        self.bucket = bucket
+        self.blksize = blksize
+
+    def __iter__(self):
+        for piece, delay in self.pieces():
+            if delay:
+                time.sleep(delay)
+            yield piece
+
+    def pieces(self):
+        """ Yield each block of the body and the seconds to wait before sending it. """
+        for chunk in self.body:
+            for start in range(0, len(chunk), self.blksize):
+                piece = chunk[start:start + self.blksize]
+                yield piece, self.bucket.consume(len(piece))
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+class ConnectionLimits:
+    """
+    A thread-safe count of open connections, in total and from each client
+    address, against limits. A limit of 0 (or None) is no limit.
+
+    """
+
+    def __init__(self, max_connections=None, max_per_address=None):
+        self.max_connections = max_connections
+        self.max_per_address = max_per_address
+        self.total = 0
+        self.addresses = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, address):
+        """ Count a new connection from address and return True, or return False if it is over a limit. """
+        with self._lock:
+            count = self.addresses.get(address, 0)
+            if ((self.max_connections and self.total >= self.max_connections) or
+                    (self.max_per_address and count >= self.max_per_address)):
+                return False
+            self.total += 1
+            self.addresses[address] = count + 1
+            return True
+
+    def release(self, address):
+        """ Count a connection from address as closed. """
+        with self._lock:
+            self.total -= 1
+            count = self.addresses.pop(address) - 1
+            if count:
+                self.addresses[address] = count
+
+
+def service_unavailable(retry_after):
+    """ Return a complete 503 (Service Unavailable) response, which closes the connection, as bytes. """
+    status = status_lines[503]
+    return (
+        f'HTTP/1.1 {status}\r\n'
+        f'Date: {http_date_now()}\r\n'
+        f'Retry-After: {retry_after}\r\n'
+        f'Content-Length: {len(status)}\r\n'
+        'Content-type: text/plain\r\n'
+        'Connection: close\r\n'
+        f'\r\n{status}'
+    ).encode('latin-1')
+
+
+# The most ranges accepted in a single Range header
+MAX_RANGES = 64
+
+_range_spec = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range(value, size):
+    """
+    Parse the value of a Range header for a file of the given size.
+
+    Return a list of (start, stop) byte offsets, which is empty if no range is
+    satisfiable, or None if the header is invalid and should be ignored.
+
+    """
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    specs = [spec for spec in specs.split(',') if spec.strip()]
+    if not specs or len(specs) > MAX_RANGES:
+        return None
+    for spec in specs:
+        match = _range_spec.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if not first:
+            if not last:
+                return None
+            # A suffix range of the final bytes
+            if int(last):
+                ranges.append((max(size - int(last), 0), size))
+        else:
+            start = int(first)
+            stop = int(last) + 1 if last else size
+            if last and stop <= start:
+                return None
+            if start < size:
+                ranges.append((start, min(stop, size)))
+    return ranges
+
+
+def parse_accept_encoding(value):
+    """ Parse the value of an Accept-Encoding header into a dict of {coding: qvalue}. """
+    accepted = {}
+    for item in value.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, val = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        accepted[coding] = q
+    return accepted
+
+
+def _gzip_compressor():
+    # wbits=31 writes a gzip header (with a zero timestamp) and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def _brotli_compressor():                               # pragma: no cover
+    compressor = brotli.Compressor()
+    return compressor.process, compressor.finish
+
+
+# The encodings available for on the fly compression in order of preference
+compressors = {'gzip': _gzip_compressor}
+if brotli is not None:                                  # pragma: no cover
+    compressors = {'br': _brotli_compressor, 'gzip': _gzip_compressor}
+
+
+def compress(data, encoding):
+    """ Return data compressed with the given encoding. """
+    process, finish = compressors[encoding]()
+    return process(data) + finish()
+
+
+def iter_compressed(f, encoding, blocksize=65536):
+    """ Compress an open file as it is read, yielding chunks, and close it. """
+    process, finish = compressors[encoding]()
+    with f:
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            data = process(chunk)
+            if data:
+                yield data
+        yield finish()
+
+
+# The length of the header and trailer which `iter_gzip_member` adds
+GZIP_OVERHEAD = 18
+
+
+def iter_gzip_member(f, crc, size, blocksize=65536):
+    """
+    Yield raw deflate data read from an open file as a gzip member, and close it.
+
+    The CRC-32 and size of the uncompressed data must be known, as they are for
+    a member of a zip archive, so the data is never inflated.
+
+    """
+    with f:
+        # No file name, modification time or extra flags; OS unknown
+        yield b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+        for chunk in iter(lambda: f.read(blocksize), b''):
+            yield chunk
+        yield struct.pack('<LL', crc, size & 0xffffffff)
+
+
+# ContentTypes other than text/* which benefit from compression
+compressible_types = {
+    'application/atom+xml',
+    'application/javascript',
+    'application/json',
+    'application/postscript',
+    'application/rss+xml',
+    'application/rtf',
+    'application/vnd.ms-fontobject',
+    'application/x-javascript',
+    'application/x-perl',
+    'application/x-tcl',
+    'application/xhtml+xml',
+    'application/xspf+xml',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/x-ms-bmp'
+}
+
+
+def is_compressible(content_type):
+    return content_type.startswith('text/') or content_type in compressible_types
+
+
+# The file extension used for a precompressed copy of a file in each encoding
+encoding_extensions = {
+    'br': '.br',
+    'gzip': '.gz',
+    'zstd': '.zst'
+}
+
+# A file name with a content hash of at least 6 hexadecimal digits (including
+# both a digit and a letter) before its extension, such as `app.3f9a2c.js`
+fingerprint_pattern = r'[.-](?=[0-9a-f]*[0-9])(?=[0-9a-f]*[a-f])[0-9a-f]{6,}\.[^/]+$'
+
+_max_age = re.compile(r'(?:^|[,\s])max-age\s*=\s*"?(\d+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=64)
+def parse_max_age(cache_control):
+    """ Return the max-age directive of a Cache-Control header value in seconds, or None if it has none. """
+    match = _max_age.search(cache_control)
+    return int(match.group(1)) if match else None
+
+
 # Define only the HTTP status codes we actually use
 http_status = {
     200: 'OK',
+    206: 'Partial Content',
     301: 'Moved Permanently',
     304: 'Not Modified',
+    400: 'Bad Request',
     404: 'Not Found',
-    405: 'Method Not Allowed'
-
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    503: 'Service Unavailable'
 }
 
+# The status line of each response, prepared once
+status_lines = {code: '%d %s' % (code, reason) for code, reason in http_status.items()}
+
 directory_template = """<!DOCTYPE html>
 <html>
     <head>